@@ -1,8 +1,9 @@
+import json
 import os
 from datetime import datetime
 
 import click
-from flask import Flask, redirect, render_template, request, url_for
+from flask import Flask, Response, jsonify, redirect, render_template, request, stream_with_context, url_for
 from flask_migrate import Migrate
 from sqlalchemy.orm import DeclarativeBase
 from flask_sqlalchemy import SQLAlchemy
@@ -28,6 +29,76 @@ app.config.update(
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
 )
 
+# Search engine answering queries: 'memory' for the per-worker inverted index, 'segment' for the memory mapped
+# segment file shared by the workers, 'sql' to query the tables directly
+app.config.setdefault('SEARCH_ENGINE', 'memory')
+# Segment file written by flask export-index, and after every crawl when the segment engine is used,
+# defaults to index.segment in the instance folder
+app.config.setdefault('INDEX_SEGMENT_PATH', None)
+# Seconds between two checks of the index generation by a worker
+app.config.setdefault('INDEX_REFRESH_INTERVAL', 5)
+# Number of doc id ranges the in-memory index is partitioned into, the shards of a query are scored by parallel threads
+app.config.setdefault('SEARCH_SHARDS', 1)
+# Resolve the query words of the SQL engine with a sorted term dictionary kept by every worker instead of querying the term tables
+app.config.setdefault('SEARCH_TERM_DICTIONARY', True)
+# Skip the documents that cannot enter the top results (Block-Max WAND) instead of scoring every candidate
+app.config.setdefault('SEARCH_DYNAMIC_PRUNING', True)
+# Score all the candidates of a query at once with NumPy instead of the Python loops, no candidate is skipped so
+# SEARCH_DYNAMIC_PRUNING has no effect when it is enabled
+app.config.setdefault('SEARCH_VECTORIZED', False)
+# Weight of the PageRank (relative to the best page, so between 0 and 1) added to the BM25 score of the results
+app.config.setdefault('SEARCH_PAGERANK_WEIGHT', 0.0)
+# PageRank damping factor, L1 convergence tolerance and iteration cap of flask compute-pagerank
+app.config.setdefault('PAGERANK_DAMPING', 0.85)
+app.config.setdefault('PAGERANK_TOLERANCE', 1e-6)
+app.config.setdefault('PAGERANK_MAX_ITERATIONS', 100)
+# Number of tokens, stopwords excluded, of the text shown around the query in every result
+app.config.setdefault('SNIPPET_TOKENS', 30)
+# Number of results of a page of /api/search when no limit is given, and the largest limit accepted
+app.config.setdefault('SEARCH_API_LIMIT', 10)
+app.config.setdefault('SEARCH_API_MAX_LIMIT', 1000)
+# Pages of /api/search larger than this are streamed as JSON lines while the results are loaded
+app.config.setdefault('SEARCH_API_STREAM_LIMIT', 100)
+# Number of completions returned by /suggest, the best ones of the common prefixes are precomputed
+app.config.setdefault('SUGGEST_LIMIT', 10)
+# Time the stages and the SQL statements of the search requests, sent in a Server-Timing header and served by /metrics
+app.config.setdefault('SEARCH_METRICS', True)
+# Log the search requests slower than this many milliseconds with the breakdown of their time, None logs none
+app.config.setdefault('SEARCH_SLOW_QUERY_MS', None)
+# Search results cache of every worker, set the number of entries to 0 to disable it
+app.config.setdefault('RESULT_CACHE_ENTRIES', 1024)
+app.config.setdefault('RESULT_CACHE_TTL', 300)
+app.config.setdefault('RESULT_CACHE_BYTES', 64*1024*1024)
+# Tokenizer used for indexing and querying: 'punkt' (nltk word_tokenize) or the faster 'regex', the pages are
+# crawled again after changing it
+app.config.setdefault('PARSER_TOKENIZER', 'punkt')
+# Number of token stems memoized by the parser
+app.config.setdefault('PARSER_STEM_CACHE_SIZE', 100000)
+# Spider downloads: concurrent requests, concurrent requests per host, seconds between two requests to a host,
+# request timeout in seconds and retries of failed requests
+app.config.setdefault('SPIDER_CONCURRENCY', 8)
+app.config.setdefault('SPIDER_PER_HOST', 2)
+app.config.setdefault('SPIDER_DELAY', 0.0)
+app.config.setdefault('SPIDER_TIMEOUT', 10.0)
+app.config.setdefault('SPIDER_RETRIES', 3)
+# Rows buffered by the spider before they are written to the database in one batch
+app.config.setdefault('SPIDER_BATCH_SIZE', 50000)
+# Processes parsing the downloaded pages, None uses one per core and 0 parses in the main process
+app.config.setdefault('SPIDER_PARSE_WORKERS', None)
+# Urls read at once from the crawl frontier table, and stopped crawls a page may be fetched in before it is given up
+app.config.setdefault('SPIDER_FRONTIER_BATCH', 1000)
+app.config.setdefault('SPIDER_FRONTIER_RETRIES', 3)
+# Seconds between two commits of the pages crawled so far, init-spider --resume continues from the last one
+app.config.setdefault('SPIDER_CHECKPOINT_INTERVAL', 60.0)
+# Crawler worker processes sharing the frontier of a crawl, PostgreSQL only. A worker leases the urls it fetches
+# for SPIDER_LEASE_SECONDS and looks for new urls of its shard every SPIDER_POLL_INTERVAL seconds once it has none
+app.config.setdefault('SPIDER_SHARDS', 1)
+app.config.setdefault('SPIDER_LEASE_SECONDS', 600.0)
+app.config.setdefault('SPIDER_POLL_INTERVAL', 1.0)
+# Pages whose shingles have at least this Jaccard similarity, estimated by MinHash, with the ones of an indexed page
+# are stored as its near-duplicates without being indexed, None indexes every page. Below 0.8 some are missed
+app.config.setdefault('SPIDER_DUPLICATE_SIMILARITY', 0.9)
+
 class Base(DeclarativeBase):
     pass
 
@@ -38,7 +109,7 @@ db = SQLAlchemy(app, model_class=Base)
 migrate = Migrate(app, db)
 
 # The import must be done after db initialization due to circular import issue
-from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList, TitleCountList, BodyCountList
+from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList, DocumentKeyword, IndexMetadata
 
 from app.spider import init_app
 init_app(app)
@@ -55,6 +126,18 @@ def init_db_command():
 
 app.cli.add_command(init_db_command)
 
+from app.pagerank import init_app
+init_app(app)
+
+from app.segment import init_app
+init_app(app)
+
+from app.storage import init_app
+init_app(app)
+
+from app.metrics import init_app
+init_app(app)
+
 from app.spider import init_app
 init_app(app)
 
@@ -66,7 +149,9 @@ def hello():
 def base():
     return render_template('base.html')
 
-from app.search import search_db
+from app.search import decode_cursor, iter_hydrated, search_db, search_page
+from app.metrics import streamed
+from app.cache import get_result_cache
 
 @app.route('/search', methods=['GET'])
 def search():
@@ -77,4 +162,39 @@ def search():
     
     res = search_db(search_string)
 
-    return render_template('search.html', results = res)
\ No newline at end of file
+    return render_template('search.html', results = res)
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', app.config['SEARCH_API_LIMIT'], type=int)
+    if not 0 < limit <= app.config['SEARCH_API_MAX_LIMIT']:
+        return jsonify({'error': f'limit must be between 1 and {app.config["SEARCH_API_MAX_LIMIT"]}'}), 400
+    try:
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Only the results of the page are loaded
+    ranked, words, next_cursor = search_page(query, limit, after)
+    results = iter_hydrated(db.session, ranked, words, app.config['SNIPPET_TOKENS'])
+    if limit <= app.config['SEARCH_API_STREAM_LIMIT']:
+        return jsonify({'query': query, 'results': [result.to_json() for result in results], 'next': next_cursor})
+
+    # One result per line, sent as soon as its chunk is loaded, the last line holds the cursor of the next page
+    def lines():
+        for result in results:
+            yield json.dumps(result.to_json()) + '\n'
+        yield json.dumps({'next': next_cursor}) + '\n'
+    return Response(stream_with_context(streamed(lines())), mimetype='application/x-ndjson')
+
+@app.route('/search/cache', methods=['GET'])
+def search_cache():
+    return jsonify(get_result_cache().stats())
+
+from app.suggest import suggest_query
+
+@app.route('/suggest', methods=['GET'])
+def suggest():
+    query = request.args.get('q', '')
+    return jsonify({'query': query, 'suggestions': suggest_query(query)})
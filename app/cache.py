@@ -0,0 +1,139 @@
+from __future__ import annotations
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Optional
+from flask import current_app
+
+"""Cache of the search results shared by all the threads of a worker"""
+
+class CacheEntry:
+    __slots__ = ('value', 'expires', 'nbytes')
+
+    def __init__(self, value: Any, expires: float, nbytes: int) -> None:
+        self.value = value
+        self.expires = expires
+        self.nbytes = nbytes
+
+def estimate_size(value: Any) -> int:
+    """Approximates the memory held by a cached value, following lists, tuples, dicts and plain objects"""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + estimate_size(value.__dict__)
+    return sys.getsizeof(value)
+
+class ResultCache:
+    """LRU cache with time to live and memory cap, emptied whenever the index generation changes"""
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self.nbytes = 0
+        self.generation: Optional[int] = None
+        # Computations in progress, concurrent misses on the same key wait for the first one
+        self.pending: dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key)
+        self.nbytes -= entry.nbytes
+
+    def store(self, generation: int, key: Hashable, value: Any) -> None:
+        nbytes = estimate_size(value)
+        with self.lock:
+            # The index changed while computing, the value is already stale
+            if generation != self.generation or nbytes > self.max_bytes:
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = CacheEntry(value, time.monotonic() + self.ttl, nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, generation: int, key: Hashable, compute: Callable[[], Any]) -> tuple[Any, bool]:
+        """Returns the cached value of the key, computing it on a miss, and whether it was a hit"""
+        with self.lock:
+            if generation != self.generation:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+                self.nbytes = 0
+                self.generation = generation
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.value, True
+                self.remove(key)
+                self.expirations += 1
+
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.pending[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            # Another request is already computing the same results
+            return future.result(), True
+
+        try:
+            value = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            self.store(generation, key, value)
+            return value, False
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'generation': self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+_cache: Optional[ResultCache] = None
+_cache_lock = threading.Lock()
+
+def get_result_cache() -> ResultCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache(\
+                    current_app.config['RESULT_CACHE_ENTRIES'],\
+                    current_app.config['RESULT_CACHE_TTL'],\
+                    current_app.config['RESULT_CACHE_BYTES']\
+                )
+    return _cache
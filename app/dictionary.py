@@ -0,0 +1,176 @@
+from __future__ import annotations
+import sys
+import threading
+from bisect import bisect_right
+from array import array
+from typing import Iterator, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app import db
+from app.models import TitleTerm, BodyTerm
+from app.index import get_generation
+
+"""Compact sorted term dictionaries kept by every worker to resolve words without querying the term tables"""
+
+# Number of words per front coded block, only the first word of a block is stored whole
+BLOCK_SIZE = 16
+
+def read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    """Returns the varint starting at offset and the offset following it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+def write_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+class FrontCodedDictionary:
+    """Words sorted by their utf-8 bytes, front coded by blocks, with the term id and df of every word
+
+    A word is identified by its rank in the sorted order. Lookups bisect the first words of the blocks, the only
+    ones kept as objects, and decode a single block.
+    """
+    def __init__(self, words: list[bytes], term_ids: array, dfs: array) -> None:
+        self.count = len(words)
+        self.term_ids = term_ids
+        self.dfs = dfs
+        self.block_offsets = array('I')
+        self.heads: list[bytes] = []
+        data = bytearray()
+        for i, word in enumerate(words):
+            if i % BLOCK_SIZE == 0:
+                self.block_offsets.append(len(data))
+                self.heads.append(word)
+                write_varint(data, len(word))
+                data += word
+            else:
+                # Every other word only stores what differs from the previous one
+                previous = words[i-1]
+                shared = 0
+                limit = min(len(word), len(previous))
+                while shared < limit and word[shared] == previous[shared]:
+                    shared += 1
+                write_varint(data, shared)
+                write_varint(data, len(word) - shared)
+                data += word[shared:]
+        self.data = bytes(data)
+
+    @classmethod
+    def load(cls, db: Session, term_model) -> FrontCodedDictionary:
+        rows = sorted(\
+            ((word.encode('utf-8'), term_id, df) for word, term_id, df in db.execute(select(term_model.word, term_model.id, term_model.df))),\
+            key=lambda row: row[0]\
+        )
+        return cls([row[0] for row in rows], array('q', (row[1] for row in rows)), array('q', (row[2] for row in rows)))
+
+    def block_words(self, block: int) -> Iterator[bytes]:
+        offset = self.block_offsets[block]
+        end = self.block_offsets[block + 1] if block + 1 < len(self.block_offsets) else len(self.data)
+        length, offset = read_varint(self.data, offset)
+        word = self.data[offset:offset + length]
+        offset += length
+        yield word
+        while offset < end:
+            shared, offset = read_varint(self.data, offset)
+            length, offset = read_varint(self.data, offset)
+            word = word[:shared] + self.data[offset:offset + length]
+            offset += length
+            yield word
+
+    def lower_bound(self, key: bytes) -> int:
+        """Returns the rank of the first word not lower than key"""
+        # Last block whose first word is not greater than the key, the key can only be inside it or right after it
+        block = bisect_right(self.heads, key) - 1
+        if block < 0:
+            return 0
+        for i, word in enumerate(self.block_words(block)):
+            if word >= key:
+                return block*BLOCK_SIZE + i
+        return min((block + 1)*BLOCK_SIZE, self.count)
+
+    def find(self, word: str) -> Optional[int]:
+        key = word.encode('utf-8')
+        block = bisect_right(self.heads, key) - 1
+        if block < 0:
+            return None
+        for i, candidate in enumerate(self.block_words(block)):
+            if candidate >= key:
+                return block*BLOCK_SIZE + i if candidate == key else None
+        return None
+
+    def get(self, word: str) -> Optional[tuple[int, int]]:
+        """Returns the term id and the document frequency of the word"""
+        rank = self.find(word)
+        if rank is None:
+            return None
+        return self.term_ids[rank], self.dfs[rank]
+
+    def prefix_range(self, prefix: str) -> range:
+        """Returns the ranks of the words starting with the prefix"""
+        key = prefix.encode('utf-8')
+        start = self.lower_bound(key)
+        # Words starting with the prefix sort before the prefix followed by the highest byte
+        end = self.lower_bound(key + b'\xff') if len(key) > 0 else self.count
+        return range(start, end)
+
+    def word(self, rank: int) -> bytes:
+        block, i = divmod(rank, BLOCK_SIZE)
+        for j, word in enumerate(self.block_words(block)):
+            if j == i:
+                return word
+        raise IndexError(rank)
+
+    def words(self, ranks: range) -> Iterator[str]:
+        """Decodes the words of a range of ranks, block by block"""
+        if len(ranks) == 0:
+            return
+        for block in range(ranks.start // BLOCK_SIZE, (ranks.stop - 1) // BLOCK_SIZE + 1):
+            for i, word in enumerate(self.block_words(block), block*BLOCK_SIZE):
+                if ranks.start <= i < ranks.stop:
+                    yield word.decode('utf-8')
+
+    def __len__(self) -> int:
+        return self.count
+
+    def nbytes(self) -> int:
+        return len(self.data) + self.block_offsets.itemsize*len(self.block_offsets)\
+            + sys.getsizeof(self.heads) + sum(sys.getsizeof(head) for head in self.heads)\
+            + self.term_ids.itemsize*len(self.term_ids) + self.dfs.itemsize*len(self.dfs)
+
+class TermDictionaries:
+    def __init__(self, generation: int, title: FrontCodedDictionary, body: FrontCodedDictionary) -> None:
+        self.generation = generation
+        self.title = title
+        self.body = body
+
+    @classmethod
+    def load(cls, db: Session, generation: int) -> TermDictionaries:
+        return cls(generation, FrontCodedDictionary.load(db, TitleTerm), FrontCodedDictionary.load(db, BodyTerm))
+
+# The dictionaries are loaded once per worker process and reloaded when the index generation changes
+_dictionaries: Optional[TermDictionaries] = None
+_dictionaries_lock = threading.Lock()
+
+def get_dictionaries() -> TermDictionaries:
+    global _dictionaries
+    generation = get_generation()
+    if _dictionaries is not None and _dictionaries.generation == generation:
+        return _dictionaries
+
+    # Only one thread reloads, the others keep using the previous dictionaries until they are swapped
+    if _dictionaries_lock.acquire(blocking=_dictionaries is None):
+        try:
+            if _dictionaries is None or _dictionaries.generation != generation:
+                _dictionaries = TermDictionaries.load(db.session, generation)
+        finally:
+            _dictionaries_lock.release()
+    return _dictionaries
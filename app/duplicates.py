@@ -0,0 +1,44 @@
+from __future__ import annotations
+from hashlib import blake2b
+from typing import Optional
+import numpy as np
+
+"""MinHash signatures of the pages, so that mirrored and templated copies of an indexed page are not indexed again"""
+
+# Number of consecutive body tokens hashed together, a single changed word changes this many shingles
+SHINGLE_SIZE = 3
+# Minimums kept in a signature, split into bands looked up as a whole: two pages are compared when one of their
+# bands is equal, which is likely above a similarity of (1/BANDS)**(1/ROWS), about 0.77
+PERMUTATIONS = 64
+BANDS = 8
+ROWS = PERMUTATIONS//BANDS
+
+def seeds(name: bytes) -> np.ndarray:
+    # Derived from a hash rather than a random generator so that the signatures never change
+    return np.array([int.from_bytes(blake2b(name + i.to_bytes(2, 'little'), digest_size=8).digest(), 'little') for i in range(PERMUTATIONS)], dtype=np.uint64)
+
+# Multiply-shift hash functions standing for the permutations of the shingles, the multipliers are odd
+MULTIPLIERS = seeds(b'multiplier') | np.uint64(1)
+INCREMENTS = seeds(b'increment')
+
+def minhash(tokens: list[str], shingle_size: int = SHINGLE_SIZE) -> Optional[bytes]:
+    """Returns the MinHash signature of the shingles of the tokens, None if there is no shingle
+
+    The share of equal values in the signatures of two pages estimates the Jaccard similarity of their shingles.
+    """
+    if len(tokens) < shingle_size:
+        return None
+    shingles = {' '.join(tokens[i:i+shingle_size]) for i in range(len(tokens) - shingle_size + 1)}
+    hashes = np.frombuffer(b''.join(blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles), dtype='<u8').astype(np.uint64)
+    # The products wrap around, the high bits of every hash are the well mixed ones
+    permuted = (hashes[:, np.newaxis]*MULTIPLIERS + INCREMENTS) >> np.uint64(32)
+    return permuted.min(axis=0).astype('<u4').tobytes()
+
+def similarity(a: bytes, b: bytes) -> float:
+    """Estimated Jaccard similarity of the shingles of two pages from their signatures"""
+    return float(np.mean(np.frombuffer(a, dtype='<u4') == np.frombuffer(b, dtype='<u4')))
+
+def band_keys(signature: bytes) -> list[int]:
+    """Returns the lookup key of every band of the signature, the pages with a key in common are compared"""
+    band_size = 4*ROWS
+    return [(band << 56) | int.from_bytes(blake2b(signature[band*band_size:(band + 1)*band_size], digest_size=7).digest(), 'little') for band in range(BANDS)]
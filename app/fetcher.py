@@ -0,0 +1,119 @@
+from __future__ import annotations
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+"""Concurrent page downloads for the spider"""
+
+# Statuses worth retrying, the server may answer later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class FetchResult:
+    def __init__(self, url: str, status: int, text: str = '', headers: Optional[CaseInsensitiveDict] = None, error: Optional[str] = None) -> None:
+        self.url = url
+        self.status = status
+        self.text = text
+        self.headers = headers if headers is not None else CaseInsensitiveDict()
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+class HostLimiter:
+    """Caps the concurrent requests to one host and spaces them by the politeness delay"""
+    def __init__(self, concurrency: int, delay: float) -> None:
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_request = 0.0
+
+    def __enter__(self) -> HostLimiter:
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.delay
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.slots.release()
+
+class Fetcher:
+    """Downloads pages from a pool of threads, each with its own keep-alive session"""
+    def __init__(self, concurrency: int = 8, per_host: int = 2, delay: float = 0.0, timeout: float = 10.0, retries: int = 3, backoff: float = 0.5) -> None:
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.delay = delay
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fetcher')
+        self.local = threading.local()
+        self.sessions: list[requests.Session] = []
+        self.hosts: dict[str, HostLimiter] = {}
+        self.lock = threading.Lock()
+
+    def session(self) -> requests.Session:
+        # Sessions are not shared between threads, each one pools the connections of its thread
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.per_host, pool_maxsize=self.per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return self.local.session
+
+    def host(self, url: str) -> HostLimiter:
+        netloc = urlsplit(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = HostLimiter(self.per_host, self.delay)
+            return self.hosts[netloc]
+
+    def fetch(self, url: str, headers: Optional[dict] = None) -> FetchResult:
+        """Downloads a page, retrying with exponential backoff on network errors and transient statuses"""
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff*2**(attempt - 1))
+            try:
+                with self.host(url):
+                    response = self.session().get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+                continue
+            except requests.RequestException as e:
+                # Malformed urls and unsupported schemes fail the same way every time
+                return FetchResult(url, 0, error=str(e))
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                continue
+            return FetchResult(url, response.status_code, response.text, response.headers)
+        return FetchResult(url, 0, error=error)
+
+    def submit(self, url: str, headers: Optional[dict] = None) -> Future:
+        return self.executor.submit(self.fetch, url, headers)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        for session in self.sessions:
+            session.close()
+
+    def __enter__(self) -> Fetcher:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
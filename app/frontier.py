@@ -0,0 +1,269 @@
+from __future__ import annotations
+import datetime
+import time
+import zlib
+from collections import deque
+from typing import Optional
+from urllib.parse import urlsplit
+from sqlalchemy import Row, Select, and_, bindparam, delete, func, insert, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from app.models import Document, FrontierUrl, FrontierLink, document_to_document
+from app.writer import chunks
+
+"""Crawl frontier kept in the database so that an interrupted crawl is resumed where it stopped"""
+
+# States of the urls of the frontier
+QUEUED = 'queued'
+FETCHING = 'fetching'
+DONE = 'done'
+FAILED = 'failed'
+
+def host_hash(url: str) -> int:
+    """Returns a stable hash of the host of the url, the fetcher enforces its politeness per host as well"""
+    return zlib.crc32(urlsplit(url).netloc.encode('utf-8')) & 0x7fffffff
+
+def entries() -> Select:
+    """Frontier urls as (id, url, priority, doc_id, last_modified, etag) rows, with the validators of the stored pages"""
+    return select(FrontierUrl.id, FrontierUrl.url, FrontierUrl.priority, Document.id.label('doc_id'), Document.last_modified, Document.etag)\
+        .outerjoin(Document, Document.url == FrontierUrl.url)\
+        .order_by(FrontierUrl.priority.asc(), FrontierUrl.id.asc())
+
+class Frontier:
+    """Urls to crawl by priority, only the next batch of them and the changes not written yet are held in memory
+
+    The changes are written in the transaction of the index writer and committed at the same checkpoints, so a page
+    is done in the frontier exactly when its rows are committed.
+    """
+    # Whether other crawler workers share the frontier
+    shared = False
+
+    def __init__(self, db: Session, batch_size: int = 1000, max_retries: int = 3) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        # Next urls to crawl, with the validators of the ones stored by a previous crawl
+        self.batch: deque[Row] = deque()
+        # Urls discovered since the last write with their lowest priority
+        self.discovered: dict[str, int] = {}
+        # States changed since the last write by url id
+        self.states: dict[int, str] = {}
+        # The last refill found no queued url, there is no point in reading the table again until urls are discovered
+        self.exhausted = False
+
+    def unfinished(self) -> bool:
+        """Whether the previous crawl was stopped before its end"""
+        return self.db.scalar(select(FrontierUrl.id).where(FrontierUrl.state.in_((QUEUED, FETCHING))).limit(1)) is not None
+
+    def reset(self, url: str) -> None:
+        """Forgets the previous crawl and queues the start page of a new one"""
+        self.db.execute(delete(FrontierLink.__table__))
+        self.db.execute(delete(FrontierUrl.__table__))
+        self.discover(url, 0)
+
+    def resume(self) -> int:
+        """Queues again the pages that were being fetched when the crawl stopped, returns the number of queued pages
+
+        A page is given up once it was being fetched in max_retries stopped crawls, it may be the reason they stopped.
+        """
+        table = FrontierUrl.__table__
+        fetching = table.c.state == FETCHING
+        self.db.execute(update(table).where(fetching, table.c.retries + 1 >= self.max_retries).values(state=FAILED, retries=table.c.retries + 1))
+        self.db.execute(update(table).where(fetching).values(state=QUEUED, retries=table.c.retries + 1))
+        return self.db.scalar(select(func.count()).select_from(table).where(table.c.state == QUEUED))
+
+    def discover(self, url: str, priority: int) -> None:
+        """Queues the url unless it was already discovered in this crawl"""
+        if url not in self.discovered or priority < self.discovered[url]:
+            self.discovered[url] = priority
+        self.exhausted = False
+        if len(self.discovered) >= self.batch_size:
+            self.write_discovered()
+
+    def pop(self) -> Optional[Row]:
+        """Returns the next url to fetch as an (id, url, priority, doc_id, last_modified, etag) row, None if there is none"""
+        if len(self.batch) == 0 and not self.exhausted:
+            self.refill()
+        if len(self.batch) == 0:
+            return None
+        entry = self.batch.popleft()
+        self.start(entry)
+        return entry
+
+    def start(self, entry: Row) -> None:
+        self.states[entry.id] = FETCHING
+
+    def finish(self, entry: Row, state: str) -> None:
+        self.states[entry.id] = state
+
+    def refill(self) -> None:
+        # The urls handed out before are written as being fetched so they are not read again
+        self.write()
+        self.batch.extend(self.db.execute(entries().where(FrontierUrl.state == QUEUED).limit(self.batch_size)))
+        self.exhausted = len(self.batch) == 0
+
+    def write_discovered(self) -> None:
+        urls = list(self.discovered)
+        known = set()
+        for batch in chunks(urls):
+            known.update(self.db.scalars(select(FrontierUrl.url).where(FrontierUrl.url.in_(batch))))
+        new = [{'url': url, 'state': QUEUED, 'priority': self.discovered[url], 'retries': 0, 'host_hash': host_hash(url)} for url in urls if url not in known]
+        if len(new) > 0:
+            self.db.execute(insert(FrontierUrl.__table__), new)
+        self.discovered.clear()
+
+    def write(self) -> None:
+        """Writes the discovered urls and the changed states, they are committed with the next checkpoint"""
+        if len(self.discovered) > 0:
+            self.write_discovered()
+        if len(self.states) > 0:
+            table = FrontierUrl.__table__
+            self.db.execute(\
+                update(table)\
+                .where(table.c.id == bindparam('url_id'))\
+                .values(state=bindparam('new_state')),\
+                [{'url_id': url_id, 'new_state': state} for url_id, state in self.states.items()]\
+            )
+            self.states.clear()
+
+    def close(self) -> None:
+        """Ends the crawl, the links waiting for pages that were never indexed are dropped"""
+        self.write()
+        self.db.execute(delete(FrontierLink.__table__))
+
+class SharedFrontier(Frontier):
+    """Frontier shared by several crawler workers, each one crawls the hosts of its shard of the host hashes
+
+    A worker leases a batch of urls with SELECT ... FOR UPDATE SKIP LOCKED in a short transaction of its own, committed
+    at once so the others skip them. The leases of the urls a worker holds are renewed until their pages are committed,
+    when a worker stops they expire and the urls are claimed again. The urls
+    discovered are inserted right away in the same way, and the states are written by the checkpoints just before
+    they commit, so the workers never wait on each other for long. Needs PostgreSQL.
+    """
+    shared = True
+
+    def __init__(self, db: Session, shard: int, shards: int, batch_size: int = 1000, max_retries: int = 3, lease_seconds: float = 600.0, poll_interval: float = 1.0) -> None:
+        super().__init__(db, batch_size, max_retries)
+        self.shard = shard
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.engine = db.get_bind()
+        self.next_claim = 0.0
+        # Ids of the urls leased by this worker whose state is not written yet, and when their leases are renewed
+        self.leased: set[int] = set()
+        self.next_renewal = 0.0
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    def pop(self) -> Optional[Row]:
+        if len(self.leased) > 0 and time.monotonic() >= self.next_renewal:
+            self.renew()
+        # The other workers discover urls of this shard as well, they are looked for again after the poll interval
+        if self.exhausted and time.monotonic() >= self.next_claim:
+            self.exhausted = False
+        return super().pop()
+
+    def renew(self) -> None:
+        """Extends the leases of the urls held by this worker, the urls whose lease already expired are not fetched"""
+        table = FrontierUrl.__table__
+        now = self.now()
+        renewed = set()
+        with self.engine.begin() as connection:
+            for batch in chunks(sorted(self.leased)):
+                renewed.update(connection.scalars(\
+                    update(table)\
+                    .where(table.c.id.in_(batch), table.c.state == FETCHING, table.c.lease_expires >= now)\
+                    .values(lease_expires=now + datetime.timedelta(seconds=self.lease_seconds))\
+                    .returning(table.c.id)\
+                ))
+        # Another worker may have claimed them, the pages already being fetched are left to the index writer
+        lost = self.leased - renewed
+        if len(lost) > 0:
+            self.batch = deque(entry for entry in self.batch if entry.id not in lost)
+            self.leased = renewed
+        self.next_renewal = time.monotonic() + self.lease_seconds/4
+
+    def start(self, entry: Row) -> None:
+        # The url is already leased
+        pass
+
+    def refill(self) -> None:
+        # The states are only written by the checkpoints, right before they are committed: a url updated by a
+        # transaction still open would hold back the workers inserting it as discovered
+        if len(self.discovered) > 0:
+            self.write_discovered()
+        table = FrontierUrl.__table__
+        now = self.now()
+        with self.engine.begin() as connection:
+            rows = connection.execute(\
+                select(table.c.id, table.c.state, table.c.retries)\
+                .where(\
+                    or_(table.c.state == QUEUED, and_(table.c.state == FETCHING, table.c.lease_expires < now)),\
+                    table.c.host_hash % self.shards == self.shard,\
+                )\
+                .order_by(table.c.priority.asc(), table.c.id.asc())\
+                .limit(self.batch_size)\
+                .with_for_update(skip_locked=True)\
+            ).all()
+            # The lease of a page expires when its worker stopped, the page is given up after max_retries of them
+            expired = [row for row in rows if row.state == FETCHING]
+            given_up = [row.id for row in expired if row.retries + 1 >= self.max_retries]
+            if len(expired) > 0:
+                connection.execute(update(table).where(table.c.id.in_([row.id for row in expired])).values(retries=table.c.retries + 1))
+            if len(given_up) > 0:
+                connection.execute(update(table).where(table.c.id.in_(given_up)).values(state=FAILED, lease_expires=None))
+            claimed = [row.id for row in rows if row.id not in set(given_up)]
+            if len(claimed) > 0:
+                connection.execute(\
+                    update(table)\
+                    .where(table.c.id.in_(claimed))\
+                    .values(state=FETCHING, lease_expires=now + datetime.timedelta(seconds=self.lease_seconds))\
+                )
+                self.batch.extend(connection.execute(entries().where(FrontierUrl.id.in_(claimed))))
+        if len(self.leased) == 0:
+            self.next_renewal = time.monotonic() + self.lease_seconds/4
+        self.leased.update(claimed)
+        self.exhausted = len(self.batch) == 0
+        if self.exhausted:
+            self.next_claim = time.monotonic() + self.poll_interval
+
+    def write(self) -> None:
+        # The leases of the pages are renewed until the checkpoint writing them as done commits
+        if len(self.leased) > 0:
+            self.renew()
+        self.leased.difference_update(url_id for url_id, state in self.states.items() if state != FETCHING)
+        super().write()
+
+    def write_discovered(self) -> None:
+        # Sorted so that two workers inserting the same urls lock them in the same order
+        rows = [{'url': url, 'state': QUEUED, 'priority': self.discovered[url], 'retries': 0, 'host_hash': host_hash(url)} for url in sorted(self.discovered)]
+        with self.engine.begin() as connection:
+            for batch in chunks(rows):
+                connection.execute(pg_insert(FrontierUrl.__table__).values(batch).on_conflict_do_nothing(index_elements=['url']))
+        self.discovered.clear()
+
+    def finished(self) -> bool:
+        """Whether every url of every shard is done or failed, the changes of this worker have to be committed first"""
+        return not self.unfinished()
+
+    def close(self) -> None:
+        """Ends the crawl once every worker is done
+
+        A link waits in the frontier link table when its page was indexed by another worker that had not committed it
+        yet, these links are written now and the ones to pages that were never indexed are dropped.
+        """
+        self.write()
+        link = FrontierLink.__table__
+        # The workers ending at the same time take turns
+        pending = self.db.execute(select(link.c.id, link.c.url, link.c.parent_id).with_for_update()).all()
+        doc_ids = {}
+        for batch in chunks(sorted({row.url for row in pending})):
+            for doc_id, url in self.db.execute(select(Document.id, Document.url).where(Document.url.in_(batch))):
+                doc_ids[url] = doc_id
+        links = [{'left_id': doc_ids[row.url], 'right_id': row.parent_id} for row in pending if row.url in doc_ids]
+        if len(links) > 0:
+            self.db.execute(insert(document_to_document), links)
+        for batch in chunks([row.id for row in pending]):
+            self.db.execute(delete(link).where(link.c.id.in_(batch)))
@@ -0,0 +1,393 @@
+from __future__ import annotations
+import datetime
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Iterable, Iterator, Optional
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from app import db
+from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList, IndexMetadata
+from app.metrics import record_shards, stage
+from app.scoring import K1, K2, FieldStatistics, PhrasePostings, StaticScore, block_upper_bounds, merge_rankings, rank
+
+"""In-memory inverted index answering search queries without any SQL round trip"""
+
+def encode_varints(values: Iterable[int]) -> bytes:
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+def decode_varints(data: bytes) -> array:
+    values = array('q')
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+def delta_encode(values: Iterable[int]) -> bytes:
+    # Sorted values are stored as the gaps between them which keeps the varints short
+    previous = 0
+    gaps = []
+    for value in values:
+        gaps.append(value - previous)
+        previous = value
+    return encode_varints(gaps)
+
+def delta_decode(data: bytes) -> array:
+    values = decode_varints(data)
+    total = 0
+    for i, gap in enumerate(values):
+        total += gap
+        values[i] = total
+    return values
+
+class PostingList:
+    """Compressed postings of a single term: doc ids, term frequencies and positions"""
+    __slots__ = ('df', 'doc_data', 'tf_data', 'position_data', 'position_offsets', 'block_max')
+
+    def __init__(self, df: int, doc_ids: list[int], tfs: list[int], positions: list[bytes]) -> None:
+        self.df = df
+        self.doc_data = delta_encode(doc_ids)
+        self.tf_data = encode_varints(tfs)
+
+        # The positions of every document are delta encoded separately so they can be decoded on their own,
+        # as they are in the posting tables
+        self.position_offsets = array('I')
+        position_data = bytearray()
+        for doc_positions in positions:
+            self.position_offsets.append(len(position_data))
+            position_data += doc_positions
+        self.position_offsets.append(len(position_data))
+        self.position_data = bytes(position_data)
+
+        # Highest BM25 score of every block of postings, set once the collection statistics are known
+        self.block_max = array('d')
+
+    def doc_ids(self) -> array:
+        return delta_decode(self.doc_data)
+
+    def tfs(self) -> array:
+        return decode_varints(self.tf_data)
+
+    def positions(self, i: int) -> array:
+        return delta_decode(self.position_data[self.position_offsets[i]:self.position_offsets[i+1]])
+
+    def nbytes(self) -> int:
+        return len(self.doc_data) + len(self.tf_data) + len(self.position_data) + self.position_offsets.itemsize*len(self.position_offsets)\
+            + self.block_max.itemsize*len(self.block_max)
+
+def gallop(values: array, target: int, lo: int = 0) -> int:
+    """Returns the first index from lo whose value is not lower than target"""
+    # Exponential search for an upper bound followed by a binary search inside it
+    hi = lo
+    step = 1
+    while hi < len(values) and values[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(values, target, lo, min(hi, len(values)))
+
+def intersect(lists: list[array]) -> list[tuple[int, ...]]:
+    """Returns, for every value shared by all the sorted lists, its index in each of them"""
+    if len(lists) == 0:
+        return []
+    # The shortest list drives the intersection, the others are searched by galloping
+    order = sorted(range(len(lists)), key=lambda i: len(lists[i]))
+    cursors = [0]*len(lists)
+    matches = []
+    for driver_index, value in enumerate(lists[order[0]]):
+        cursors[order[0]] = driver_index
+        for i in order[1:]:
+            cursors[i] = gallop(lists[i], value, cursors[i])
+            if cursors[i] == len(lists[i]):
+                return matches
+            if lists[i][cursors[i]] != value:
+                break
+        else:
+            matches.append(tuple(cursors))
+    return matches
+
+def count_phrase(positions: list[array]) -> int:
+    """Returns the number of times the terms appear at consecutive positions"""
+    # A phrase starts at p when the i-th term of the phrase is found at p+i
+    driver = min(range(len(positions)), key=lambda i: len(positions[i]))
+    cursors = [0]*len(positions)
+    count = 0
+    for position in positions[driver]:
+        start = position - driver
+        for i, term_positions in enumerate(positions):
+            if i == driver:
+                continue
+            cursors[i] = gallop(term_positions, start + i, cursors[i])
+            if cursors[i] == len(term_positions):
+                return count
+            if term_positions[cursors[i]] != start + i:
+                break
+        else:
+            count += 1
+    return count
+
+def iter_posting_rows(db: Session, term_model, posting_model) -> Iterator[tuple[str, int, list]]:
+    """Streams the word, df and posting rows sorted by doc id of every term of a field by increasing term id"""
+    postings = db.execute(\
+        select(posting_model.term_id, term_model.word, term_model.df, posting_model.doc_id, posting_model.tf, posting_model.positions)\
+        .join(term_model, posting_model.term)\
+        .order_by(posting_model.term_id.asc(), posting_model.doc_id.asc())\
+        .execution_options(yield_per=10000)\
+    )
+    for term_id, rows in groupby(postings, key=lambda row: row.term_id):
+        rows = list(rows)
+        yield rows[0].word, rows[0].df, rows
+
+def make_posting_list(df: int, rows: list) -> PostingList:
+    return PostingList(df, [row.doc_id for row in rows], [row.tf for row in rows], [row.positions for row in rows])
+
+def iter_posting_lists(db: Session, term_model, posting_model) -> Iterator[tuple[str, PostingList]]:
+    """Streams the posting list of every term of a field by increasing term id"""
+    for word, df, rows in iter_posting_rows(db, term_model, posting_model):
+        yield word, make_posting_list(df, rows)
+
+class FieldIndex:
+    """Term dictionary and posting lists of one field (title or body)"""
+    def __init__(self, statistics: FieldStatistics) -> None:
+        self.statistics = statistics
+        self.terms: dict[str, PostingList] = {}
+
+    def load(self, db: Session, term_model, posting_model) -> None:
+        for word, posting_list in iter_posting_lists(db, term_model, posting_model):
+            self.terms[word] = posting_list
+
+    def compute_bounds(self, N: int) -> None:
+        for posting_list in self.terms.values():
+            posting_list.block_max = block_upper_bounds(posting_list.doc_ids(), posting_list.tfs(), N, posting_list.df, self.statistics)
+
+    def phrase_postings(self, phrase: list[str]) -> PhrasePostings:
+        """Returns the documents containing the phrase along with the number of occurrences in each"""
+        lists = [self.terms.get(token) for token in phrase]
+        if len(lists) == 0 or None in lists:
+            return PhrasePostings(array('q'), array('q'), self.statistics)
+        if len(lists) == 1:
+            return PhrasePostings(lists[0].doc_ids(), lists[0].tfs(), self.statistics, lists[0].df, lists[0].block_max)
+
+        # Documents containing every term of the phrase, then check the positions
+        doc_ids = array('q')
+        ftds = array('q')
+        candidates = [posting_list.doc_ids() for posting_list in lists]
+        for indices in intersect(candidates):
+            ftd = count_phrase([posting_list.positions(i) for posting_list, i in zip(lists, indices)])
+            if ftd > 0:
+                doc_ids.append(candidates[0][indices[0]])
+                ftds.append(ftd)
+        return PhrasePostings(doc_ids, ftds, self.statistics)
+
+    def nbytes(self) -> int:
+        return sum(posting_list.nbytes() for posting_list in self.terms.values())
+
+class InvertedIndex:
+    def __init__(self, generation: int, N: int = 0, title_lavg: float = 0.0, body_lavg: float = 0.0) -> None:
+        self.generation = generation
+        self.N = N
+        # Document sizes are stored in arrays indexed by doc id
+        self.title_sizes = array('I')
+        self.body_sizes = array('I')
+        self.pagerank = array('d')
+        self.max_pagerank = 0.0
+        self.title = FieldIndex(FieldStatistics(K1, title_lavg, self.title_sizes))
+        self.body = FieldIndex(FieldStatistics(K2, body_lavg, self.body_sizes))
+
+    @classmethod
+    def build(cls, db: Session, generation: int) -> InvertedIndex:
+        metadata = get_metadata(db)
+        index = cls(generation, metadata.document_count, metadata.average_title_size, metadata.average_body_size)
+        index.load_documents(db)
+        index.title.load(db, TitleTerm, TitlePostingList)
+        index.body.load(db, BodyTerm, BodyPostingList)
+        if index.N > 0:
+            index.title.compute_bounds(index.N)
+            index.body.compute_bounds(index.N)
+        return index
+
+    def load_documents(self, db: Session) -> None:
+        max_id = db.scalar(select(func.max(Document.id))) or 0
+        self.title_sizes.frombytes(bytes(4*(max_id+1)))
+        self.body_sizes.frombytes(bytes(4*(max_id+1)))
+        self.pagerank.frombytes(bytes(8*(max_id+1)))
+        for doc_id, title_size, body_size, pagerank in db.execute(select(Document.id, Document.title_size, Document.size, Document.pagerank)):
+            self.title_sizes[doc_id] = title_size
+            self.body_sizes[doc_id] = body_size
+            self.pagerank[doc_id] = pagerank or 0.0
+        self.max_pagerank = max(self.pagerank, default=0.0)
+
+    def search(self, phrases: list[list[str]], top: int, pruning: bool = True, stats: Optional[dict] = None, static_weight: float = 0.0, vectorized: bool = False, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+        """Returns the (score, doc id) pairs of the top documents by decreasing score, ranked after the given one"""
+        postings = []
+        with stage('candidates'):
+            for phrase in phrases:
+                postings.append(self.title.phrase_postings(phrase))
+                postings.append(self.body.phrase_postings(phrase))
+        with stage('score'):
+            static = StaticScore(static_weight, self.pagerank, self.max_pagerank) if static_weight > 0 else None
+            return rank(postings, self.N, top, pruning, stats, static, vectorized, after)
+
+    def nbytes(self) -> int:
+        return self.title.nbytes() + self.body.nbytes() + self.title_sizes.itemsize*len(self.title_sizes) + self.body_sizes.itemsize*len(self.body_sizes) + self.pagerank.itemsize*len(self.pagerank)
+
+class IndexShard:
+    """Postings of the documents of one range of doc ids, the statistics of the fields are those of the whole collection"""
+    def __init__(self, title: FieldStatistics, body: FieldStatistics) -> None:
+        self.title = FieldIndex(title)
+        self.body = FieldIndex(body)
+
+    def phrase_postings(self, phrases: list[list[str]]) -> list[PhrasePostings]:
+        postings = []
+        for phrase in phrases:
+            postings.append(self.title.phrase_postings(phrase))
+            postings.append(self.body.phrase_postings(phrase))
+        return postings
+
+def load_shards(db: Session, fields: list[FieldIndex], term_model, posting_model, bounds: list[int]) -> None:
+    """Splits the posting list of every term between the fields of the shards, each one keeps the df of the collection"""
+    for word, df, rows in iter_posting_rows(db, term_model, posting_model):
+        for shard, shard_rows in groupby(rows, key=lambda row: bisect_right(bounds, row.doc_id)):
+            fields[shard].terms[word] = make_posting_list(df, list(shard_rows))
+
+def timed(function, *args) -> tuple:
+    """Calls the function and returns its result along with the seconds it took"""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+class ShardedIndex(InvertedIndex):
+    """In-memory index partitioned by ranges of doc ids, the shards of a query are searched by a pool of threads
+
+    Every shard is scored with the document count, average sizes and document frequencies of the whole collection,
+    so the scores and the merged top-k are those of the index that is not partitioned.
+    """
+    def __init__(self, generation: int, N: int = 0, title_lavg: float = 0.0, body_lavg: float = 0.0, bounds: Optional[list[int]] = None) -> None:
+        super().__init__(generation, N, title_lavg, body_lavg)
+        # First doc id of every shard but the first one
+        self.bounds = bounds or []
+        # The document sizes and PageRank are shared by the shards
+        self.shards = [IndexShard(self.title.statistics, self.body.statistics) for _ in range(len(self.bounds) + 1)]
+
+    @classmethod
+    def build(cls, db: Session, generation: int, shards: int = 1) -> ShardedIndex:
+        metadata = get_metadata(db)
+        # The ranges hold the same number of indexed documents
+        doc_ids = db.scalars(select(Document.id).where(Document.duplicate_of_id.is_(None)).order_by(Document.id.asc())).all()
+        bounds = [doc_ids[len(doc_ids)*i//shards] for i in range(1, shards)] if len(doc_ids) > 0 else []
+        index = cls(generation, metadata.document_count, metadata.average_title_size, metadata.average_body_size, bounds)
+        index.load_documents(db)
+        load_shards(db, [shard.title for shard in index.shards], TitleTerm, TitlePostingList, bounds)
+        load_shards(db, [shard.body for shard in index.shards], BodyTerm, BodyPostingList, bounds)
+        if index.N > 0:
+            for shard in index.shards:
+                shard.title.compute_bounds(index.N)
+                shard.body.compute_bounds(index.N)
+        return index
+
+    def search(self, phrases: list[list[str]], top: int, pruning: bool = True, stats: Optional[dict] = None, static_weight: float = 0.0, vectorized: bool = False, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+        executor = get_executor(len(self.shards))
+        with stage('candidates'):
+            candidates = list(executor.map(lambda shard: timed(shard.phrase_postings, phrases), self.shards))
+            # The documents containing a phrase are only counted once every shard found its own
+            for i, phrase in enumerate(phrases):
+                if len(phrase) > 1:
+                    for field in (2*i, 2*i + 1):
+                        df = sum(len(postings[field].doc_ids) for postings, _ in candidates)
+                        for postings, _ in candidates:
+                            postings[field].df = df
+        with stage('score'):
+            static = StaticScore(static_weight, self.pagerank, self.max_pagerank) if static_weight > 0 else None
+            shard_stats = [{} for _ in self.shards]
+            ranked = list(executor.map(\
+                lambda i: timed(rank, candidates[i][0], self.N, top, pruning, shard_stats[i], static, vectorized, after),\
+                range(len(self.shards))\
+            ))
+            if stats is not None:
+                for key in ('candidates', 'scored', 'skipped'):
+                    stats[key] = sum(shard[key] for shard in shard_stats)
+            record_shards([searched + scored for (_, searched), (_, scored) in zip(candidates, ranked)])
+            return merge_rankings([ranking for ranking, _ in ranked], top)
+
+    def nbytes(self) -> int:
+        return sum(shard.title.nbytes() + shard.body.nbytes() for shard in self.shards)\
+            + self.title_sizes.itemsize*len(self.title_sizes) + self.body_sizes.itemsize*len(self.body_sizes) + self.pagerank.itemsize*len(self.pagerank)
+
+# Threads searching the shards, shared by all the requests of the worker process
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_executor(workers: int) -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(workers, thread_name_prefix='shard')
+    return _executor
+
+def current_generation(db: Session) -> int:
+    return db.scalar(select(IndexMetadata.generation).where(IndexMetadata.id == 1)) or 0
+
+def get_metadata(db: Session) -> IndexMetadata:
+    """Returns the single row holding the index generation and the collection statistics"""
+    metadata = db.get(IndexMetadata, 1)
+    if metadata is None:
+        metadata = IndexMetadata(id=1, generation=0, document_count=0, body_size=0, title_size=0)
+        db.add(metadata)
+    return metadata
+
+def bump_generation(db: Session) -> int:
+    """Marks the index as changed so that every worker rebuilds its in-memory copy"""
+    metadata = get_metadata(db)
+    metadata.generation += 1
+    metadata.updated = datetime.datetime.now()
+    return metadata.generation
+
+# The generation is only read from the database every INDEX_REFRESH_INTERVAL seconds
+_generation = 0
+_checked_at: Optional[float] = None
+
+def get_generation() -> int:
+    """Returns the index generation last seen by this worker"""
+    global _generation, _checked_at
+    now = time.monotonic()
+    if _checked_at is None or now - _checked_at >= current_app.config['INDEX_REFRESH_INTERVAL']:
+        _generation = current_generation(db.session)
+        _checked_at = now
+    return _generation
+
+# The index is held per worker process and shared by all of its threads
+_index: Optional[InvertedIndex] = None
+_index_lock = threading.Lock()
+
+def get_index() -> InvertedIndex:
+    global _index
+    generation = get_generation()
+    if _index is not None and _index.generation == generation:
+        return _index
+
+    # Only one thread rebuilds, the others keep serving the previous index until it is swapped
+    if _index_lock.acquire(blocking=_index is None):
+        try:
+            if _index is None or _index.generation != generation:
+                shards = current_app.config['SEARCH_SHARDS']
+                _index = ShardedIndex.build(db.session, generation, shards) if shards > 1 else InvertedIndex.build(db.session, generation)
+        finally:
+            _index_lock.release()
+    return _index
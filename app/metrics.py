@@ -0,0 +1,242 @@
+from __future__ import annotations
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from flask import Response, current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""Instrumentation of the search requests
+
+Every search request gets a trace of the time spent in each stage of the query, the SQL statements it ran and
+the number of candidates scored. The trace is sent back in a Server-Timing header, aggregated in the histograms
+served in the Prometheus text format by /metrics and logged when the query is slow. The metrics are kept per
+worker process.
+"""
+
+# Stages of a query in the order they run, the time of a stage excludes the stages nested in it. The index stage
+# is the time taken by the worker to check the index generation and load a new index.
+STAGES = ('parse', 'index', 'lookup', 'candidates', 'score', 'hydrate')
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the buckets of the number of SQL statements of a request
+STATEMENT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+class QueryTrace:
+    """Where the time of one search request went"""
+    def __init__(self, query: str, stats: dict) -> None:
+        self.query = query
+        self.phrases: Optional[list[list[str]]] = None
+        # Filled by the ranking: candidates, scored, skipped and cache_hit
+        self.stats = stats
+        self.start = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        # Stages being timed, each with its start and the time spent in the stages nested in it
+        self.running: list[list] = []
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        # Time spent searching every shard of a sharded index, the shards run in parallel within the stages
+        self.shards: list[float] = []
+        # Streamed responses are recorded once their last line is sent
+        self.streaming = False
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        entry = [name, time.perf_counter(), 0.0]
+        self.running.append(entry)
+        try:
+            yield
+        finally:
+            self.running.pop()
+            elapsed = time.perf_counter() - entry[1]
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed - entry[2]
+            if self.running:
+                self.running[-1][2] += elapsed
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Returns the value of the Server-Timing header, the durations are in milliseconds"""
+        metrics = [f'{name};dur={1000*self.stages[name]:.3f}' for name in STAGES if name in self.stages]
+        metrics.extend(f'shard-{i};dur={1000*seconds:.3f}' for i, seconds in enumerate(self.shards))
+        metrics.append(f'sql;dur={1000*self.sql_seconds:.3f};desc="{self.sql_statements} statements"')
+        if 'candidates' in self.stats:
+            metrics.append(f'scored;desc="{self.stats["scored"]} of {self.stats["candidates"]} candidates"')
+        if 'cache_hit' in self.stats:
+            metrics.append(f'cache;desc="{"hit" if self.stats["cache_hit"] else "miss"}"')
+        metrics.append(f'total;dur={1000*self.elapsed():.3f}')
+        return ', '.join(metrics)
+
+    def breakdown(self) -> str:
+        parts = [f'{name} {1000*self.stages[name]:.1f} ms' for name in STAGES if name in self.stages]
+        if self.shards:
+            parts.append('shards ' + '/'.join(f'{1000*seconds:.1f}' for seconds in self.shards) + ' ms')
+        parts.append(f'sql {self.sql_statements} statements {1000*self.sql_seconds:.1f} ms')
+        if 'candidates' in self.stats:
+            parts.append(f'scored {self.stats["scored"]} of {self.stats["candidates"]} candidates')
+        if 'cache_hit' in self.stats:
+            parts.append('cache hit' if self.stats['cache_hit'] else 'cache miss')
+        return ', '.join(parts)
+
+def start_trace(query: str, stats: dict) -> Optional[QueryTrace]:
+    """Starts the trace of the search request being served, queries run outside of a request are not traced"""
+    if not has_request_context() or not current_app.config['SEARCH_METRICS']:
+        return None
+    g.trace = QueryTrace(query, stats)
+    return g.trace
+
+def get_trace() -> Optional[QueryTrace]:
+    return g.get('trace') if has_app_context() else None
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times a stage of the query being traced, if any"""
+    trace = get_trace()
+    if trace is None:
+        yield
+    else:
+        with trace.stage(name):
+            yield
+
+def record_shards(seconds: list[float]) -> None:
+    """Records the time spent searching every shard in the trace of the query, if any"""
+    trace = get_trace()
+    if trace is not None:
+        trace.shards = seconds
+
+def streamed(lines: Iterator[str]) -> Iterator[str]:
+    """Marks the response of the request as streamed so that its trace includes the time to send all the lines"""
+    trace = get_trace()
+    if trace is None:
+        return lines
+    trace.streaming = True
+
+    def stream() -> Iterator[str]:
+        yield from lines
+        trace.streaming = False
+    return stream()
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, *label_values: str) -> None:
+        with _metrics_lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value:g}')
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        # Per label values: count of every bucket (not cumulated, the last one is +Inf), sum of the observations
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        with _metrics_lock:
+            counts, total = self.values.setdefault(label_values, ([0]*(len(self.buckets) + 1), [0.0]))
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total) in sorted(self.values.items()):
+            cumulated = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulated += count
+                le = bound if isinstance(bound, str) else f'{bound:g}'
+                lines.append(f'{self.name}_bucket{format_labels((*self.labels, "le"), (*label_values, le))} {cumulated}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, label_values)} {total[0]:g}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, label_values)} {cumulated}')
+        return lines
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+_metrics_lock = threading.Lock()
+
+REQUEST_DURATION = Histogram('seekify_search_request_duration_seconds', 'Time to answer a search request.', LATENCY_BUCKETS, ('endpoint',))
+STAGE_DURATION = Histogram('seekify_search_stage_duration_seconds', 'Time spent in a stage of a search query, nested stages excluded.', LATENCY_BUCKETS, ('stage',))
+SHARD_DURATION = Histogram('seekify_search_shard_duration_seconds', 'Time spent searching a shard of the index per search request.', LATENCY_BUCKETS, ('shard',))
+SQL_DURATION = Histogram('seekify_search_sql_duration_seconds', 'Time spent executing SQL statements per search request.', LATENCY_BUCKETS)
+SQL_STATEMENTS = Histogram('seekify_search_sql_statements', 'Number of SQL statements per search request.', STATEMENT_BUCKETS)
+CANDIDATES = Counter('seekify_search_candidates_total', 'Documents matching at least one phrase of the queries.')
+SCORED = Counter('seekify_search_scored_total', 'Candidate documents scored, the others were skipped by dynamic pruning.')
+CACHE_REQUESTS = Counter('seekify_search_cache_requests_total', 'Search requests answered from the result cache or not.', ('result',))
+SLOW_QUERIES = Counter('seekify_search_slow_queries_total', 'Search requests slower than SEARCH_SLOW_QUERY_MS.')
+METRICS = (REQUEST_DURATION, STAGE_DURATION, SHARD_DURATION, SQL_DURATION, SQL_STATEMENTS, CANDIDATES, SCORED, CACHE_REQUESTS, SLOW_QUERIES)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+    trace = get_trace()
+    if trace is not None:
+        trace.sql_statements += 1
+        trace.sql_seconds += elapsed
+
+def add_server_timing(response: Response) -> Response:
+    trace = get_trace()
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+def record_trace(exception: Optional[BaseException] = None) -> None:
+    """Aggregates the trace once the response is sent"""
+    # The teardown of a streamed response also runs when the view returns, before the lines are sent
+    trace = g.get('trace')
+    if trace is None or trace.streaming:
+        return
+    g.pop('trace')
+    if exception is not None:
+        return
+    elapsed = trace.elapsed()
+    REQUEST_DURATION.observe(elapsed, request.endpoint or '')
+    for name, seconds in trace.stages.items():
+        STAGE_DURATION.observe(seconds, name)
+    for i, seconds in enumerate(trace.shards):
+        SHARD_DURATION.observe(seconds, str(i))
+    SQL_DURATION.observe(trace.sql_seconds)
+    SQL_STATEMENTS.observe(trace.sql_statements)
+    if 'candidates' in trace.stats:
+        CANDIDATES.inc(trace.stats['candidates'])
+        SCORED.inc(trace.stats['scored'])
+    if 'cache_hit' in trace.stats:
+        CACHE_REQUESTS.inc(1, 'hit' if trace.stats['cache_hit'] else 'miss')
+
+    slow = current_app.config['SEARCH_SLOW_QUERY_MS']
+    if slow is not None and 1000*elapsed >= slow:
+        SLOW_QUERIES.inc()
+        current_app.logger.warning('Slow query %r parsed as %s took %.1f ms: %s', trace.query, trace.phrases, 1000*elapsed, trace.breakdown())
+
+def metrics() -> Response:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    if not app.config['SEARCH_METRICS']:
+        return
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.after_request(add_server_timing)
+    app.teardown_request(record_trace)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -1,5 +1,5 @@
 from typing import Optional, List, Set
-from sqlalchemy import Column, ForeignKey, Integer, String, Table
+from sqlalchemy import BigInteger, Column, ForeignKey, Index, Integer, LargeBinary, String, Table
 import datetime
 from sqlalchemy.orm import relationship, mapped_column, Mapped
 from app import db
@@ -20,14 +20,20 @@ class Document(db.Model):
     url: Mapped[str] = mapped_column(String(255), unique=True, index=True, nullable=False)
     
     last_modified: Mapped[datetime.datetime]
+    etag: Mapped[Optional[str]] = mapped_column(String(255)) # Validator sent back to the server when the page is crawled again
     size: Mapped[int]
+    title_size: Mapped[int] = mapped_column(default=0)
+    pagerank: Mapped[float] = mapped_column(default=0.0) # Relative to the best page, computed by compute-pagerank
     title: Mapped[Optional[str]] = mapped_column(String(255))
     content: Mapped[Optional[str]]
+    text: Mapped[Optional[str]] # Plain text of the body, the body tokens are read from it
+    offsets: Mapped[Optional[bytes]] = mapped_column(LargeBinary) # Location in the text of every body position, see app.snippet
+    signature: Mapped[Optional[bytes]] = mapped_column(LargeBinary) # MinHash of the body shingles, see app.duplicates
+    duplicate_of_id: Mapped[Optional[int]] = mapped_column(ForeignKey("document_table.id"), index=True) # Indexed page this one is a near-duplicate of, it has no postings
 
     title_postings: Mapped[List["TitlePostingList"]] = relationship("TitlePostingList", back_populates="document") # To generate forward index
-    title_counts: Mapped[List["TitleCountList"]] = relationship("TitleCountList", back_populates="document") # To generate forward index
     body_postings: Mapped[List["BodyPostingList"]] = relationship("BodyPostingList", back_populates="document") # To generate forward index
-    body_counts: Mapped[List["BodyCountList"]] = relationship("BodyCountList", back_populates="document") # To generate forward index
+    keywords: Mapped[List["DocumentKeyword"]] = relationship("DocumentKeyword", back_populates="document", order_by="DocumentKeyword.rank") # Top keywords shown with the results
 
     parents: Mapped[Set["Document"]] = relationship(
         "Document",
@@ -52,9 +58,11 @@ class TitleTerm(db.Model):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     word: Mapped[str] = mapped_column(unique=True, index=True)
+    df: Mapped[int] = mapped_column(default=0) # Number of documents containing the term, maintained by the spider
+    surface: Mapped[Optional[str]] # Word the term was stemmed from when it was first indexed, shown in the suggestions
+    generation: Mapped[int] = mapped_column(default=0, index=True) # Index generation in which df last changed
 
     postings: Mapped[List["TitlePostingList"]] = relationship("TitlePostingList", back_populates="term")
-    counts: Mapped[List["TitleCountList"]] = relationship("TitleCountList", back_populates="term")
 
     def __repr__(self) -> str:
         return f'<TitleTerm {self.word!r}>'
@@ -64,69 +72,124 @@ class BodyTerm(db.Model):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     word: Mapped[str] = mapped_column(unique=True, index=True)
+    df: Mapped[int] = mapped_column(default=0) # Number of documents containing the term, maintained by the spider
+    surface: Mapped[Optional[str]] # Word the term was stemmed from when it was first indexed, shown in the suggestions
+    generation: Mapped[int] = mapped_column(default=0, index=True) # Index generation in which df last changed
     
     postings: Mapped[List["BodyPostingList"]] = relationship("BodyPostingList", back_populates="term")
-    counts: Mapped[List["BodyCountList"]] = relationship("BodyCountList", back_populates="term")
 
     def __repr__(self) -> str:
         return f'<BodyTerm {self.word!r}>'
 
 class TitlePostingList(db.Model):
-    __tablename__ = 'title_posting_table'
+    __tablename__ = 'title_postings_table'
+    # SQLite stores the rows in the primary key b-tree instead of a rowid table and a copy of the key
+    __table_args__ = {'sqlite_with_rowid': False}
 
-    id: Mapped[int] = mapped_column(primary_key=True)
-
-    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"))
-    document: Mapped["Document"] = relationship("Document", back_populates="title_postings") # To generate forward index
-    term_id: Mapped[int] = mapped_column(ForeignKey("title_term_table.id"))
+    # One row per term and document, clustered by term so that a posting list is a range of the primary key
+    term_id: Mapped[int] = mapped_column(ForeignKey("title_term_table.id"), primary_key=True)
     term: Mapped["TitleTerm"] = relationship("TitleTerm", back_populates="postings") # To generate dictionary
+    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"), primary_key=True, index=True)
+    document: Mapped["Document"] = relationship("Document", back_populates="title_postings") # To generate forward index
+
+    tf: Mapped[int] # Number of occurrences of the term in the document
+    positions: Mapped[bytes] = mapped_column(LargeBinary) # Delta encoded varints, see app.index.delta_encode
+
+    def __repr__(self) -> str:
+        return f'<TitlePostingList {self.term!r} {self.document!r} {self.tf!r}>'
+
+class BodyPostingList(db.Model):
+    __tablename__ = 'body_postings_table'
+    # SQLite stores the rows in the primary key b-tree instead of a rowid table and a copy of the key
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # One row per term and document, clustered by term so that a posting list is a range of the primary key
+    term_id: Mapped[int] = mapped_column(ForeignKey("body_term_table.id"), primary_key=True)
+    term: Mapped["BodyTerm"] = relationship("BodyTerm", back_populates="postings") # To generate dictionary
+    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"), primary_key=True, index=True)
+    document: Mapped["Document"] = relationship("Document", back_populates="body_postings") # To generate forward index
+
+    tf: Mapped[int] # Number of occurrences of the term in the document
+    positions: Mapped[bytes] = mapped_column(LargeBinary) # Delta encoded varints, see app.index.delta_encode
 
-    position: Mapped[int]
-    
     def __repr__(self) -> str:
-        return f'<TitlePostingList {self.term!r} {self.document!r} {self.frequency!r}>'
+        return f'<BodyPostingList {self.term!r} {self.document!r} {self.tf!r}>'
 
-class TitleCountList(db.Model):
-    __tablename__ = 'title_count_table'
+class DocumentKeyword(db.Model):
+    __tablename__ = 'document_keyword_table'
 
     id: Mapped[int] = mapped_column(primary_key=True)
 
-    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"))
-    document: Mapped["Document"] = relationship("Document", back_populates="title_counts") # To generate forward index
-    term_id: Mapped[int] = mapped_column(ForeignKey("title_term_table.id"))
-    term: Mapped["TitleTerm"] = relationship("TitleTerm", back_populates="counts") # To generate dictionary
+    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"), index=True)
+    document: Mapped["Document"] = relationship("Document", back_populates="keywords")
+    term_id: Mapped[int] = mapped_column(ForeignKey("body_term_table.id"))
+    term: Mapped["BodyTerm"] = relationship("BodyTerm")
 
+    rank: Mapped[int] # 0 for the most frequent term of the document
     count: Mapped[int]
 
     def __repr__(self) -> str:
-        return f'<TitleCountList {self.term!r} {self.document!r} {self.count}>'
+        return f'<DocumentKeyword {self.term!r} {self.document!r} {self.rank} {self.count}>'
 
-class BodyPostingList(db.Model):
-    __tablename__ = 'body_posting_list'
+class SignatureBand(db.Model):
+    __tablename__ = 'signature_band_table'
+    # SQLite stores the rows in the primary key b-tree instead of a rowid table and a copy of the key
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # One row per band of the signature of every indexed page, the pages sharing a band with a new page are compared to it
+    key: Mapped[int] = mapped_column(BigInteger, primary_key=True) # See app.duplicates.band_keys
+    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"), primary_key=True, index=True)
+
+    def __repr__(self) -> str:
+        return f'<SignatureBand {self.key!r} {self.doc_id!r}>'
+
+class IndexMetadata(db.Model):
+    __tablename__ = 'index_metadata_table'
 
     id: Mapped[int] = mapped_column(primary_key=True)
+    generation: Mapped[int] = mapped_column(default=0) # Bumped by the spider every time a crawl is committed
+    updated: Mapped[Optional[datetime.datetime]]
 
-    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"))
-    document: Mapped["Document"] = relationship("Document", back_populates="body_postings") # To generate forward index
-    term_id: Mapped[int] = mapped_column(ForeignKey("body_term_table.id"))
-    term: Mapped["BodyTerm"] = relationship("BodyTerm", back_populates="postings") # To generate dictionary
+    # Collection statistics maintained by the spider so that queries never aggregate the document table
+    document_count: Mapped[int] = mapped_column(default=0) # Indexed documents, the near-duplicates are left out
+    body_size: Mapped[int] = mapped_column(default=0) # Sum of the body sizes of the indexed documents
+    title_size: Mapped[int] = mapped_column(default=0) # Sum of the title sizes of the indexed documents
+
+    @property
+    def average_body_size(self) -> float:
+        return self.body_size/self.document_count if self.document_count > 0 else 0.0
+
+    @property
+    def average_title_size(self) -> float:
+        return self.title_size/self.document_count if self.document_count > 0 else 0.0
 
-    position: Mapped[int]
-    
     def __repr__(self) -> str:
-        return f'<BodyInvertedIndex {self.term!r} {self.document!r} {self.frequency!r}>'
-    
-class BodyCountList(db.Model):
-    __tablename__ = 'body_count_table'
+        return f'<IndexMetadata {self.generation!r} {self.updated!r} {self.document_count!r}>'
+
+class FrontierUrl(db.Model):
+    __tablename__ = 'frontier_table'
+    # The next urls to crawl are read in priority order among the queued ones
+    __table_args__ = (Index('ix_frontier_table_state_priority', 'state', 'priority', 'id'),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
+    url: Mapped[str] = mapped_column(String(255), unique=True, index=True, nullable=False)
 
-    doc_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"))
-    document: Mapped["Document"] = relationship("Document", back_populates="body_counts") # To generate forward index
-    term_id: Mapped[int] = mapped_column(ForeignKey("body_term_table.id"))
-    term: Mapped["TitleTerm"] = relationship("BodyTerm", back_populates="counts") # To generate dictionary
+    state: Mapped[str] = mapped_column(String(8)) # queued, fetching, done or failed, see app.frontier
+    priority: Mapped[int] = mapped_column(default=0) # Number of links followed from the start page, the lowest are crawled first
+    retries: Mapped[int] = mapped_column(default=0) # Number of crawls stopped, or leases expired, while the page was being fetched
+    host_hash: Mapped[int] = mapped_column(default=0) # Hash of the host, the pages of a host are crawled by a single worker
+    lease_expires: Mapped[Optional[datetime.datetime]] # Time a worker fetching the page is given up, in UTC
 
-    count: Mapped[int]
+    def __repr__(self) -> str:
+        return f'<FrontierUrl {self.url!r} {self.state!r} {self.priority!r} {self.retries!r} {self.lease_expires!r}>'
+
+class FrontierLink(db.Model):
+    __tablename__ = 'frontier_link_table'
+
+    # Link of an indexed page to a page not indexed yet, written to document_to_document once the page is indexed
+    id: Mapped[int] = mapped_column(primary_key=True)
+    url: Mapped[str] = mapped_column(String(255), index=True)
+    parent_id: Mapped[int] = mapped_column(ForeignKey("document_table.id"))
 
     def __repr__(self) -> str:
-        return f'<BodyCountList {self.term!r} {self.document!r} {self.count}>'
\ No newline at end of file
+        return f'<FrontierLink {self.url!r} {self.parent_id!r}>'
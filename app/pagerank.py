@@ -0,0 +1,95 @@
+from __future__ import annotations
+import time
+from typing import Optional
+import click
+import numpy as np
+from flask import current_app
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.orm import Session
+from app import db
+from app.models import Document, document_to_document
+from app.index import bump_generation
+
+"""PageRank of the crawled pages, used as a query independent score"""
+
+def load_columns(db: Session, query, dtype: np.dtype) -> np.ndarray:
+    """Streams a query into a structured array with one record per result row, the ids stay integers"""
+    result = db.connection().execute(query)
+    return np.fromiter(map(tuple, result), dtype=dtype)
+
+def load_graph(db: Session) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the doc ids by increasing id, their stored scores and the links as (parent, child) indices into the doc ids"""
+    documents = load_columns(db, select(Document.id, func.coalesce(Document.pagerank, 0.0)).order_by(Document.id.asc()), np.dtype([('id', np.int64), ('pagerank', np.float64)]))
+    doc_ids = documents['id']
+
+    # Children are on the left side of the association, parents on the right
+    links = load_columns(db, select(document_to_document.c.right_id, document_to_document.c.left_id), np.dtype([('parent', np.int64), ('child', np.int64)]))
+    return doc_ids, documents['pagerank'], np.searchsorted(doc_ids, links['parent']), np.searchsorted(doc_ids, links['child'])
+
+def pagerank(n: int, sources: np.ndarray, targets: np.ndarray, damping: float = 0.85, tolerance: float = 1e-6, max_iterations: int = 100, start: Optional[np.ndarray] = None) -> tuple[np.ndarray, int]:
+    """Power iteration over the links from sources to targets, returns the scores summing to one and the iterations run
+
+    The sparse matrix vector product is a weighted bincount over the links. The rank of the pages without
+    outgoing links is spread over every page.
+    """
+    if n == 0:
+        return np.zeros(0), 0
+    out_degree = np.bincount(sources, minlength=n).astype(np.float64)
+    weights = 1/out_degree[sources]
+    dangling = out_degree == 0
+
+    if start is not None and start.sum() > 0:
+        scores = start/start.sum()
+    else:
+        scores = np.full(n, 1/n)
+
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        spread = np.bincount(targets, weights=scores[sources]*weights, minlength=n)
+        new_scores = damping*(spread + scores[dangling].sum()/n) + (1 - damping)/n
+        error = np.abs(new_scores - scores).sum()
+        scores = new_scores
+        if error < tolerance:
+            break
+    return scores, iteration
+
+def warm_start(stored: np.ndarray) -> Optional[np.ndarray]:
+    """Starts from the previous scores, the pages crawled since then start from the average score"""
+    known = stored > 0
+    if not known.any():
+        return None
+    start = stored.copy()
+    start[~known] = stored[known].mean()
+    return start
+
+def compute_pagerank(db: Session, damping: float, tolerance: float, max_iterations: int, warm: bool = True) -> tuple[int, int, int]:
+    """Computes and stores the PageRank of every document, returns the number of documents, links and iterations"""
+    doc_ids, stored, sources, targets = load_graph(db)
+    scores, iterations = pagerank(len(doc_ids), sources, targets, damping, tolerance, max_iterations, warm_start(stored) if warm else None)
+
+    # Stored relative to the best page so that the blend weight does not depend on the size of the collection
+    if len(scores) > 0:
+        scores = scores/scores.max()
+        table = Document.__table__
+        db.execute(\
+            update(table)\
+            .where(table.c.id == bindparam('doc_id'))\
+            .values(pagerank=bindparam('score')),\
+            [{'doc_id': int(doc_id), 'score': float(score)} for doc_id, score in zip(doc_ids, scores)]\
+        )
+    # The stored scores are part of the ranking, the workers have to reload them
+    bump_generation(db)
+    db.commit()
+    return len(doc_ids), len(sources), iterations
+
+@click.command('compute-pagerank')
+@click.option('--cold', is_flag=True, help='Start from the uniform vector instead of the stored scores.')
+def compute_pagerank_command(cold: bool):
+    """Compute the PageRank of the crawled pages from their links."""
+    config = current_app.config
+    start = time.perf_counter()
+    documents, links, iterations = compute_pagerank(db.session, config['PAGERANK_DAMPING'], config['PAGERANK_TOLERANCE'], config['PAGERANK_MAX_ITERATIONS'], not cold)
+    click.echo(f'Computed the PageRank of {documents} documents and {links} links in {iterations} iterations ({time.perf_counter() - start:.2f} s)')
+
+def init_app(app):
+    app.cli.add_command(compute_pagerank_command)
@@ -1,54 +1,93 @@
-from flask import g
+import re
+import threading
+from array import array
+from functools import lru_cache
+from typing import Optional
+from flask import current_app
 from nltk.stem.porter import *
 from nltk.tokenize import regexp_tokenize, word_tokenize
 from nltk.corpus import stopwords
 from collections import Counter
+from app.snippet import locate_tokens, pack_offset
+
+# The rules of the Treebank tokenizer applied by word_tokenize that decide which tokens are alphabetic:
+# can't is split into ca and n't and cannot, gonna and friends in two words like punkt does. Words joined
+# by hyphens, periods, slashes and the other characters Treebank does not split on are kept whole so
+# that both tokenizers filter out well-known, U.S. or and/or as non alphabetic, clitics such as 's are
+# split off with their apostrophe and an opening quote is split off the word it starts
+FAST_TOKEN_PATTERN = re.compile(r"""
+    (?i:can(?=not\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|wan(?=na\s))
+    |\w+(?=(?:n't|N'T)(?![-./+=|~^\\']?\w))|(?:n't|N'T)(?![-./+=|~^\\']?\w)
+    |(?:(?<![-.])[-.]|[/+=|~^\\]|'(?=(?i:re|ve|ll|m|t|s|d|n)\b))*
+     \w+(?:[-./+=|~^\\]\w+|'(?!(?:[sSmMdD]|ll|LL|re|RE|ve|VE)\b)\w+)*(?:-(?!-))?
+""", re.VERBOSE)
 
 class Parser:
-    def __init__(self) -> None:
+    def __init__(self, tokenizer: str = 'punkt', stem_cache_size: int = 100000) -> None:
         self.stemmer = PorterStemmer()
         self.stopwords = set(stopwords.words('english'))
-    
-    def parse(self, content: str) -> tuple[list[str], Counter]:
-        # Tokenize the text content of the webpage
-        tokens = word_tokenize(content)
-
-        # Filter out the stopwords
-        filtered_tokens = [word.lower() for word in tokens if word.isalpha() and word.lower() not in self.stopwords]
-
-        # Stem the token using the PorterStemmer
-        stemmed_tokens = list(map(lambda w: self.stemmer.stem(w), filtered_tokens))
-
-        return stemmed_tokens, Counter(stemmed_tokens)
-    
-    def parse_query(self, content: str) -> list[list[str]]:
-        if '"' in content:
-            expr = r'\w+|[^\w\s]+|"[^"]*"'
-            phrases = [word_tokenize(part) for part in regexp_tokenize(content, expr)]
-
-            filtered_phrases = [[word.lower() for word in phrase if word.isalpha() and word.lower() not in self.stopwords] for phrase in phrases]
 
-            stemmed_phrases = list(map(lambda w: [self.stemmer.stem(t) for t in w], filtered_phrases))
+        # The regex tokenizer gives the same alphabetic tokens as punkt on ordinary text and is much faster,
+        # runs of punctuation inside a word can still be split differently so the index is rebuilt when
+        # the tokenizer changes
+        if tokenizer == 'punkt':
+            self.tokenize = word_tokenize
+        elif tokenizer == 'regex':
+            self.tokenize = FAST_TOKEN_PATTERN.findall
+        else:
+            raise ValueError(f"Unknown tokenizer {tokenizer!r}, expected 'punkt' or 'regex'")
+        self.tokenizer = tokenizer
 
-            return stemmed_phrases
-        else: 
-            tokens = word_tokenize(content)
+        # The stemmed vocabulary repeats constantly so the stems are memoized
+        self.stem_cache_size = stem_cache_size
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
 
-            # Filter out the stopwords
-            filtered_tokens = [word.lower() for word in tokens if word.isalpha() and word.lower() not in self.stopwords]
+    def analyze(self, tokens: list[str], surfaces: Optional[dict[str, str]] = None, kept: Optional[list[int]] = None) -> list[str]:
+        # Filter out the stopwords and stem the remaining tokens using the PorterStemmer
+        stemmed_tokens = []
+        for i, token in enumerate(tokens):
+            if token.isalpha():
+                word = token.lower()
+                if word not in self.stopwords:
+                    stem = self.stem(word)
+                    stemmed_tokens.append(stem)
+                    # The first word seen for every stem is kept to display it, the stems are not words
+                    if surfaces is not None and stem not in surfaces:
+                        surfaces[stem] = word
+                    if kept is not None:
+                        kept.append(i)
+        return stemmed_tokens
 
-            # Stem the token using the PorterStemmer
-            stemmed_tokens = list(map(lambda w: [self.stemmer.stem(w)], filtered_tokens))
-
-            return stemmed_tokens
+    def parse(self, content: str, surfaces: Optional[dict[str, str]] = None, offsets: Optional[array] = None) -> tuple[list[str], Counter]:
+        # Tokenize the text content of the webpage
+        tokens = self.tokenize(content)
+        if offsets is None:
+            stemmed_tokens = self.analyze(tokens, surfaces)
+        else:
+            # The packed location in the content of every token kept, in the order of their positions
+            kept = []
+            stemmed_tokens = self.analyze(tokens, surfaces, kept)
+            spans = locate_tokens(content, tokens)
+            offsets.extend(pack_offset(*spans[i]) for i in kept)
 
-            
-        
-        
+        return stemmed_tokens, Counter(stemmed_tokens)
 
+    def parse_query(self, content: str) -> list[list[str]]:
+        if '"' in content:
+            # Quoted phrases have to be tried first, otherwise the quotes are matched as punctuation
+            expr = r'"[^"]*"|\w+|[^\w\s]+'
+            return [self.analyze(self.tokenize(part)) for part in regexp_tokenize(content, expr)]
+        else:
+            return [[token] for token in self.analyze(self.tokenize(content))]
 
+# A single parser is shared by the whole process so the stopwords and the stem cache are only loaded once
+_parser: Optional[Parser] = None
+_parser_lock = threading.Lock()
 
 def get_parser() -> Parser:
-    if 'parser' not in g:
-        g.parser = Parser()
-    return g.parser
\ No newline at end of file
+    global _parser
+    if _parser is None:
+        with _parser_lock:
+            if _parser is None:
+                _parser = Parser(current_app.config['PARSER_TOKENIZER'], current_app.config['PARSER_STEM_CACHE_SIZE'])
+    return _parser
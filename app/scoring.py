@@ -0,0 +1,278 @@
+from __future__ import annotations
+import heapq
+import math
+from array import array
+from itertools import islice
+from typing import Optional, Sequence
+import numpy as np
+
+"""Contains the BM25 parameters and the ranking shared by every search engine"""
+
+# Saturation parameter of the title field
+K1 = 1.6
+# Saturation parameter of the body field
+K2 = 1.2
+# Length normalization parameter
+B = 0.75
+# Number of postings covered by one block upper bound
+BLOCK_SIZE = 64
+# Relative slack on the pruning threshold so that rounding errors never prune a document of the top-k
+THRESHOLD_SLACK = 1e-9
+
+def bm25(N: int, Nt: int, ftd: int, size: int, lavg: float, k: float, b: float = B) -> float:
+    return math.log(N/Nt)*(ftd*(k+1))/(ftd+k*((1-b)+b*(size/lavg)))
+
+class FieldStatistics:
+    """Saturation parameter and length normalization data of one field"""
+    __slots__ = ('k', 'lavg', 'doc_sizes')
+
+    def __init__(self, k: float, lavg: float, doc_sizes: Sequence[int]) -> None:
+        self.k = k
+        self.lavg = lavg
+        self.doc_sizes = doc_sizes
+
+    def score(self, N: int, Nt: int, ftd: int, doc_id: int) -> float:
+        return bm25(N, Nt, ftd, self.doc_sizes[doc_id], self.lavg, self.k)
+
+class StaticScore:
+    """Query independent score of the documents (PageRank), added with a weight to the score of the matching ones"""
+    __slots__ = ('weight', 'scores', 'max_score')
+
+    def __init__(self, weight: float, scores: Sequence[float], max_score: float) -> None:
+        self.weight = weight
+        self.scores = scores
+        self.max_score = weight*max_score
+
+    def score(self, doc_id: int) -> float:
+        return self.weight*self.scores[doc_id]
+
+def block_upper_bounds(doc_ids: array, ftds: array, N: int, Nt: int, field: FieldStatistics) -> array:
+    """Returns the highest score of every block of BLOCK_SIZE postings"""
+    bounds = array('d')
+    for start in range(0, len(doc_ids), BLOCK_SIZE):
+        bounds.append(max(\
+            field.score(N, Nt, ftds[i], doc_ids[i])\
+            for i in range(start, min(start + BLOCK_SIZE, len(doc_ids)))\
+        ))
+    return bounds
+
+class PhrasePostings:
+    """Documents containing a phrase in one field along with the phrase frequency in each of them"""
+    __slots__ = ('doc_ids', 'ftds', 'field', 'df', 'block_max', 'max_score', 'cursor')
+
+    def __init__(self, doc_ids: array, ftds: array, field: FieldStatistics, df: Optional[int] = None, block_max: Optional[array] = None) -> None:
+        self.doc_ids = doc_ids
+        self.ftds = ftds
+        self.field = field
+        # Number of documents of the collection containing the phrase
+        self.df = len(doc_ids) if df is None else df
+        self.block_max = block_max
+        self.max_score = 0.0
+        self.cursor = 0
+
+    def prepare(self, N: int) -> None:
+        # Phrases are only known at query time, their bounds are computed on the fly
+        if self.block_max is None:
+            self.block_max = block_upper_bounds(self.doc_ids, self.ftds, N, self.df, self.field)
+        self.max_score = max(self.block_max, default=0.0)
+        self.cursor = 0
+
+    def doc(self) -> float:
+        return self.doc_ids[self.cursor] if self.cursor < len(self.doc_ids) else math.inf
+
+    def block_end(self) -> int:
+        """Returns the last doc id of the block holding the current posting"""
+        return self.doc_ids[min((self.cursor // BLOCK_SIZE + 1)*BLOCK_SIZE, len(self.doc_ids)) - 1]
+
+    def block_score(self) -> float:
+        return self.block_max[self.cursor // BLOCK_SIZE]
+
+    def seek(self, doc_id: int) -> None:
+        """Moves the cursor to the first posting whose doc id is not lower than doc_id"""
+        # Exponential search followed by a binary search, the doc ids are sorted
+        lo = self.cursor
+        hi = lo
+        step = 1
+        while hi < len(self.doc_ids) and self.doc_ids[hi] < doc_id:
+            lo = hi + 1
+            hi += step
+            step *= 2
+        hi = min(hi, len(self.doc_ids))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.doc_ids[mid] < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.cursor = lo
+
+def follows(score: float, doc_id: int, after: Optional[tuple[float, int]]) -> bool:
+    """Returns whether the document ranks after the (score, doc id) of the last result of the previous page"""
+    return after is None or score < after[0] or score == after[0] and doc_id > after[1]
+
+def rank_exhaustive(postings: list[PhrasePostings], N: int, top: int, stats: Optional[dict] = None, static: Optional[StaticScore] = None, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+    scores: dict[int, float] = {}
+    for phrase in postings:
+        for doc_id, ftd in zip(phrase.doc_ids, phrase.ftds):
+            scores[doc_id] = scores.get(doc_id, 0) + phrase.field.score(N, phrase.df, ftd, doc_id)
+
+    if stats is not None:
+        stats['candidates'] = len(scores)
+        stats['scored'] = len(scores)
+        stats['skipped'] = 0
+
+    if static is not None:
+        scores = {doc_id: score + static.score(doc_id) for doc_id, score in scores.items() if score > 0}
+
+    # Ties are broken by doc id so the ranking is deterministic
+    return heapq.nlargest(top, ((score, doc_id) for doc_id, score in scores.items() if score > 0 and follows(score, doc_id, after)), key=lambda r: (r[0], -r[1]))
+
+def rank_wand(postings: list[PhrasePostings], N: int, top: int, stats: Optional[dict] = None, static: Optional[StaticScore] = None, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+    """Document at a time ranking skipping the documents whose upper bound cannot enter the top-k (Block-Max WAND)
+
+    The documents of the previous pages are scored but never enter the heap, so the threshold only rises with the
+    documents of the requested page.
+    """
+    for phrase in postings:
+        phrase.prepare(N)
+    order = {id(phrase): i for i, phrase in enumerate(postings)}
+    cursors = [phrase for phrase in postings if len(phrase.doc_ids) > 0]
+
+    # Min-heap of (score, -doc id) so that on ties the lowest doc id is kept, the docs are visited by increasing id
+    # so a later document never replaces an earlier one with the same score
+    heap: list[tuple[float, int]] = []
+    scored = 0
+    while cursors:
+        threshold = heap[0][0]*(1 - THRESHOLD_SLACK) if len(heap) == top else 0.0
+        cursors.sort(key=lambda phrase: phrase.doc())
+
+        # The pivot is the first document whose cumulated upper bounds can beat the threshold
+        pivot = None
+        bound = static.max_score if static is not None else 0.0
+        for i, phrase in enumerate(cursors):
+            bound += phrase.max_score
+            if bound > threshold:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = cursors[pivot].doc_ids[cursors[pivot].cursor]
+
+        if cursors[0].doc() != pivot_doc:
+            # No document before the pivot can enter the top-k
+            for phrase in cursors[:pivot]:
+                phrase.seek(pivot_doc)
+            cursors = [phrase for phrase in cursors if phrase.cursor < len(phrase.doc_ids)]
+            continue
+
+        matching = [phrase for phrase in cursors if phrase.doc() == pivot_doc]
+        block_bound = sum(phrase.block_score() for phrase in matching)
+        # The other documents of the blocks may have a higher static score than the pivot
+        if block_bound + (static.max_score if static is not None else 0.0) <= threshold:
+            # The current blocks cannot produce a top-k document, jump past the first of them to end
+            others = [phrase.doc() for phrase in cursors if phrase.doc() != pivot_doc]
+            target = min(min(phrase.block_end() for phrase in matching) + 1, min(others, default=math.inf))
+            for phrase in matching:
+                phrase.seek(target)
+        elif static is not None and block_bound + static.score(pivot_doc) <= threshold:
+            # Only the pivot cannot enter the top-k
+            for phrase in matching:
+                phrase.cursor += 1
+        else:
+            # Contributions are summed in the same order as the exhaustive ranking so the scores are identical
+            score = 0.0
+            for phrase in sorted(matching, key=lambda phrase: order[id(phrase)]):
+                score += phrase.field.score(N, phrase.df, phrase.ftds[phrase.cursor], pivot_doc)
+                phrase.cursor += 1
+            scored += 1
+            if score > 0:
+                if static is not None:
+                    score += static.score(pivot_doc)
+                if follows(score, pivot_doc, after):
+                    if len(heap) < top:
+                        heapq.heappush(heap, (score, -pivot_doc))
+                    elif (score, -pivot_doc) > heap[0]:
+                        heapq.heapreplace(heap, (score, -pivot_doc))
+        cursors = [phrase for phrase in cursors if phrase.cursor < len(phrase.doc_ids)]
+
+    if stats is not None:
+        candidates = len(set().union(*(phrase.doc_ids for phrase in postings)))
+        stats['candidates'] = candidates
+        stats['scored'] = scored
+        stats['skipped'] = candidates - scored
+
+    return [(score, -doc_id) for score, doc_id in sorted(heap, reverse=True)]
+
+def gather(values: Sequence, doc_ids: np.ndarray) -> np.ndarray:
+    """Returns the values of the documents, from an array or a memory view indexed by doc id or from a dict"""
+    # The indexes keep the per document values in buffers indexed by doc id, the SQL engine in a dict of the candidates
+    if isinstance(values, array):
+        return np.frombuffer(values, dtype=values.typecode)[doc_ids]
+    if isinstance(values, memoryview):
+        return np.frombuffer(values, dtype=values.format)[doc_ids]
+    return np.fromiter((values[doc_id] for doc_id in doc_ids.tolist()), dtype=np.float64, count=len(doc_ids))
+
+def rank_vectorized(postings: list[PhrasePostings], N: int, top: int, stats: Optional[dict] = None, static: Optional[StaticScore] = None, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+    """Scores every candidate like rank_exhaustive, one NumPy operation per phrase instead of one Python call per posting"""
+    phrases = [(phrase, np.frombuffer(phrase.doc_ids, dtype=np.int64)) for phrase in postings if len(phrase.doc_ids) > 0]
+    candidates = np.unique(np.concatenate([doc_ids for _, doc_ids in phrases])) if phrases else np.zeros(0, dtype=np.int64)
+    scores = np.zeros(len(candidates))
+    for phrase, doc_ids in phrases:
+        field = phrase.field
+        ftds = np.frombuffer(phrase.ftds, dtype=np.int64).astype(np.float64)
+        sizes = gather(field.doc_sizes, doc_ids)
+        # Same operations in the same order as bm25 so that the scores are identical
+        contributions = math.log(N/phrase.df)*(ftds*(field.k+1))/(ftds+field.k*((1-B)+B*(sizes/field.lavg)))
+        # The doc ids of a phrase are unique, the contributions are added phrase by phrase like rank_exhaustive does
+        scores[np.searchsorted(candidates, doc_ids)] += contributions
+
+    if stats is not None:
+        stats['candidates'] = len(candidates)
+        stats['scored'] = len(candidates)
+        stats['skipped'] = 0
+
+    matching = scores > 0
+    candidates = candidates[matching]
+    scores = scores[matching]
+    if static is not None:
+        scores = scores + static.weight*gather(static.scores, candidates)
+        matching = scores > 0
+        candidates = candidates[matching]
+        scores = scores[matching]
+    if after is not None:
+        following = (scores < after[0]) | ((scores == after[0]) & (candidates > after[1]))
+        candidates = candidates[following]
+        scores = scores[following]
+
+    if len(scores) > top:
+        # Every document tied with the k-th score is kept so that ties are broken by doc id below
+        kth = scores[np.argpartition(-scores, top - 1)[top - 1]]
+        selected = scores >= kth
+        candidates = candidates[selected]
+        scores = scores[selected]
+    order = np.lexsort((candidates, -scores))[:top]
+    return list(zip(scores[order].tolist(), candidates[order].tolist()))
+
+def rank(postings: list[PhrasePostings], N: int, top: int, pruning: bool = True, stats: Optional[dict] = None, static: Optional[StaticScore] = None, vectorized: bool = False, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+    """Scores the posting list of every phrase and returns the top (score, doc id) pairs by decreasing score
+
+    The static score of a document is only added when it matches the query. The vectorized ranking scores every
+    candidate so it does not use dynamic pruning. Given the (score, doc id) of the last result of a page, only
+    the documents ranked after it are returned, the top of the next page.
+    """
+    # A field where every document is empty cannot be scored
+    postings = [phrase for phrase in postings if phrase.field.lavg > 0]
+    if N == 0 or top <= 0:
+        if stats is not None:
+            stats.update(candidates=0, scored=0, skipped=0)
+        return []
+    if vectorized:
+        return rank_vectorized(postings, N, top, stats, static, after)
+    if pruning:
+        return rank_wand(postings, N, top, stats, static, after)
+    return rank_exhaustive(postings, N, top, stats, static, after)
+
+def merge_rankings(rankings: list[list[tuple[float, int]]], top: int) -> list[tuple[float, int]]:
+    """Merges the rankings of disjoint sets of documents into the top (score, doc id) pairs of all of them"""
+    # Every ranking is sorted by decreasing score then increasing doc id, as the merged one is
+    return list(islice(heapq.merge(*rankings, key=lambda r: (-r[0], r[1])), top))
@@ -1,35 +1,60 @@
 from __future__ import annotations
-import math
-from typing import Optional, Union
+import base64
+import binascii
+import struct
+from typing import Iterator, Optional, Union
 from flask import current_app, flash, redirect, render_template, request, url_for
 from sqlalchemy import func, select
 from sqlalchemy.orm import Session, with_parent
 from app.parser import get_parser
 from app import db
-from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList, TitleCountList, BodyCountList
-import heapq
+from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList, DocumentKeyword, document_to_document
+from app.cache import get_result_cache
+from app.index import count_phrase, delta_decode, get_generation, get_index, get_metadata
+from app.segment import get_segment
+from app.dictionary import FrontCodedDictionary, TermDictionaries, get_dictionaries
+from app.snippet import make_snippet
+from app.metrics import stage, start_trace
+from app.scoring import K1, K2, FieldStatistics, PhrasePostings, StaticScore, rank
+from array import array
+from itertools import groupby
+
+# Number of child links shown with every result
+CHILD_LINKS = 4
+# Score and doc id of the last result of a page, encoded in the cursor of the next one
+CURSOR = struct.Struct('<dq')
 
 class Result:
-    def __init__(self, score: int) -> None:
-        self.doc: Optional[Document] = None
+    def __init__(self, score: int, doc_id: Optional[int] = None) -> None:
+        self.doc_id = doc_id
         self.score = score
 
-    def populate(self) -> Result:
-        self.title = self.doc.title
-        self.url = self.doc.url
-        self.metadata = f'{str(self.doc.last_modified)} {self.doc.size}'
-        self.keywords = ": ".join([\
-            f'{word} {count}'\
-            for word, count in db.session.execute(\
-                select(BodyTerm.word, BodyCountList.count)\
-                .where(BodyCountList.doc_id == self.doc.id)\
-                .join(BodyTerm, BodyCountList.term)\
-                .order_by(BodyCountList.count.desc())\
-                .limit(5)\
-            ).all()\
-        ])
-        self.children = [f'{child.title} {child.url}' for child in self.doc.children][0:4]
-    
+    def populate(self, doc, keywords: list[tuple[str, int]], children: list[tuple[Optional[str], str]], snippet: list[tuple[str, bool]]) -> Result:
+        self.title = doc.title
+        self.url = doc.url
+        self.last_modified = doc.last_modified
+        self.size = doc.size
+        self.metadata = f'{str(doc.last_modified)} {doc.size}'
+        self.keyword_counts = keywords
+        self.keywords = ": ".join([f'{word} {count}' for word, count in keywords])
+        self.child_links = children
+        self.children = [f'{title} {url}' for title, url in children]
+        # Pieces of the text around the query, the query words are flagged to be highlighted
+        self.snippet = snippet
+        return self
+
+    def to_json(self) -> dict:
+        return {
+            'score': self.score,
+            'url': self.url,
+            'title': self.title,
+            'last_modified': self.last_modified.isoformat(),
+            'size': self.size,
+            'keywords': [{'word': word, 'count': count} for word, count in self.keyword_counts],
+            'children': [{'title': title, 'url': url} for title, url in self.child_links],
+            'snippet': [{'text': text, 'match': match} for text, match in self.snippet],
+        }
+
     def __eq__(self, other: Result) -> bool:
         return self.score == other.score
     
@@ -45,309 +70,269 @@ class Result:
     def __ge__(self, other: Result) -> bool:
         return self.score >= other.score
 
-class Phrase:
-    def __init__(self, phrase: list[Union[TitleTerm, BodyTerm]], next_doc: Document) -> None:
-        self.phrase = phrase
-        self.next_doc = next_doc
-    
-    def __eq__(self, other: Phrase) -> bool:
-        if self.next_doc is None or other.next_doc is None: return False
-        return self.next_doc.id == other.next_doc.id
+class SQLField:
+    """Tables of one field (title or body) queried by the SQL engine"""
+    def __init__(self, term_model, posting_model, size_column, k: float) -> None:
+        self.term_model = term_model
+        self.posting_model = posting_model
+        self.size_column = size_column
+        self.k = k
 
-    def __lt__(self, other: Phrase) -> bool:
-        if self.next_doc is None or other.next_doc is None: return True
-        return self.next_doc.id < other.next_doc.id
-    
-    def __le__(self, other: Phrase) -> bool:
-        if self.next_doc is None or other.next_doc is None: return True
-        return self.next_doc.id <= other.next_doc.id
-    
-    def __gt__(self, other: Phrase) -> bool:
-        if self.next_doc is None or other.next_doc is None: return False
-        return self.next_doc.id > other.next_doc.id
-    
-    def __ge__(self, other: Phrase) -> bool:
-        if self.next_doc is None or other.next_doc is None: return False
-        return self.next_doc.id >= other.next_doc.id
+title_field = SQLField(TitleTerm, TitlePostingList, Document.title_size, K1)
+body_field = SQLField(BodyTerm, BodyPostingList, Document.size, K2)
 
-def prevTitleTerm(db: Session, term: TitleTerm, position: Optional[TitlePostingList]) -> Optional[TitlePostingList]:
-    if position is None:
-        return None
-    return db.scalars(\
-        select(TitlePostingList)\
-        .where(TitlePostingList.term_id == term.id)\
-        .where((TitlePostingList.doc_id <= position.doc_id) & (TitlePostingList.position < position.position))\
-        .order_by(TitlePostingList.doc_id.desc())\
-    ).first()
-
-def nextTitleTerm(db: Session, term: TitleTerm, position: Optional[TitlePostingList]) -> Optional[TitlePostingList]:
-    if position is None:
-        return None
-    return db.scalars(\
-        select(TitlePostingList)\
-        .where(TitlePostingList.term_id == term.id)\
-        .where((TitlePostingList.doc_id >= position.doc_id) & (TitlePostingList.position > position.position))\
-        .order_by(TitlePostingList.doc_id.asc())\
-    ).first()
-
-def nextTitlePhrase(db: Session, phrase: list[TitleTerm], position: Optional[TitlePostingList]) -> tuple[Optional[TitlePostingList], Optional[TitlePostingList]]:
-    if position is None:
-        return None, None
-    if len(phrase) == 1:
-        u = nextTitleTerm(db, phrase[0], position)
-        return u, u
-    v = position
-    p = phrase
-    for term in p:
-        v = nextTitleTerm(db, term, v)
-    if v is None:
-        return None, None
-    u = v
-    p.reverse()
-    for term in p:
-        u = prevTitleTerm(db, term, u)
-    if v.id - u.id == len(phrase) - 1:
-        return u, v
-    else:
-        return nextTitlePhrase(db, phrase, u)
-
-def nextTitleDoc(db: Session, phrase: list[TitleTerm], doc: Optional[Document]) -> Optional[Document]:
-    if doc is None:
-        doc = db.scalars(\
-            select(Document)\
-            .order_by(Document.id.asc())\
-        ).first()
-        if len(phrase) == 1:
-            return db.scalars(\
-                select(Document)\
-                .join(TitleCountList, Document.title_counts)
-                .where((TitleCountList.term_id == phrase[0].id) & (TitleCountList.doc_id > doc.id-1))\
-                .order_by(Document.id.asc())\
-            ).first()
-    if len(phrase) == 1:
-        return db.scalars(\
-            select(Document)\
-            .join(TitleCountList, Document.title_counts)
-            .where((TitleCountList.term_id == phrase[0].id) & (TitleCountList.doc_id > doc.id))\
-            .order_by(Document.id.asc())\
-        ).first()
-    start, end = nextTitlePhrase(db, phrase, doc.title_postings[0])
-    while start is not None and start.document == doc:
-        start, end = nextTitlePhrase(db, phrase, end)
-    if start is None:
-        return None
-    return start.document
+class TermEntry:
+    __slots__ = ('id', 'df')
 
-def title_ftd(db: Session, phrase: list[TitleTerm], doc: Document) -> int:
-    if len(phrase) == 1:
-        return db.scalar(\
-            select(TitleCountList.count)\
-            .where((TitleCountList.term_id == phrase[0].id) & (TitleCountList.doc_id == doc.id))\
-        )
-    count = 0
-    start, end = nextTitlePhrase(db, phrase, doc.title_postings[0])
-    while start is not None and start.document == doc:
-        start, end = nextTitlePhrase(db, phrase, end)
-        count += 1
-    return count
-
-def title_Nt(db: Session, phrase: list[TitleTerm]) -> int:
-    count = 0
+    def __init__(self, id: int, df: int) -> None:
+        self.id = id
+        self.df = df
+
+def lookup_terms(db: Session, field: SQLField, dictionary: Optional[FrontCodedDictionary], phrase: list[str]) -> dict[str, TermEntry]:
+    """Returns the id and document frequency of the words of the phrase present in the field"""
+    if dictionary is None:
+        return {row.word: TermEntry(row.id, row.df) for row in db.execute(\
+            select(field.term_model.word, field.term_model.id, field.term_model.df)\
+            .where(field.term_model.word.in_(set(phrase)))\
+        )}
+    terms = {}
+    for word in set(phrase):
+        entry = dictionary.get(word)
+        if entry is not None:
+            terms[word] = TermEntry(*entry)
+    return terms
+
+def phrase_postings(db: Session, field: SQLField, statistics: FieldStatistics, phrase: list[str], dictionary: Optional[FrontCodedDictionary] = None) -> PhrasePostings:
+    """Returns the documents containing the phrase along with the number of occurrences in each"""
+    if len(phrase) == 0:
+        return PhrasePostings(array('q'), array('q'), statistics)
+    with stage('lookup'):
+        terms = lookup_terms(db, field, dictionary, phrase)
+    if len(terms) != len(set(phrase)):
+        return PhrasePostings(array('q'), array('q'), statistics)
+
+    doc_ids = array('q')
+    ftds = array('q')
     if len(phrase) == 1:
-        return db.scalar(\
-            select(func.count(TitleCountList.doc_id))\
-            .where(TitleCountList.term_id == phrase[0].id)\
-        )
-    doc = db.scalars(
-        select(Document)\
-        .order_by(Document.id.asc())\
-    ).first()
-    while doc is not None:
-        doc = nextTitleDoc(db, phrase, doc)
-        count += 1
-    return count
-
-def prevBodyTerm(db: Session, term: BodyTerm, position: Optional[BodyPostingList]) -> Optional[BodyPostingList]:
-    if position is None:
-        return None
-    return db.scalars(\
-        select(BodyPostingList)\
-        .where(BodyPostingList.term_id == term.id)\
-        .where((BodyPostingList.doc_id <= position.doc_id) & (BodyPostingList.position < position.position))\
-        .order_by(BodyPostingList.doc_id.desc())\
-    ).first()
-
-def nextBodyTerm(db: Session, term: BodyTerm, position: Optional[BodyPostingList]) -> Optional[BodyPostingList]:
-    if position is None:
+        for doc_id, tf, size in db.execute(\
+            select(field.posting_model.doc_id, field.posting_model.tf, field.size_column)\
+            .join(Document, field.posting_model.document)\
+            .where(field.posting_model.term_id == terms[phrase[0]].id)\
+            .order_by(field.posting_model.doc_id.asc())\
+        ):
+            doc_ids.append(doc_id)
+            ftds.append(tf)
+            statistics.doc_sizes[doc_id] = size
+        return PhrasePostings(doc_ids, ftds, statistics, terms[phrase[0]].df)
+
+    # Only the documents containing every term of the phrase are candidates
+    unique_ids = [term.id for term in terms.values()]
+    candidates = select(field.posting_model.doc_id)\
+        .where(field.posting_model.term_id.in_(unique_ids))\
+        .group_by(field.posting_model.doc_id)\
+        .having(func.count() == len(unique_ids))
+
+    # The packed positions of all the terms in all the candidates are fetched at once
+    positions = db.execute(\
+        select(field.posting_model.doc_id, field.posting_model.term_id, field.posting_model.positions, field.size_column.label('size'))\
+        .join(Document, field.posting_model.document)\
+        .where(field.posting_model.term_id.in_(unique_ids) & field.posting_model.doc_id.in_(candidates))\
+        .order_by(field.posting_model.doc_id.asc())\
+    )
+    for doc_id, rows in groupby(positions, key=lambda row: row.doc_id):
+        term_positions = {}
+        for row in rows:
+            term_positions[row.term_id] = delta_decode(row.positions)
+        ftd = count_phrase([term_positions[terms[token].id] for token in phrase])
+        if ftd > 0:
+            doc_ids.append(doc_id)
+            ftds.append(ftd)
+            statistics.doc_sizes[doc_id] = row.size
+    return PhrasePostings(doc_ids, ftds, statistics)
+
+def static_scores(db: Session, postings: list[PhrasePostings], weight: float) -> Optional[StaticScore]:
+    """Loads the PageRank of the documents matching the query"""
+    if weight <= 0:
         return None
-    return db.scalars(\
-        select(BodyPostingList)\
-        .where(BodyPostingList.term_id == term.id)\
-        .where((BodyPostingList.doc_id >= position.doc_id) & (BodyPostingList.position > position.position))\
-        .order_by(BodyPostingList.doc_id.asc())\
-    ).first()
-
-def nextBodyPhrase(db: Session, phrase: list[BodyTerm], position: Optional[BodyPostingList]) -> tuple[Optional[BodyPostingList], Optional[BodyPostingList]]:
-    if position is None:
-        return None, None
-    if len(phrase) == 1:
-        u = nextBodyTerm(db, phrase[0], position)
-        return u, u
-    v = position
-    for term in phrase:
-        v = nextBodyTerm(db, term, v)
-    if v is None:
-        return None, None
-    u = v
-    for term in phrase.reverse():
-        u = prevBodyTerm(db, term, u)
-    if v.id - u.id == len(phrase) - 1:
-        return u, v
+    doc_ids = list(set().union(*(phrase.doc_ids for phrase in postings)))
+    scores = {}
+    for i in range(0, len(doc_ids), 1000):
+        for doc_id, pagerank in db.execute(select(Document.id, Document.pagerank).where(Document.id.in_(doc_ids[i:i+1000]))):
+            scores[doc_id] = pagerank or 0.0
+    return StaticScore(weight, scores, max(scores.values(), default=0.0))
+
+def search_sql(db_session: Session, phrases: list[list[str]], top: int, pruning: bool = True, stats: Optional[dict] = None, static_weight: float = 0.0, vectorized: bool = False, dictionaries: Optional[TermDictionaries] = None, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+    # The collection statistics are maintained by the spider, a single row lookup
+    metadata = get_metadata(db_session)
+    title_statistics = FieldStatistics(K1, metadata.average_title_size, {})
+    body_statistics = FieldStatistics(K2, metadata.average_body_size, {})
+    title_dictionary = dictionaries.title if dictionaries is not None else None
+    body_dictionary = dictionaries.body if dictionaries is not None else None
+
+    # Every phrase costs a constant number of queries
+    postings = []
+    with stage('candidates'):
+        for phrase in phrases:
+            postings.append(phrase_postings(db_session, title_field, title_statistics, phrase, title_dictionary))
+            postings.append(phrase_postings(db_session, body_field, body_statistics, phrase, body_dictionary))
+    with stage('score'):
+        return rank(postings, metadata.document_count, top, pruning, stats, static_scores(db_session, postings, static_weight), vectorized, after)
+
+def rank_phrases(phrases: list[list[str]], top: int, stats: dict, after: Optional[tuple[float, int]] = None) -> list[tuple[float, int]]:
+    pruning = current_app.config['SEARCH_DYNAMIC_PRUNING']
+    static_weight = current_app.config['SEARCH_PAGERANK_WEIGHT']
+    vectorized = current_app.config['SEARCH_VECTORIZED']
+    engine = current_app.config['SEARCH_ENGINE']
+    with stage('index'):
+        index = None
+        if engine == 'memory':
+            index = get_index()
+        elif engine == 'segment':
+            # The tables are queried until the first segment is exported
+            index = get_segment()
+        if index is None:
+            dictionaries = get_dictionaries() if current_app.config['SEARCH_TERM_DICTIONARY'] else None
+    if index is None:
+        ranked = search_sql(db.session, phrases, top, pruning, stats, static_weight, vectorized, dictionaries, after)
     else:
-        return nextBodyPhrase(db, phrase, u)
-
-def nextBodyDoc(db: Session, phrase: list[BodyTerm], doc: Document) -> Optional[Document]:
-    if doc is None:
-        doc = db.scalars(\
-            select(Document)\
-            .order_by(Document.id.asc())\
-        ).first()
-        if len(phrase) == 1:
-            return db.scalars(\
-                select(Document)\
-                .join(BodyCountList, Document.body_counts)
-                .where((BodyCountList.term_id == phrase[0].id) & (BodyCountList.doc_id > doc.id-1))\
-                .order_by(Document.id.asc())\
-            ).first()
-    if len(phrase) == 1:
-        return db.scalars(\
-            select(Document)\
-            .join(BodyCountList, Document.body_counts)
-            .where((BodyCountList.term_id == phrase[0].id) & (BodyCountList.doc_id > doc.id))\
-            .order_by(Document.id.asc())\
-        ).first()
-    start, end = nextBodyPhrase(db, phrase, doc.body_postings[0])
-    while start is not None and start.document == doc:
-        start, end = nextBodyPhrase(db, phrase, end)
-    if start is None:
-        return None
-    return start.document
+        ranked = index.search(phrases, top, pruning, stats, static_weight, vectorized, after)
+    current_app.logger.debug('Scored %d of %d candidate documents, %d skipped', stats['scored'], stats['candidates'], stats['skipped'])
+    return ranked
 
-def body_ftd(db: Session, phrase: list[BodyTerm], doc: Document) -> int:
-    count = 0
-    if len(phrase) == 1:
-        return db.scalar(\
-            select(BodyCountList.count)\
-            .where((BodyCountList.term_id == phrase[0].id) & (BodyCountList.doc_id == doc.id))
-        )
-    start, end = nextBodyPhrase(db, phrase, doc.body_postings[0])
-    while start is not None and start.document == doc:
-        start, end = nextBodyPhrase(db, phrase, end)
-        count += 1
-    return count
-
-def body_Nt(db: Session, phrase: list[BodyTerm]) -> int:
-    count = 0
-    if len(phrase) == 1:
-        return db.scalar(\
-            select(func.count(BodyCountList.doc_id))\
-            .where(BodyCountList.term_id == phrase[0].id)\
-        )
-    doc = db.scalars(\
-        select(Document)\
-        .order_by(Document.id.asc())\
-    ).first()
-    while doc is not None:
-        doc = nextBodyDoc(db, phrase, doc)
-        count += 1
-    return count
-
-def search_db(query: str, top: int = 50) -> list[Document]:
+def serving_generation() -> int:
+    """Returns the generation of the index answering the queries, which may lag behind while a new one is loaded"""
+    engine = current_app.config['SEARCH_ENGINE']
+    if engine == 'memory':
+        return get_index().generation
+    if engine == 'segment':
+        segment = get_segment()
+        if segment is not None:
+            return segment.generation
+    return get_generation()
+
+def search_db(query: str, top: int = 50, stats: Optional[dict] = None) -> list[Result]:
+    if stats is None:
+        stats = {}
+    trace = start_trace(query, stats)
     parser = get_parser()
-    phrases = parser.parse_query(query)
-    db_session = db.session
-
-    k1 = 1.6
-    k2 = 1.2
-    b = 0.75
-    N: int = db_session.scalar(\
-        select(func.count())\
-        .select_from(Document)\
+    with stage('parse'):
+        phrases = parser.parse_query(query)
+    if trace is not None:
+        trace.phrases = phrases
+    words = {word for phrase in phrases for word in phrase}
+    snippet_tokens = current_app.config['SNIPPET_TOKENS']
+    if current_app.config['RESULT_CACHE_ENTRIES'] <= 0:
+        stats['cache_hit'] = False
+        return hydrate(db.session, rank_phrases(phrases, top, stats), words, snippet_tokens)
+
+    # Queries are cached on their stemmed phrases, empty phrases do not change the results
+    key = (tuple(tuple(phrase) for phrase in phrases if len(phrase) > 0), top)
+    results, stats['cache_hit'] = get_result_cache().get_or_compute(\
+        serving_generation(),\
+        key,\
+        lambda: hydrate(db.session, rank_phrases(phrases, top, stats), words, snippet_tokens)\
     )
-    lavg: float = float(db_session.scalar(\
-        select(func.avg(Document.size))\
-        .select_from(Document)\
-    ))
+    return results
 
-    results = [Result(0) for _ in range(top)]
-    
-    title_phrases: list[Phrase] = []
-    body_phrases: list[Phrase] = []
-    for phrase in phrases:
-        title_terms = []
-        body_terms = []
-        for token in phrase:
-            title_term = db_session.scalars(\
-                select(TitleTerm)\
-                .where(TitleTerm.word == token)\
-            ).first()
-            if title_term is not None:
-                title_terms.append(title_term)
-            body_term = db_session.scalars(\
-                select(BodyTerm)\
-                .where(BodyTerm.word == token)\
-            ).first()
-            if body_term is not None:
-                body_terms.append(body_term)
-        print(title_terms)
-        print(body_terms)
-        title_phrases.append(Phrase(title_terms, nextTitleDoc(db_session, title_terms, None)))
-        body_phrases.append(Phrase(body_terms, nextBodyDoc(db_session, body_terms, None)))
-
-    heapq.heapify(title_phrases)
-    heapq.heapify(body_phrases)
-
-    while title_phrases[0].next_doc is not None or body_phrases[0].next_doc is not None:
-        title_doc = title_phrases[0].next_doc
-        body_doc = body_phrases[0].next_doc
-
-        print("title")
-
-        score = 0
-        while title_doc is not None and (body_doc is None or title_doc.id <= body_doc.id) and title_phrases[0].next_doc == title_doc:
-            phrase = title_phrases[0].phrase
-            print(phrase)
-
-            # Get the number of times the phrase is present in the title
-            Nt = title_Nt(db_session, phrase)
-            ftd = title_ftd(db_session, phrase, title_doc)
-            score += math.log(N/Nt)*(ftd*(k1+1))/(ftd+k1*((1-b)+b*(title_doc.size/lavg)))
-            title_phrases[0].next_doc = nextTitleDoc(db_session, phrase, title_doc)
-            title_phrases.sort()
-        
-        while body_doc is not None and (title_doc is None or body_doc.id <= title_doc.id) and body_phrases[0].next_doc == body_doc:
-            phrase = body_phrases[0].phrase
-            print(phrase)
-
-            # Get the number of times the phrase is present in the documents
-            Nt = body_Nt(db_session, phrase)
-            ftd = body_ftd(db_session, phrase, body_doc)
-            score += math.log(N/Nt)*(ftd*(k2+1))/(ftd+k2*((1-b)+b*(body_doc.size/lavg)))
-            body_phrases[0].next_doc = nextBodyDoc(db_session, phrase, body_doc)
-            body_phrases.sort()
-
-        if score > results[0].score:
-            res = Result(score)
-            if title_doc is not None and title_doc.id <= body_doc.id:
-                res.doc = title_doc
-            else:
-                res.doc = body_doc
-            heapq.heappushpop(results, res)
-    
-    res = []
-    for result in results:
-        if result.doc is not None and result.score != 0:
-            result.populate()
-            res.append(result)
-    res.sort(reverse=True)
-    return res
\ No newline at end of file
+def encode_cursor(score: float, doc_id: int) -> str:
+    """Returns the opaque cursor of the page following the result"""
+    return base64.urlsafe_b64encode(CURSOR.pack(score, doc_id)).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    """Returns the (score, doc id) of the last result of the previous page, raises ValueError on a malformed cursor"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '='*(-len(cursor) % 4))
+    except (binascii.Error, UnicodeEncodeError):
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    if len(data) != CURSOR.size:
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    return CURSOR.unpack(data)
+
+def search_page(query: str, limit: int, after: Optional[tuple[float, int]] = None, stats: Optional[dict] = None) -> tuple[list[tuple[float, int]], set[str], Optional[str]]:
+    """Ranks a page of results without loading them
+
+    Returns the (score, doc id) pairs of the page, the query words to highlight and the cursor of the next page. The
+    page is the top-k of the documents ranked after the last result of the previous one, so the previous pages are
+    not kept or sorted again.
+    """
+    if stats is None:
+        stats = {}
+    trace = start_trace(query, stats)
+    parser = get_parser()
+    with stage('parse'):
+        phrases = parser.parse_query(query)
+    if trace is not None:
+        trace.phrases = phrases
+    words = {word for phrase in phrases for word in phrase}
+    if current_app.config['RESULT_CACHE_ENTRIES'] <= 0:
+        stats['cache_hit'] = False
+        ranked = rank_phrases(phrases, limit, stats, after)
+    else:
+        # Only the ranking is cached, the results are loaded again as they are sent
+        key = ('page', tuple(tuple(phrase) for phrase in phrases if len(phrase) > 0), limit, after)
+        ranked, stats['cache_hit'] = get_result_cache().get_or_compute(\
+            serving_generation(),\
+            key,\
+            lambda: rank_phrases(phrases, limit, stats, after)\
+        )
+    next_cursor = encode_cursor(*ranked[-1]) if len(ranked) == limit else None
+    return ranked, words, next_cursor
+
+def iter_hydrated(db: Session, ranked: list[tuple[float, int]], words: Optional[set[str]] = None, snippet_tokens: int = 30, chunk_size: int = 20) -> Iterator[Result]:
+    """Loads the results chunk by chunk, so that the first ones are sent before the last ones are read"""
+    for start in range(0, len(ranked), chunk_size):
+        yield from hydrate(db, ranked[start:start + chunk_size], words, snippet_tokens)
+
+def hydrate(db: Session, ranked: list[tuple[float, int]], words: Optional[set[str]] = None, snippet_tokens: int = 30) -> list[Result]:
+    """Loads what is displayed for a whole page of results with a constant number of queries"""
+    with stage('hydrate'):
+        doc_ids = [doc_id for _, doc_id in ranked]
+        if len(doc_ids) == 0:
+            return []
+
+        # Only the displayed columns are loaded, the HTML content of the page is left in the database
+        docs = {doc.id: doc for doc in db.execute(\
+            select(Document.id, Document.title, Document.url, Document.last_modified, Document.size, Document.text, Document.offsets)\
+            .where(Document.id.in_(doc_ids))\
+        )}
+
+        # Positions of the query words in the bodies, the snippets are cut around them
+        matches: dict[int, list[tuple[int, int]]] = {doc_id: [] for doc_id in doc_ids}
+        if words:
+            for doc_id, term_id, positions in db.execute(\
+                select(BodyPostingList.doc_id, BodyPostingList.term_id, BodyPostingList.positions)\
+                .join(BodyTerm, BodyPostingList.term)\
+                .where(BodyTerm.word.in_(words) & BodyPostingList.doc_id.in_(doc_ids))\
+            ):
+                matches[doc_id].extend((position, term_id) for position in delta_decode(positions))
+            for doc_matches in matches.values():
+                doc_matches.sort()
+
+        keywords: dict[int, list[tuple[str, int]]] = {doc_id: [] for doc_id in doc_ids}
+        for doc_id, word, count in db.execute(\
+            select(DocumentKeyword.doc_id, BodyTerm.word, DocumentKeyword.count)\
+            .join(BodyTerm, DocumentKeyword.term)\
+            .where(DocumentKeyword.doc_id.in_(doc_ids))\
+            .order_by(DocumentKeyword.doc_id.asc(), DocumentKeyword.rank.asc())\
+        ):
+            keywords[doc_id].append((word, count))
+
+        # The first child links of every result, numbered per parent so the rest of the children is never loaded
+        links = select(\
+            document_to_document.c.right_id.label('parent_id'),\
+            document_to_document.c.left_id.label('child_id'),\
+            func.row_number().over(partition_by=document_to_document.c.right_id, order_by=document_to_document.c.left_id).label('number')\
+        ).where(document_to_document.c.right_id.in_(doc_ids)).subquery()
+        children: dict[int, list[tuple[Optional[str], str]]] = {doc_id: [] for doc_id in doc_ids}
+        for parent_id, title, url in db.execute(\
+            select(links.c.parent_id, Document.title, Document.url)\
+            .join(Document, Document.id == links.c.child_id)\
+            .where(links.c.number <= CHILD_LINKS)\
+            .order_by(links.c.parent_id.asc(), links.c.number.asc())\
+        ):
+            children[parent_id].append((title, url))
+
+        return [\
+            Result(score, doc_id).populate(docs[doc_id], keywords[doc_id], children[doc_id], make_snippet(docs[doc_id].text, docs[doc_id].offsets, matches[doc_id], snippet_tokens))\
+            for score, doc_id in ranked\
+        ]
@@ -0,0 +1,309 @@
+from __future__ import annotations
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from typing import BinaryIO, Optional
+import click
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from app import db
+from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList
+from app.index import FieldIndex, InvertedIndex, PostingList, current_generation, get_generation, get_metadata, iter_posting_lists
+from app.scoring import BLOCK_SIZE, K1, K2, FieldStatistics, block_upper_bounds
+
+"""Immutable index segment written to a file and memory mapped by every worker
+
+Layout, every section starting on 8 bytes:
+    document tables     title sizes (uint32), body sizes (uint32) and PageRank (float64) indexed by doc id
+    for each field      postings: delta encoded doc ids followed by the term frequencies of every term
+                        positions: delta encoded positions of every posting
+                        position offsets (uint64): start of the positions of every posting and the end of the last one
+                        block bounds (float64): highest BM25 score of every block of postings
+                        term entries (int64): df, postings, doc ids offset, doc ids length, frequencies length,
+                        first posting, first block for every term sorted by word
+                        word offsets (uint64) and words (utf-8) of the sorted terms
+    table of contents   JSON describing the sections
+    footer              table of contents offset and length (uint64) and the magic bytes
+"""
+
+MAGIC = b'SEEKSEG1'
+FOOTER = struct.Struct('<QQ8s')
+# Number of int64 values of a term entry
+ENTRY_SIZE = 7
+
+class SegmentWriter:
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.offset = 0
+
+    def align(self) -> None:
+        padding = -self.offset % 8
+        if padding:
+            self.file.write(bytes(padding))
+            self.offset += padding
+
+    def write(self, data: bytes) -> int:
+        """Appends the data and returns its offset"""
+        offset = self.offset
+        self.file.write(data)
+        self.offset += len(data)
+        return offset
+
+    def section(self, data) -> list[int]:
+        """Writes an aligned section and returns its offset and length"""
+        self.align()
+        data = data.tobytes() if isinstance(data, array) else data
+        return [self.write(data), len(data)]
+
+    def copy(self, source: BinaryIO, length: int) -> list[int]:
+        self.align()
+        offset = self.offset
+        source.seek(0)
+        shutil.copyfileobj(source, self.file)
+        self.offset += length
+        return [offset, length]
+
+def write_field(writer: SegmentWriter, db: Session, models: tuple, N: int, statistics: FieldStatistics) -> dict:
+    """Streams the posting lists of a field into the segment and returns its table of contents"""
+    entries: list[tuple[bytes, tuple[int, ...]]] = []
+    position_offsets = array('Q')
+    bounds = array('d')
+    positions_length = 0
+    writer.align()
+    postings_offset = writer.offset
+    with tempfile.TemporaryFile() as positions:
+        for word, posting_list in iter_posting_lists(db, *models):
+            doc_ids = posting_list.doc_ids()
+            entries.append((word.encode('utf-8'), (\
+                posting_list.df,\
+                len(doc_ids),\
+                writer.write(posting_list.doc_data) - postings_offset,\
+                len(posting_list.doc_data),\
+                len(posting_list.tf_data),\
+                len(position_offsets),\
+                len(bounds),\
+            )))
+            writer.write(posting_list.tf_data)
+            position_offsets.extend(positions_length + offset for offset in posting_list.position_offsets[:-1])
+            positions.write(posting_list.position_data)
+            positions_length += len(posting_list.position_data)
+            if N > 0:
+                bounds.extend(block_upper_bounds(doc_ids, posting_list.tfs(), N, posting_list.df, statistics))
+        position_offsets.append(positions_length)
+        postings = [postings_offset, writer.offset - postings_offset]
+        positions_section = writer.copy(positions, positions_length)
+
+    # The terms are sorted by their utf-8 bytes so that the dictionary can be searched without decoding it
+    entries.sort(key=lambda entry: entry[0])
+    values = array('q')
+    word_offsets = array('Q', [0])
+    words = bytearray()
+    for word, entry in entries:
+        values.extend(entry)
+        words += word
+        word_offsets.append(len(words))
+    return {
+        'terms': len(entries),
+        'postings': postings,
+        'positions': positions_section,
+        'position_offsets': writer.section(position_offsets),
+        'bounds': writer.section(bounds),
+        'entries': writer.section(values),
+        'word_offsets': writer.section(word_offsets),
+        'words': writer.section(bytes(words)),
+    }
+
+def write_segment(db: Session, path: str) -> dict:
+    """Exports the index to a new segment file, replacing the previous one atomically, and returns its table of contents"""
+    metadata = get_metadata(db)
+    generation = current_generation(db)
+
+    max_id = db.scalar(select(func.max(Document.id))) or 0
+    title_sizes = array('I', bytes(4*(max_id+1)))
+    body_sizes = array('I', bytes(4*(max_id+1)))
+    pagerank = array('d', bytes(8*(max_id+1)))
+    for doc_id, title_size, body_size, score in db.execute(select(Document.id, Document.title_size, Document.size, Document.pagerank)):
+        title_sizes[doc_id] = title_size
+        body_sizes[doc_id] = body_size
+        pagerank[doc_id] = score or 0.0
+
+    title_statistics = FieldStatistics(K1, metadata.average_title_size, title_sizes)
+    body_statistics = FieldStatistics(K2, metadata.average_body_size, body_sizes)
+
+    # Readers keep the file they mapped, the new segment only replaces it once complete
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'wb') as file:
+            writer = SegmentWriter(file)
+            toc = {
+                'generation': generation,
+                'N': metadata.document_count,
+                'title_lavg': metadata.average_title_size,
+                'body_lavg': metadata.average_body_size,
+                'max_pagerank': max(pagerank, default=0.0),
+                'title_sizes': writer.section(title_sizes),
+                'body_sizes': writer.section(body_sizes),
+                'pagerank': writer.section(pagerank),
+                'title': write_field(writer, db, (TitleTerm, TitlePostingList), metadata.document_count, title_statistics),
+                'body': write_field(writer, db, (BodyTerm, BodyPostingList), metadata.document_count, body_statistics),
+            }
+            data = json.dumps(toc).encode('utf-8')
+            offset = writer.write(data)
+            writer.write(FOOTER.pack(offset, len(data), MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    toc['bytes'] = os.path.getsize(path)
+    return toc
+
+class SegmentPostingList(PostingList):
+    """Posting list whose compressed data are views of the mapped segment, decoded like the in-memory ones"""
+    __slots__ = ()
+
+    def __init__(self, df: int, doc_data: memoryview, tf_data: memoryview, position_data: memoryview, position_offsets: memoryview, block_max: memoryview) -> None:
+        self.df = df
+        self.doc_data = doc_data
+        self.tf_data = tf_data
+        self.position_data = position_data
+        self.position_offsets = position_offsets
+        self.block_max = block_max
+
+class TermDictionary:
+    """Sorted term dictionary of a field read from the mapped segment"""
+    def __init__(self, view: memoryview, toc: dict) -> None:
+        self.count = toc['terms']
+        self.postings = section(view, toc['postings'])
+        self.positions = section(view, toc['positions'])
+        self.position_offsets = section(view, toc['position_offsets']).cast('Q')
+        self.bounds = section(view, toc['bounds']).cast('d')
+        self.entries = section(view, toc['entries']).cast('q')
+        self.word_offsets = section(view, toc['word_offsets']).cast('Q')
+        self.words = section(view, toc['words'])
+
+    def word(self, i: int) -> bytes:
+        return bytes(self.words[self.word_offsets[i]:self.word_offsets[i+1]])
+
+    def find(self, word: str) -> Optional[int]:
+        """Returns the rank of the word in the dictionary, found by binary search"""
+        key = word.encode('utf-8')
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.word(lo) == key else None
+
+    def get(self, word: str) -> Optional[SegmentPostingList]:
+        i = self.find(word)
+        if i is None:
+            return None
+        df, count, doc_offset, doc_length, tf_length, first_posting, first_block = self.entries[i*ENTRY_SIZE:(i+1)*ENTRY_SIZE]
+        tf_offset = doc_offset + doc_length
+        blocks = -(-count // BLOCK_SIZE) if len(self.bounds) > 0 else 0
+        return SegmentPostingList(\
+            df,\
+            self.postings[doc_offset:tf_offset],\
+            self.postings[tf_offset:tf_offset + tf_length],\
+            self.positions,\
+            self.position_offsets[first_posting:first_posting + count + 1],\
+            self.bounds[first_block:first_block + blocks]\
+        )
+
+    def __len__(self) -> int:
+        return self.count
+
+def section(view: memoryview, bounds: list[int]) -> memoryview:
+    offset, length = bounds
+    return view[offset:offset + length]
+
+class Segment(InvertedIndex):
+    """Index searched straight from the memory mapped segment file, the pages are shared by all the workers"""
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Identifies the file so that a worker notices when it is replaced
+        self.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        view = memoryview(self.mapping)
+        toc_offset, toc_length, magic = FOOTER.unpack(view[len(view) - FOOTER.size:])
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an index segment')
+        toc = json.loads(bytes(view[toc_offset:toc_offset + toc_length]))
+
+        self.generation = toc['generation']
+        self.N = toc['N']
+        self.title_sizes = section(view, toc['title_sizes']).cast('I')
+        self.body_sizes = section(view, toc['body_sizes']).cast('I')
+        self.pagerank = section(view, toc['pagerank']).cast('d')
+        self.max_pagerank = toc['max_pagerank']
+        self.title = FieldIndex(FieldStatistics(K1, toc['title_lavg'], self.title_sizes))
+        self.title.terms = TermDictionary(view, toc['title'])
+        self.body = FieldIndex(FieldStatistics(K2, toc['body_lavg'], self.body_sizes))
+        self.body.terms = TermDictionary(view, toc['body'])
+
+    def nbytes(self) -> int:
+        return len(self.mapping)
+
+def get_segment_path() -> str:
+    return current_app.config['INDEX_SEGMENT_PATH'] or os.path.join(current_app.instance_path, 'index.segment')
+
+# Segment mapped by this worker, replaced when a new file is exported
+_segment: Optional[Segment] = None
+_segment_lock = threading.Lock()
+# The file is looked at again at most every INDEX_REFRESH_INTERVAL seconds
+_segment_checked_at: Optional[float] = None
+
+def get_segment() -> Optional[Segment]:
+    """Returns the segment mapped by this worker, None until the first one is exported"""
+    global _segment, _segment_checked_at
+    generation = get_generation()
+    if _segment is not None and _segment.generation == generation:
+        return _segment
+    # The segment is usually behind the database between the end of a crawl and the export
+    if _segment_checked_at is not None and time.monotonic() - _segment_checked_at < current_app.config['INDEX_REFRESH_INTERVAL']:
+        return _segment
+
+    # Only one thread looks at the file, the others keep serving the current segment
+    if _segment_lock.acquire(blocking=False):
+        try:
+            path = get_segment_path()
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if _segment_checked_at is None:
+                    current_app.logger.warning('No index segment at %s, the queries are answered from the tables until flask export-index writes it', path)
+                stat = None
+            # The file is only mapped again when it changes
+            if stat is not None and (_segment is None or _segment.file_id != (stat.st_ino, stat.st_mtime_ns, stat.st_size)):
+                _segment = Segment(path)
+            _segment_checked_at = time.monotonic()
+        finally:
+            _segment_lock.release()
+    return _segment
+
+def export_segment() -> dict:
+    return write_segment(db.session, get_segment_path())
+
+@click.command('export-index')
+def export_index_command():
+    """Write the index to a segment file memory mapped by the workers."""
+    toc = export_segment()
+    click.echo(f"Exported generation {toc['generation']}: {toc['title']['terms']} title terms, {toc['body']['terms']} body terms, {toc['bytes']} bytes")
+
+def init_app(app):
+    app.cli.add_command(export_index_command)
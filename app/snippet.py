@@ -0,0 +1,90 @@
+from __future__ import annotations
+from collections import Counter
+from typing import Optional
+
+"""Query-biased snippets cut from the stored plain text of the pages
+
+Every body token is located in the text by a uint32 packing its start (high 24 bits) and its length (low 8 bits),
+indexed by its position in the body postings, so that a snippet is cut and highlighted by slicing the text.
+"""
+
+LENGTH_BITS = 8
+MAX_LENGTH = (1 << LENGTH_BITS) - 1
+# Pages longer than this have no offsets and get no snippet
+MAX_TEXT_LENGTH = 1 << (32 - LENGTH_BITS)
+
+def locate_tokens(content: str, tokens: list[str]) -> list[tuple[int, int]]:
+    """Returns the start and end of every token in the text it was read from
+
+    Tokens rewritten by the tokenizer, such as quotes, are not found and get an empty span where the previous one ended.
+    """
+    spans = []
+    cursor = 0
+    for token in tokens:
+        start = content.find(token, cursor)
+        if start < 0:
+            spans.append((cursor, cursor))
+        else:
+            cursor = start + len(token)
+            spans.append((start, cursor))
+    return spans
+
+def pack_offset(start: int, end: int) -> int:
+    return start << LENGTH_BITS | min(end - start, MAX_LENGTH)
+
+def unpack_offset(offset: int) -> tuple[int, int]:
+    start = offset >> LENGTH_BITS
+    return start, start + (offset & MAX_LENGTH)
+
+def best_window(matches: list[tuple[int, int]], window: int) -> tuple[int, int]:
+    """Returns the first and last positions of the window of tokens matching the most query terms, then the most matches
+
+    The matches are (position, term id) pairs sorted by position.
+    """
+    best = (matches[0][0], matches[0][0])
+    best_score = (0, 0)
+    terms: Counter = Counter()
+    i = 0
+    for j, (position, term_id) in enumerate(matches):
+        terms[term_id] += 1
+        while position - matches[i][0] >= window:
+            terms[matches[i][1]] -= 1
+            if terms[matches[i][1]] == 0:
+                del terms[matches[i][1]]
+            i += 1
+        score = (len(terms), j - i + 1)
+        if score > best_score:
+            best_score = score
+            best = (matches[i][0], position)
+    return best
+
+def make_snippet(text: Optional[str], offsets: Optional[bytes], matches: list[tuple[int, int]], window: int) -> list[tuple[str, bool]]:
+    """Cuts the window of the text around the query terms, as pieces of text flagged when they are a query term"""
+    if text is None or offsets is None or len(offsets) == 0:
+        return []
+    offsets = memoryview(offsets).cast('I')
+    if len(matches) > 0:
+        first, last = best_window(matches, window)
+        # The matches are centered in the window
+        start = max(0, first - (window - (last - first + 1))//2)
+    else:
+        start = 0
+    end = min(len(offsets), start + window)
+    start = max(0, end - window)
+
+    pieces = []
+    if start > 0:
+        pieces.append(('… ', False))
+    cursor = unpack_offset(offsets[start])[0]
+    for position in sorted({position for position, _ in matches if start <= position < end}):
+        match_start, match_end = unpack_offset(offsets[position])
+        if match_start > cursor:
+            pieces.append((text[cursor:match_start], False))
+        pieces.append((text[match_start:match_end], True))
+        cursor = match_end
+    last_end = unpack_offset(offsets[end - 1])[1]
+    if last_end > cursor:
+        pieces.append((text[cursor:last_end], False))
+    if end < len(offsets):
+        pieces.append((' …', False))
+    return pieces
@@ -3,213 +3,388 @@ from __future__ import annotations
 
 # For Flask
 import click
-from flask import g
+from flask import current_app, g
 
 # For SQL manipulation
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Row, select
 from sqlalchemy.orm import Session
 from app import db
-from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, TitleCountList, BodyPostingList, BodyCountList
+from app.models import Document, document_to_document
+from app.writer import IndexWriter, PendingDocument
+from app.frontier import DONE, FAILED, Frontier, SharedFrontier
 
 # For requests
 from bs4 import BeautifulSoup
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from urllib.parse import urljoin
-import requests
+from email.utils import format_datetime, parsedate_to_datetime
+from app.fetcher import Fetcher
 
 # For text manipulation
-from collections import deque
+from collections import Counter
 import datetime
+import logging
+import multiprocessing
+import os
+import time
+from array import array
+from typing import Optional
 from app.parser import Parser, get_parser
+from app.duplicates import minhash
+from app.snippet import MAX_TEXT_LENGTH
+from app.index import bump_generation, get_metadata
+from app.segment import export_segment
 
-class UniqueQueue:
-    def __init__(self) -> None:
-        self.queue = deque()
-        self.unique_set = set()
-
-    def enqueue(self, doc: Document) -> None:
-        if doc not in self.unique_set:
-            self.queue.append(doc)
-            self.unique_set.add(doc)
-
-    def dequeue(self) -> Document:
-        if self.queue:
-            item = self.queue.popleft()
-            self.unique_set.remove(item)
-            return item
-        else:
-            raise IndexError("Queue is empty")
-
-    def is_empty(self) -> bool:
-        return len(self.queue) == 0
-
-    def __len__(self) -> int:
-        return len(self.queue)
+# Number of keywords stored with every document to be shown in the results
+TOP_KEYWORDS = 5
 
-class DocumentMap:
-    def __init__(self):
-        self.documents = {}
-        self.count = {}
-    
-    def get_document(self, url: str) -> tuple[Document, int]:
-        if url not in self.documents:
-            doc = Document(url=url)
-            self.documents[url] = doc
-            self.count[url] = 0
-        self.count[url] += 1
-        return self.documents[url], self.count[url]
-
-class TitleTermMap:
-    def __init__(self):
-        self.title_terms = {}
-
-    def get_title_term(self, word: str) -> TitleTerm:
-        if word not in self.title_terms:
-            title_term = TitleTerm(word=word)
-            self.title_terms[word] = title_term
-            return title_term
-        else:
-            return self.title_terms[word]
-        
-class BodyTermMap:
-    def __init__(self):
-        self.body_terms = {}
-
-    def get_body_term(self, word: str) -> BodyTerm:
-        if word not in self.body_terms:
-            title_term = BodyTerm(word=word)
-            self.body_terms[word] = title_term
-            return title_term
-        else:
-            return self.body_terms[word]
+# Child of the logger of the application, the parsing worker processes have no application context
+logger = logging.getLogger(__name__)
 
 class Spider:
-    def __init__(self, db: SQLAlchemy, parser: Parser) -> None:
-        self.creation_time = datetime.datetime.now()
+    def __init__(self, db: SQLAlchemy, parser: Parser, concurrency: int = 1, per_host: int = 2, delay: float = 0.0, timeout: float = 10.0, retries: int = 3, batch_size: int = 50000, parse_workers: int = 0, frontier_batch: int = 1000, frontier_retries: int = 3, checkpoint_interval: float = 60.0, shard: int = 0, shards: int = 1, lease_seconds: float = 600.0, poll_interval: float = 1.0, duplicate_similarity: Optional[float] = 0.9) -> None:
+        # Times are stored in UTC since they are sent back to the servers in If-Modified-Since
+        self.creation_time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
         self.db = db.session
         self.parser = parser
-        self.docs = DocumentMap()
-        self.title_terms = TitleTermMap()
-        self.body_terms = BodyTermMap()
-
-    def crawl(self, url: str) -> None:
-        root, _ = self.docs.get_document(url)
-        to_process = UniqueQueue()
-        to_process.enqueue(root)
-        while not to_process.is_empty():
-            doc = to_process.dequeue()
-            
-            # Request webpage
-            response = requests.get(doc.url)
-            if response.status_code != 200:
-                print(f"Failed to fetch the webpage: {doc.url}, {response.status_code}")
-                continue
-            
-            # Parse webpage
-            soup = BeautifulSoup(response.text, 'lxml')
-
-            # Attempt to grab the last modified time
-            last_modified_tag = soup.find('meta', attrs={'name': 'last-modified'})
-            if last_modified_tag is not None:
-                # Assuming last modification time is in a standard format like ISO 8601
-                last_modified_date = datetime.datetime.strptime(last_modified_tag['content'], "%a, %d %b %Y %H:%M:%S %Z")
-
-                # If the last modified date of the page is not older than the new last modified date, we abort
-                if doc.last_modified is not None and doc.last_modified < last_modified_date:
-                    continue
-                
-                doc.last_modified = last_modified_date
-            else:
-                # If we were unable to grab the last modified time we set it to the current time
-                print("Last modification time not found")
-                doc.last_modified = self.creation_time
-
-            # # Attempt the grab the page size
-            # size_tag = soup.find('meta', attrs={'name': 'size'})
-            # if size_tag is not None:
-            #     doc.size = size_tag['content']
-            # else:
-            #     print("Page size not found")
-            #     doc.size = len(response.text)
-
-            # Attemp to grab the title
-            title_tag = soup.find('title')
-            if title_tag is not None:
-                doc.title = title_tag.text
-                token_list, token_count = self.parser.parse(title_tag.text)
-                for pos, token in enumerate(token_list):
-                    title_term = self.title_terms.get_title_term(token)
-                    self.db.add(TitlePostingList(doc_id=doc.id, document=doc, term_id=title_term.id, term=title_term, position=pos))
-                for token in token_count:
-                    title_term = self.title_terms.get_title_term(token)
-                    self.db.add(TitleCountList(doc_id=doc.id, document=doc, term_id=title_term.id, term=title_term, count=token_count[token]))
-            else:
-                print("Title element not found")
-            
-            # Extract the body element
-            body_tag = soup.body
-            if body_tag is not None:
-                # Serialize the body element to get its inner HTML content
-                doc.content = str(body_tag)
-
-                token_list, token_count = self.parser.parse(body_tag.get_text())
-                doc.size = len(token_list)
-                for pos, token in enumerate(token_list):
-                    body_term = self.body_terms.get_body_term(token)
-                    self.db.add(BodyPostingList(doc_id=doc.id, document=doc, term_id=body_term.id, term=body_term, position=pos))
-                for token in token_count:
-                    body_term = self.body_terms.get_body_term(token)
-                    self.db.add(BodyCountList(doc_id=doc.id, document=doc, term_id=body_term.id, term=body_term, count=token_count[token]))
-
-                doc.size = len(token_list)
-
-                for url in [urljoin(doc.url, link.get('href')) for link in body_tag.find_all('a')]:
-                    child_doc, count = self.docs.get_document(url)
-                    doc.children.add(child_doc)
-                    child_doc.parents.add(doc)
-                    if count < 3:
-                        to_process.enqueue(child_doc)
-
-            else:
-                doc.size = 0
-                print("Body element not found")
-            
-            # print(doc)
-            # print(len(doc.title_counts))
-            # for count in doc.title_counts:
-            #     print(count)
-            # print(len(doc.body_counts))
-            # for count in doc.body_counts:
-            #     print(count)
-
-        # for doc in self.docs.documents.values():
-        #     self.db.add(doc)
-        
-        # for title_term in self.title_terms.title_terms.values():
-        #     self.db.add(title_term)
-        
-        # for body_term in self.body_terms.body_terms.values():
-        #     self.db.add(body_term)
-        
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.delay = delay
+        self.timeout = timeout
+        self.retries = retries
+        self.batch_size = batch_size
+        self.parse_workers = parse_workers
+        self.frontier_batch = frontier_batch
+        self.frontier_retries = frontier_retries
+        self.checkpoint_interval = checkpoint_interval
+        # Crawler worker sharing the frontier with the workers of the other shards when there are several
+        self.shard = shard
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        # Similarity of the shingles of a page with the ones of an indexed page above which it is a near-duplicate
+        self.duplicate_similarity = duplicate_similarity
+        self.unchanged = 0
+
+    def crawl(self, url: Optional[str], resume: bool = False) -> None:
+        """Crawls from the url, or from where the previous crawl stopped when resuming and it did not finish
+
+        A worker of a sharded crawl joins the crawl started by init_spider instead, it returns once every shard is done.
+        """
+        if self.shards > 1:
+            frontier = SharedFrontier(self.db, self.shard, self.shards, self.frontier_batch, self.frontier_retries, self.lease_seconds, self.poll_interval)
+        else:
+            frontier = Frontier(self.db, self.frontier_batch, self.frontier_retries)
+            if not start_frontier(frontier, url, resume):
+                return
+        writer = IndexWriter(self.db, get_metadata(self.db), self.batch_size, frontier.shared, self.duplicate_similarity)
+        checkpoint_time = time.monotonic()
+        # The crawl is a pipeline: pages are downloaded by threads, parsed by worker processes and written here,
+        # the number of pages waiting at each stage is bounded so a slow stage holds back the ones before it
+        parse_pool = ProcessPoolExecutor(self.parse_workers, initializer=init_parse_worker, initargs=(self.parser.tokenizer, self.parser.stem_cache_size)) if self.parse_workers > 0 else None
+        max_parsing = 2*max(1, self.parse_workers)
+        with Fetcher(self.concurrency, self.per_host, self.delay, self.timeout, self.retries) as fetcher:
+            # Frontier entries of the pages being downloaded and parsed
+            fetching: dict[Future, Row] = {}
+            parsing: dict[Future, Row] = {}
+            try:
+                while True:
+                    while len(fetching) < fetcher.concurrency and len(fetching) + len(parsing) < fetcher.concurrency + max_parsing:
+                        entry = frontier.pop()
+                        if entry is None:
+                            break
+                        fetching[fetcher.submit(entry.url, self.validators(entry))] = entry
+                    if not fetching and not parsing:
+                        if not frontier.shared:
+                            break
+                        # The other workers may still discover pages of this shard, they only see that this one is
+                        # done once it committed its pages
+                        self.checkpoint(writer, frontier)
+                        checkpoint_time = time.monotonic()
+                        if frontier.finished():
+                            break
+                        time.sleep(self.poll_interval)
+                        continue
+
+                    done, _ = wait([*fetching, *parsing], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in parsing:
+                            entry = parsing.pop(future)
+                            self.index_page(entry, future.result(), writer, frontier)
+                            continue
+
+                        entry = fetching.pop(future)
+                        response = future.result()
+                        # Pages crawled before are only downloaded again if the server reports a change
+                        if response.not_modified and entry.doc_id is not None:
+                            self.skip(entry, frontier)
+                            continue
+                        if not response.ok:
+                            logger.warning('Failed to fetch the webpage: %s, %s', entry.url, response.status or response.error)
+                            frontier.finish(entry, FAILED)
+                            continue
+                        etag = response.headers.get('ETag')
+                        # Servers ignoring If-None-Match still send the same validator for an unchanged page
+                        if entry.doc_id is not None and etag is not None and etag == entry.etag:
+                            self.skip(entry, frontier)
+                            continue
+                        args = (entry.url, response.text, response.headers.get('Last-Modified'), etag, self.creation_time)
+                        if parse_pool is not None:
+                            parsing[parse_pool.submit(parse_page, *args)] = entry
+                        else:
+                            parsed = Future()
+                            parsed.set_result(parse_page(*args, parser=self.parser))
+                            parsing[parsed] = entry
+
+                    if time.monotonic() - checkpoint_time >= self.checkpoint_interval:
+                        self.checkpoint(writer, frontier)
+                        logger.info('Checkpoint: %s', writer.report())
+                        checkpoint_time = time.monotonic()
+            finally:
+                if parse_pool is not None:
+                    parse_pool.shutdown(wait=True, cancel_futures=True)
+
+        writer.close()
+        frontier.close()
+        logger.info(writer.report())
+        logger.info('%d unchanged pages skipped', self.unchanged)
+        logger.info('%d near-duplicate pages not indexed, saving %d index rows and %d bytes of positions', writer.duplicates, writer.saved_rows, writer.saved_bytes)
+
+        # Let the search workers know that they have to reload the index, the pages of a resumed crawl may have been
+        # written by the checkpoints of the previous run. The first worker of a sharded crawl to end bumps it for all
+        if (writer.rows > 0 or resume) and get_metadata(self.db).generation < writer.generation:
+            bump_generation(self.db)
         self.db.commit()
 
-    
-def get_spider() -> Spider:
+    def checkpoint(self, writer: IndexWriter, frontier: Frontier) -> None:
+        """Commits the pages indexed so far with the state of the frontier, a resumed crawl starts from there"""
+        writer.flush()
+        frontier.write()
+        self.db.commit()
+
+    def validators(self, entry: Row) -> dict:
+        """Headers making the request conditional on the page having changed since it was stored"""
+        headers = {}
+        if entry.doc_id is not None:
+            headers['If-Modified-Since'] = format_datetime(entry.last_modified.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+            if entry.etag is not None:
+                headers['If-None-Match'] = entry.etag
+        return headers
+
+    def skip(self, entry: Row, frontier: Frontier) -> None:
+        """Keeps an unchanged page as it is stored and follows its stored links instead of parsing it again"""
+        self.unchanged += 1
+        children = self.db.scalars(\
+            select(Document.url)\
+            .join(document_to_document, document_to_document.c.left_id == Document.id)\
+            .where(document_to_document.c.right_id == entry.doc_id)\
+        )
+        for child in children:
+            frontier.discover(child, entry.priority + 1)
+        frontier.finish(entry, DONE)
+
+    def index_page(self, entry: Row, page: ParsedPage, writer: IndexWriter, frontier: Frontier) -> None:
+        # If the page is not newer than the stored version it does not have to be indexed again
+        if entry.doc_id is not None and page.dated and page.document.last_modified <= entry.last_modified:
+            self.skip(entry, frontier)
+            return
+
+        # The frontier only queues the children it has not seen in this crawl, the writer replaces the rows of a stored page
+        for child in page.links:
+            frontier.discover(child, entry.priority + 1)
+        writer.add_document(page.document, page.links)
+        frontier.finish(entry, DONE)
+
+class ParsedPage:
+    """What a parsing worker sends back, plain tokens and links instead of database objects"""
+    __slots__ = ('document', 'links', 'dated')
+
+    def __init__(self, document: PendingDocument, links: list[str], dated: bool) -> None:
+        self.document = document
+        self.links = links
+        # Whether the last modified time was reported by the server or the page rather than set to the crawl time
+        self.dated = dated
+
+# Parser of a parsing worker process, created once by init_parse_worker
+_worker_parser: Optional[Parser] = None
+
+def init_parse_worker(tokenizer: str, stem_cache_size: int) -> None:
+    global _worker_parser
+    _worker_parser = Parser(tokenizer, stem_cache_size)
+
+def parse_last_modified(value: Optional[str]) -> Optional[datetime.datetime]:
+    """Naive UTC time of an HTTP date, None when it is missing or malformed"""
+    # A malformed date must not abort the crawl, the page is then dated with the crawl time
+    try:
+        last_modified = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if last_modified.tzinfo is not None:
+        last_modified = last_modified.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return last_modified
+
+def parse_page(url: str, text: str, last_modified_header: Optional[str], etag: Optional[str], crawl_time: datetime.datetime, parser: Optional[Parser] = None) -> ParsedPage:
+    """Parses and analyzes a downloaded page, runs in the parsing worker processes"""
+    if parser is None:
+        parser = _worker_parser
+
+    # Parse webpage
+    soup = BeautifulSoup(text, 'lxml')
+
+    # Attempt to grab the last modified time, from the response headers first then from the page
+    last_modified = parse_last_modified(last_modified_header)
+    if last_modified is None:
+        last_modified_tag = soup.find('meta', attrs={'name': 'last-modified'})
+        if last_modified_tag is not None:
+            last_modified = parse_last_modified(last_modified_tag.get('content'))
+    dated = last_modified is not None
+    if not dated:
+        # If we were unable to grab the last modified time we set it to the current time
+        logger.debug('Last modification time not found: %s', url)
+        last_modified = crawl_time
+
+    # Words as they were written before being stemmed, shared by both fields
+    surfaces: dict[str, str] = {}
+
+    # Attemp to grab the title
+    title = None
+    title_tokens, title_counts = [], Counter()
+    title_tag = soup.find('title')
+    if title_tag is not None:
+        title = title_tag.text
+        title_tokens, title_counts = parser.parse(title_tag.text, surfaces)
+    else:
+        logger.debug('Title element not found: %s', url)
+
+    # Extract the body element
+    content = None
+    body_text = None
+    offsets = None
+    body_tokens, body_counts = [], Counter()
+    links = []
+    body_tag = soup.body
+    if body_tag is not None:
+        # Serialize the body element to get its inner HTML content
+        content = str(body_tag)
+        # The plain text is stored with the location of every token so that snippets are cut without parsing the HTML
+        body_text = ' '.join(body_tag.get_text().split())
+        token_offsets = array('I')
+        body_tokens, body_counts = parser.parse(body_text, surfaces, token_offsets)
+        if len(body_text) < MAX_TEXT_LENGTH:
+            offsets = token_offsets.tobytes()
+        links = list(dict.fromkeys(urljoin(url, link.get('href')) for link in body_tag.find_all('a')))
+    else:
+        logger.debug('Body element not found: %s', url)
+
+    # Precompute the forward index of the most frequent terms so that results do not have to sort the counts
+    keywords = body_counts.most_common(TOP_KEYWORDS)
+
+    # The writer compares the signature with the ones of the indexed pages to skip the near-duplicates
+    signature = minhash(body_tokens)
+
+    return ParsedPage(PendingDocument(url, title, content, body_text, offsets, last_modified, etag, title_tokens, title_counts, body_tokens, body_counts, keywords, surfaces, signature), links, dated)
+
+def start_frontier(frontier: Frontier, url: Optional[str], resume: bool) -> bool:
+    """Queues the start page of a new crawl, or the pages left by the previous one, returns False if there is neither"""
+    if resume and frontier.unfinished():
+        logger.info('Resuming the previous crawl, %d pages queued', frontier.resume())
+    elif url is not None:
+        frontier.reset(url)
+    else:
+        logger.warning('No crawl to resume')
+        return False
+    return True
+
+def get_spider(concurrency: Optional[int] = None, workers: Optional[int] = None, shard: int = 0, shards: int = 1) -> Spider:
     if not 'spider' in g:
-        g.spider = Spider(db, get_parser())
+        config = current_app.config
+        if workers is None:
+            workers = config['SPIDER_PARSE_WORKERS'] if config['SPIDER_PARSE_WORKERS'] is not None else os.cpu_count() or 1
+        g.spider = Spider(\
+            db,\
+            get_parser(),\
+            concurrency if concurrency is not None else config['SPIDER_CONCURRENCY'],\
+            config['SPIDER_PER_HOST'],\
+            config['SPIDER_DELAY'],\
+            config['SPIDER_TIMEOUT'],\
+            config['SPIDER_RETRIES'],\
+            config['SPIDER_BATCH_SIZE'],\
+            workers,\
+            config['SPIDER_FRONTIER_BATCH'],\
+            config['SPIDER_FRONTIER_RETRIES'],\
+            config['SPIDER_CHECKPOINT_INTERVAL'],\
+            shard,\
+            shards,\
+            config['SPIDER_LEASE_SECONDS'],\
+            config['SPIDER_POLL_INTERVAL'],\
+            config['SPIDER_DUPLICATE_SIMILARITY']\
+        )
     
     return g.spider
 
-def init_spider(url: str):
-    spider = get_spider()
+def crawl_shard(shard: int, shards: int, concurrency: Optional[int], workers: Optional[int], resume: bool) -> None:
+    """Runs the crawler worker of a shard, in a process of its own"""
+    from app import app
+    with app.app_context():
+        # The connections of the parent process are left to it
+        db.engine.dispose(close=False)
+        get_spider(concurrency, workers, shard, shards).crawl(None, resume)
+
+def init_spider(url: Optional[str], concurrency: Optional[int] = None, workers: Optional[int] = None, resume: bool = False, shards: Optional[int] = None, shard_ids: Optional[list[int]] = None):
+    """Crawls from the url, or resumes the previous crawl, with one crawler worker process per shard when there are
+    several. Without a url nor resume, the workers of the given shards join the crawl started elsewhere."""
+    config = current_app.config
+    if shards is None:
+        shards = config['SPIDER_SHARDS']
+    if shards == 1:
+        # https://www.cse.ust.hk/~kwtleung/COMP4321/testpage.htm
+        get_spider(concurrency, workers).crawl(url, resume)
+    else:
+        if url is not None or resume:
+            frontier = Frontier(db.session)
+            if not start_frontier(frontier, url, resume):
+                return
+            frontier.write()
+            # The workers share the statistics row, it is created before they start
+            get_metadata(db.session)
+            db.session.commit()
+        shard_ids = list(shard_ids) if shard_ids else list(range(shards))
+        # The cores are split between the parsing processes of the workers
+        if workers is None and config['SPIDER_PARSE_WORKERS'] is None:
+            workers = max(1, (os.cpu_count() or 1)//len(shard_ids))
+        processes = [multiprocessing.Process(target=crawl_shard, args=(shard, shards, concurrency, workers, resume), name=f'spider-{shard}') for shard in shard_ids]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [process.name for process in processes if process.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError(f'Crawler workers {", ".join(failed)} failed')
 
-    # https://www.cse.ust.hk/~kwtleung/COMP4321/testpage.htm
-    spider.crawl(url)
+    # The workers using the segment engine switch to the new segment once it replaces the previous one
+    if current_app.config['SEARCH_ENGINE'] == 'segment':
+        export_segment()
 
 @click.command('init-spider')
-@click.argument('url')
-def init_spider_command(url: str):
+@click.argument('url', required=False)
+@click.option('--concurrency', type=click.IntRange(min=1), default=None, help='Number of pages downloaded at the same time.')
+@click.option('--workers', type=click.IntRange(min=0), default=None, help='Number of processes parsing the pages, 0 parses them in the main process.')
+@click.option('--resume', is_flag=True, help='Continue the previous crawl from its last checkpoint if it did not finish.')
+@click.option('--shards', type=click.IntRange(min=1), default=None, help='Number of crawler workers sharing the crawl, each one crawls the hosts of its shard.')
+@click.option('--shard', 'shard_ids', type=click.IntRange(min=0), multiple=True, help='Shard crawled by a worker started here, all of them by default. Can be repeated.')
+def init_spider_command(url: Optional[str], concurrency: Optional[int], workers: Optional[int], resume: bool, shards: Optional[int], shard_ids: tuple[int, ...]):
     """Crawl base website and index it in the database."""
-    init_spider(url)
+    if url is None and not resume and len(shard_ids) == 0:
+        raise click.UsageError('A URL is needed unless the previous crawl is resumed, or joined with --shard.')
+    if shards is None:
+        shards = current_app.config['SPIDER_SHARDS']
+    if any(shard >= shards for shard in shard_ids):
+        raise click.UsageError(f'The shards are numbered from 0 to {shards - 1}.')
+    # SQLite has a single writer, the workers would wait on each other
+    if shards > 1 and db.engine.dialect.name != 'postgresql':
+        raise click.UsageError('Several crawler workers need a PostgreSQL database.')
+    init_spider(url, concurrency, workers, resume, shards, shard_ids)
     click.echo('Initialized spider')
 
 def init_app(app):
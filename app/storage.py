@@ -0,0 +1,51 @@
+from __future__ import annotations
+import click
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+from app import db
+from app.models import Document
+
+"""On-disk size of the index tables, to follow the effect of schema changes"""
+
+class TableSize:
+    def __init__(self, name: str, rows: int, table_bytes: int, index_bytes: int) -> None:
+        self.name = name
+        self.rows = rows
+        self.table_bytes = table_bytes
+        self.index_bytes = index_bytes
+
+def table_sizes(db: Session) -> list[TableSize]:
+    """Returns the size of the data and of the indexes of every table of the schema, by decreasing total size"""
+    dialect = db.get_bind().dialect.name
+    if dialect == 'sqlite':
+        # The dbstat virtual table gives the pages of every b-tree, the indexes are found in sqlite_master
+        pages = dict(db.execute(text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).all())
+    sizes = []
+    for table in Document.metadata.sorted_tables:
+        rows = db.scalar(select(func.count()).select_from(table))
+        if dialect == 'postgresql':
+            table_bytes, index_bytes = db.execute(\
+                text('SELECT pg_table_size(CAST(:name AS regclass)), pg_indexes_size(CAST(:name AS regclass))'),\
+                {'name': table.name}\
+            ).one()
+        elif dialect == 'sqlite':
+            indexes = db.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name"), {'name': table.name}).scalars()
+            table_bytes = pages.get(table.name, 0)
+            index_bytes = sum(pages.get(index, 0) for index in indexes)
+        else:
+            raise click.ClickException(f'Table sizes are not available for {dialect}')
+        sizes.append(TableSize(table.name, rows, table_bytes, index_bytes))
+    sizes.sort(key=lambda size: size.table_bytes + size.index_bytes, reverse=True)
+    return sizes
+
+@click.command('table-sizes')
+def table_sizes_command():
+    """Print the rows, data and index size of every table."""
+    sizes = table_sizes(db.session)
+    click.echo(f'{"table":<28} {"rows":>12} {"data":>12} {"indexes":>12}')
+    for size in sizes:
+        click.echo(f'{size.name:<28} {size.rows:>12} {size.table_bytes:>12} {size.index_bytes:>12}')
+    click.echo(f'{"total":<28} {sum(size.rows for size in sizes):>12} {sum(size.table_bytes for size in sizes):>12} {sum(size.index_bytes for size in sizes):>12}')
+
+def init_app(app):
+    app.cli.add_command(table_sizes_command)
@@ -0,0 +1,203 @@
+from __future__ import annotations
+import heapq
+import re
+import threading
+from bisect import bisect_left, insort
+from typing import Optional
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app import db
+from app.models import TitleTerm, BodyTerm
+from app.index import get_generation
+
+"""Query completions ranked by document frequency, answered from a table of the best words of every prefix"""
+
+# Prefixes matching more words than this have their completions precomputed, the others are scanned
+SCAN_LIMIT = 64
+# Sorts after every character so that prefix + MAX_CHAR bounds the words starting with the prefix
+MAX_CHAR = '\U0010ffff'
+# Last word of the query, the one being typed
+LAST_WORD_PATTERN = re.compile(r'(\w*)$')
+
+class Suggestions:
+    """Words of the vocabulary as they were written, with the top completions of the prefixes matching many words
+
+    The terms of both fields are merged on their stem, the weight of a word is its title and body document
+    frequencies. A new generation only reloads the terms stamped with it by the spider and recomputes the
+    prefixes whose completions they change.
+    """
+    def __init__(self, generation: int, limit: int) -> None:
+        self.generation = generation
+        self.limit = limit
+        # Stem to its displayed word, title df and body df
+        self.terms: dict[str, tuple[str, int, int]] = {}
+        self.weights: dict[str, int] = {}
+        self.words: list[str] = []
+        self.top: dict[str, list[str]] = {}
+
+    @classmethod
+    def build(cls, db: Session, generation: int, limit: int) -> Suggestions:
+        suggestions = cls(generation, limit)
+        suggestions.load_terms(db, None)
+        suggestions.rank_terms()
+        return suggestions
+
+    def rank_terms(self) -> None:
+        """Builds the completions of every prefix from the terms"""
+        self.weights = {}
+        for surface, title_df, body_df in self.terms.values():
+            if title_df + body_df > 0:
+                self.weights[surface] = self.weights.get(surface, 0) + title_df + body_df
+        self.words = sorted(self.weights)
+        self.top = {}
+        self.rank_prefix('', 0, len(self.words), True)
+
+    def load_terms(self, db: Session, since: Optional[int]) -> set[str]:
+        """Reads the terms changed after the since generation, or all of them, and returns their stems"""
+        changed = set()
+        for field, term_model in enumerate((TitleTerm, BodyTerm)):
+            query = select(term_model.word, term_model.surface, term_model.df)
+            if since is not None:
+                query = query.where(term_model.generation > since)
+            for stem, surface, df in db.execute(query):
+                previous_surface, title_df, body_df = self.terms.get(stem, (None, 0, 0))
+                # The body keeps the word it was first indexed with, titles only name the terms missing from the bodies
+                if previous_surface is None or field == 1 and surface is not None:
+                    previous_surface = surface if surface is not None else stem
+                self.terms[stem] = (previous_surface, df, body_df) if field == 0 else (previous_surface, title_df, df)
+                changed.add(stem)
+        return changed
+
+    def update(self, db: Session, generation: int) -> Suggestions:
+        """Returns a copy with the terms changed since this generation applied, this one keeps answering meanwhile"""
+        suggestions = Suggestions(generation, self.limit)
+        suggestions.terms = dict(self.terms)
+        suggestions.weights = dict(self.weights)
+        suggestions.words = list(self.words)
+        suggestions.top = dict(self.top)
+
+        dirty = set()
+        for stem in suggestions.load_terms(db, self.generation):
+            # Stems displayed with the same word add up, a term first seen in a title may also change of word
+            # once it appears in a body
+            if stem in self.terms:
+                surface, title_df, body_df = self.terms[stem]
+                dirty.update(suggestions.set_weight(surface, suggestions.weights.get(surface, 0) - title_df - body_df))
+            surface, title_df, body_df = suggestions.terms[stem]
+            dirty.update(suggestions.set_weight(surface, suggestions.weights.get(surface, 0) + title_df + body_df))
+
+        # Deeper prefixes first so that their parents are merged from up to date completions
+        for prefix in sorted(dirty, key=len, reverse=True):
+            lo, hi = suggestions.prefix_range(prefix)
+            suggestions.rank_prefix(prefix, lo, hi, False)
+        return suggestions
+
+    def set_weight(self, word: str, weight: int) -> list[str]:
+        """Changes the weight of a word and returns the prefixes whose completions have to be recomputed"""
+        old = self.weights.get(word)
+        if weight <= 0:
+            if old is None:
+                return []
+            del self.weights[word]
+            del self.words[bisect_left(self.words, word)]
+        else:
+            if old is None:
+                insort(self.words, word)
+            self.weights[word] = weight
+
+        dirty = []
+        for end in range(1, len(word) + 1):
+            prefix = word[:end]
+            top = self.top.get(prefix)
+            if top is None:
+                lo, hi = self.prefix_range(prefix)
+                # The prefix just became too common to be scanned
+                if hi - lo > SCAN_LIMIT:
+                    dirty.append(prefix)
+            elif word in top or weight > 0 and (len(top) < self.limit or top[-1] not in self.weights or self.key(word) < self.key(top[-1])):
+                # The last completion may have been removed by the same update, the prefix is recomputed anyway
+                dirty.append(prefix)
+        return dirty
+
+    def key(self, word: str) -> tuple[int, str]:
+        return -self.weights[word], word
+
+    def best(self, words) -> list[str]:
+        return heapq.nsmallest(self.limit, words, key=self.key)
+
+    def prefix_range(self, prefix: str) -> tuple[int, int]:
+        lo = bisect_left(self.words, prefix)
+        return lo, bisect_left(self.words, prefix + MAX_CHAR, lo)
+
+    def rank_prefix(self, prefix: str, lo: int, hi: int, rebuild: bool) -> list[str]:
+        """Computes the completions of a prefix from the ones of its children, rebuilding them first or reusing the table"""
+        if hi - lo <= SCAN_LIMIT:
+            self.top.pop(prefix, None)
+            return self.best(self.words[lo:hi])
+
+        depth = len(prefix)
+        candidates = []
+        i = lo
+        # The prefix itself sorts before all of its extensions
+        if self.words[i] == prefix:
+            candidates.append(prefix)
+            i += 1
+        while i < hi:
+            child = self.words[i][:depth + 1]
+            j = bisect_left(self.words, child + MAX_CHAR, i, hi)
+            if rebuild:
+                candidates.extend(self.rank_prefix(child, i, j, True))
+            elif child in self.top:
+                candidates.extend(self.top[child])
+            else:
+                candidates.extend(self.best(self.words[i:j]))
+            i = j
+        top = self.best(candidates)
+        if depth > 0:
+            self.top[prefix] = top
+        return top
+
+    def suggest(self, prefix: str, limit: Optional[int] = None) -> list[str]:
+        """Returns the most frequent words starting with the prefix"""
+        limit = self.limit if limit is None else min(limit, self.limit)
+        if len(prefix) == 0:
+            return []
+        top = self.top.get(prefix)
+        if top is None:
+            lo, hi = self.prefix_range(prefix)
+            top = self.best(self.words[lo:hi])
+        return top[:limit]
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+# The suggestions are held per worker process and patched when the index generation changes
+_suggestions: Optional[Suggestions] = None
+_suggestions_lock = threading.Lock()
+
+def get_suggestions() -> Suggestions:
+    global _suggestions
+    generation = get_generation()
+    if _suggestions is not None and _suggestions.generation == generation:
+        return _suggestions
+
+    # Only one thread updates, the others keep using the previous suggestions until they are swapped
+    if _suggestions_lock.acquire(blocking=_suggestions is None):
+        try:
+            if _suggestions is None:
+                _suggestions = Suggestions.build(db.session, generation, current_app.config['SUGGEST_LIMIT'])
+            elif _suggestions.generation != generation:
+                _suggestions = _suggestions.update(db.session, generation)
+        finally:
+            _suggestions_lock.release()
+    return _suggestions
+
+def suggest_query(query: str, limit: Optional[int] = None) -> list[str]:
+    """Completes the last word of the query, the words before it are kept as they were typed"""
+    match = LAST_WORD_PATTERN.search(query)
+    prefix = match.group(1).lower()
+    if not prefix.isalpha():
+        return []
+    head = query[:match.start(1)]
+    return [head + word for word in get_suggestions().suggest(prefix, limit)]
@@ -0,0 +1,462 @@
+from __future__ import annotations
+import csv
+import datetime
+import io
+import time
+from collections import Counter
+from typing import Optional
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from app.models import Document, TitleTerm, BodyTerm, TitlePostingList, BodyPostingList, DocumentKeyword, IndexMetadata, FrontierLink, SignatureBand, document_to_document
+from app.index import delta_encode
+from app.duplicates import band_keys, similarity
+
+"""Bulk writer streaming the rows produced by the spider into the index tables"""
+
+# Last modified time of the pages to download again whatever the server says, older than any page
+UNKNOWN_TIME = datetime.datetime(1970, 1, 1)
+
+def chunks(values: list, size: int = 1000):
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+class TermMap:
+    """Maps the words of one field to their term ids, new words are inserted in bulk when the writer flushes
+
+    Every term written is stamped with the generation the crawl commits, so that the workers only reload those.
+    """
+    def __init__(self, term_model, generation: int = 0) -> None:
+        self.term_model = term_model
+        self.generation = generation
+        self.ids: dict[str, int] = {}
+        # Document frequency increments not written yet
+        self.df: Counter = Counter()
+
+    def resolve(self, db: Session, words: set[str], surfaces: dict[str, str]) -> None:
+        missing = [word for word in words if word not in self.ids]
+        if len(missing) == 0:
+            return
+        # Terms may already exist if the database was indexed by a previous crawl
+        for words in chunks(missing):
+            for term_id, word in db.execute(select(self.term_model.id, self.term_model.word).where(self.term_model.word.in_(words))):
+                self.ids[word] = term_id
+        new = [word for word in missing if word not in self.ids]
+        if len(new) > 0:
+            for term_id, word in db.execute(\
+                insert(self.term_model).returning(self.term_model.id, self.term_model.word),\
+                [{'word': word, 'df': 0, 'surface': surfaces.get(word), 'generation': self.generation} for word in new]\
+            ):
+                self.ids[word] = term_id
+
+    def write_df(self, db: Session) -> None:
+        if len(self.df) == 0:
+            return
+        table = self.term_model.__table__
+        db.execute(\
+            update(table)\
+            .where(table.c.id == bindparam('term_id'))\
+            .values(df=table.c.df + bindparam('increment'), generation=self.generation),\
+            [{'term_id': self.ids[word], 'increment': increment} for word, increment in self.df.items()]\
+        )
+        self.df.clear()
+
+    def remove(self, db: Session, posting_model, doc_ids: list[int]) -> None:
+        """Deletes the postings of the documents and takes them out of the document frequencies"""
+        decrements = db.execute(\
+            select(posting_model.term_id, func.count())\
+            .where(posting_model.doc_id.in_(doc_ids))\
+            .group_by(posting_model.term_id)\
+        ).all()
+        if len(decrements) > 0:
+            table = self.term_model.__table__
+            db.execute(\
+                update(table)\
+                .where(table.c.id == bindparam('term_id'))\
+                .values(df=table.c.df - bindparam('decrement'), generation=self.generation),\
+                [{'term_id': term_id, 'decrement': decrement} for term_id, decrement in decrements]\
+            )
+        db.execute(delete(posting_model.__table__).where(posting_model.__table__.c.doc_id.in_(doc_ids)))
+
+class SharedTermMap(TermMap):
+    """Term map of a crawler worker sharing the term tables with other workers
+
+    New words are inserted in short transactions of their own, committed at once, so a word found by two workers gets
+    a single id and no worker holds locks on the terms until its checkpoint. The document frequencies are computed
+    from the postings once every worker is done. Needs PostgreSQL.
+    """
+    def resolve(self, db: Session, words: set[str], surfaces: dict[str, str]) -> None:
+        # Sorted so that two workers inserting the same words lock them in the same order
+        missing = sorted(word for word in words if word not in self.ids)
+        if len(missing) == 0:
+            return
+        table = self.term_model.__table__
+        with db.get_bind().begin() as connection:
+            for words in chunks(missing):
+                connection.execute(\
+                    pg_insert(table)\
+                    .values([{'word': word, 'df': 0, 'surface': surfaces.get(word), 'generation': self.generation} for word in words])\
+                    .on_conflict_do_nothing(index_elements=['word'])\
+                )
+        for words in chunks(missing):
+            for term_id, word in db.execute(select(self.term_model.id, self.term_model.word).where(self.term_model.word.in_(words))):
+                self.ids[word] = term_id
+
+    def write_df(self, db: Session) -> None:
+        self.df.clear()
+
+    def remove(self, db: Session, posting_model, doc_ids: list[int]) -> None:
+        db.execute(delete(posting_model.__table__).where(posting_model.__table__.c.doc_id.in_(doc_ids)))
+
+    def refresh_df(self, db: Session, posting_model) -> None:
+        """Counts the postings of every term, the terms whose document frequency changed are stamped with the generation"""
+        table = self.term_model.__table__
+        postings = posting_model.__table__
+        counts = select(table.c.id, func.count(postings.c.term_id).label('df'))\
+            .select_from(table.outerjoin(postings, postings.c.term_id == table.c.id))\
+            .group_by(table.c.id)\
+            .subquery()
+        db.execute(\
+            update(table)\
+            .where(table.c.id == counts.c.id, table.c.df != counts.c.df)\
+            .values(df=counts.c.df, generation=self.generation)\
+        )
+
+def posting_rows(doc_id: int, term_ids: dict[str, int], tokens: list[str]) -> list[tuple[int, int, int, bytes]]:
+    """Returns the (term id, doc id, tf, positions) row of every term of a field of the document"""
+    positions: dict[str, list[int]] = {}
+    for position, token in enumerate(tokens):
+        positions.setdefault(token, []).append(position)
+    return [(term_ids[token], doc_id, len(token_positions), delta_encode(token_positions)) for token, token_positions in positions.items()]
+
+def positions_size(tokens: list[str]) -> int:
+    """Returns the bytes taken by the positions of the posting rows of a field of the document"""
+    positions: dict[str, list[int]] = {}
+    for position, token in enumerate(tokens):
+        positions.setdefault(token, []).append(position)
+    return sum(len(delta_encode(token_positions)) for token_positions in positions.values())
+
+class PendingDocument:
+    __slots__ = ('url', 'title', 'content', 'text', 'offsets', 'last_modified', 'etag', 'size', 'title_size', 'title_tokens', 'title_counts', 'body_tokens', 'body_counts', 'keywords', 'surfaces', 'signature')
+
+    def __init__(self, url: str, title: Optional[str], content: Optional[str], text: Optional[str], offsets: Optional[bytes], last_modified: datetime.datetime, etag: Optional[str], title_tokens: list[str], title_counts: Counter, body_tokens: list[str], body_counts: Counter, keywords: list[tuple[str, int]], surfaces: Optional[dict[str, str]] = None, signature: Optional[bytes] = None) -> None:
+        self.url = url
+        self.title = title
+        self.content = content
+        self.text = text
+        self.offsets = offsets
+        self.last_modified = last_modified
+        self.etag = etag
+        self.size = len(body_tokens)
+        self.title_size = len(title_tokens)
+        self.title_tokens = title_tokens
+        self.title_counts = title_counts
+        self.body_tokens = body_tokens
+        self.body_counts = body_counts
+        self.keywords = keywords
+        # Unstemmed word of every stem of the page
+        self.surfaces = surfaces if surfaces is not None else {}
+        # MinHash of the body tokens, None when the body is too short to have one
+        self.signature = signature
+
+    def rows(self) -> int:
+        return len(self.title_counts) + len(self.body_counts) + len(self.keywords) + 1
+
+class IndexWriter:
+    """Buffers the indexed pages as plain rows and writes them in batches of batch_size rows
+
+    Only the pages of the current batch and the vocabulary are held in memory. Pages already stored keep their id
+    and only their own rows are replaced, links to pages not indexed yet wait in the frontier link table.
+
+    When the writer is shared by several crawler workers, the statistics of the collection and the document
+    frequencies are left alone until every worker is done, see refresh_statistics.
+
+    Unless duplicate_similarity is None, a page whose shingles are at least that similar to the ones of an indexed page
+    is stored as its near-duplicate, without any posting or keyword. The workers of a sharded crawl only see the pages
+    committed by the others, they may both index two near-duplicates.
+    """
+    def __init__(self, db: Session, statistics: IndexMetadata, batch_size: int = 50000, shared: bool = False, duplicate_similarity: Optional[float] = 0.9) -> None:
+        self.db = db
+        self.statistics = statistics
+        self.batch_size = batch_size
+        self.shared = shared
+        self.duplicate_similarity = duplicate_similarity
+        self.copy = db.get_bind().dialect.name == 'postgresql'
+        # The spider bumps the generation once the crawl is written
+        self.generation = statistics.generation + 1
+        term_map = SharedTermMap if shared else TermMap
+        self.title_terms = term_map(TitleTerm, self.generation)
+        self.body_terms = term_map(BodyTerm, self.generation)
+        # Ids of the stored pages of the current batch and of the pages they link to
+        self.doc_ids: dict[str, int] = {}
+        self.documents: list[PendingDocument] = []
+        self.buffered = 0
+        self.links: list[tuple[str, str]] = []
+
+        self.rows = 0
+        self.elapsed = 0.0
+        # Near-duplicate pages and the index rows and position bytes they would have taken
+        self.duplicates = 0
+        self.saved_rows = 0
+        self.saved_bytes = 0
+
+    def add_document(self, document: PendingDocument, children: list[str]) -> None:
+        self.documents.append(document)
+        for child in children:
+            self.links.append((document.url, child))
+        self.buffered += document.rows() + len(children)
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def lookup(self, urls: set[str]) -> None:
+        """Adds the stored pages among the urls to doc_ids"""
+        missing = [url for url in urls if url not in self.doc_ids]
+        for batch in chunks(missing):
+            for doc_id, url in self.db.execute(select(Document.id, Document.url).where(Document.url.in_(batch))):
+                self.doc_ids[url] = doc_id
+
+    def write(self, table, columns: tuple[str, ...], rows: list[tuple]) -> None:
+        if len(rows) == 0:
+            return
+        self.rows += len(rows)
+        if self.copy:
+            # COPY is the fastest way to load rows in Postgres, it is only used for numeric and binary rows so no
+            # escaping is needed, binary values are sent in the hex format of bytea
+            if any(isinstance(value, bytes) for value in rows[0]):
+                rows = [tuple('\\x' + value.hex() if isinstance(value, bytes) else value for value in row) for row in rows]
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            cursor = self.db.connection().connection.cursor()
+            try:
+                cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+            finally:
+                cursor.close()
+        else:
+            self.db.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+
+    def flush(self) -> None:
+        start = time.perf_counter()
+        # A page fetched twice is only indexed in its last version
+        documents = list({document.url: document for document in self.documents}.values())
+        self.documents = []
+        self.buffered = 0
+        self.doc_ids = {}
+        self.lookup({document.url for document in documents})
+
+        new = [document for document in documents if document.url not in self.doc_ids]
+        changed = [document for document in documents if document.url in self.doc_ids]
+        if len(changed) > 0:
+            self.remove([self.doc_ids[document.url] for document in changed])
+            self.db.execute(\
+                update(Document.__table__)\
+                .where(Document.__table__.c.id == bindparam('doc_id'))\
+                .values(\
+                    title=bindparam('new_title'),\
+                    content=bindparam('new_content'),\
+                    text=bindparam('new_text'),\
+                    offsets=bindparam('new_offsets'),\
+                    last_modified=bindparam('new_last_modified'),\
+                    etag=bindparam('new_etag'),\
+                    size=bindparam('new_size'),\
+                    title_size=bindparam('new_title_size'),\
+                    signature=bindparam('new_signature'),\
+                    duplicate_of_id=None,\
+                ),\
+                [{\
+                    'doc_id': self.doc_ids[document.url],\
+                    'new_title': document.title,\
+                    'new_content': document.content,\
+                    'new_text': document.text,\
+                    'new_offsets': document.offsets,\
+                    'new_last_modified': document.last_modified,\
+                    'new_etag': document.etag,\
+                    'new_size': document.size,\
+                    'new_title_size': document.title_size,\
+                    'new_signature': document.signature,\
+                } for document in changed]\
+            )
+            self.rows += len(changed)
+        if len(new) > 0:
+            statement = insert(Document)
+            if self.shared:
+                # Another worker whose lease on the page expired may have inserted it since the lookup, it is left to it
+                statement = pg_insert(Document).on_conflict_do_nothing(index_elements=['url'])
+            for doc_id, url in self.db.execute(\
+                statement.returning(Document.id, Document.url),\
+                [{\
+                    'url': document.url,\
+                    'title': document.title,\
+                    'content': document.content,\
+                    'text': document.text,\
+                    'offsets': document.offsets,\
+                    'last_modified': document.last_modified,\
+                    'etag': document.etag,\
+                    'size': document.size,\
+                    'title_size': document.title_size,\
+                    'signature': document.signature,\
+                } for document in new]\
+            ):
+                self.doc_ids[url] = doc_id
+            skipped = {document.url for document in new if document.url not in self.doc_ids}
+            if len(skipped) > 0:
+                documents = [document for document in documents if document.url not in skipped]
+                self.links = [(parent, child) for parent, child in self.links if parent not in skipped]
+            self.rows += len(new) - len(skipped)
+
+        # The near-duplicates are stored with their links only
+        duplicates = self.find_duplicates(documents)
+        if len(duplicates) > 0:
+            self.db.execute(\
+                update(Document.__table__)\
+                .where(Document.__table__.c.id == bindparam('doc_id'))\
+                .values(duplicate_of_id=bindparam('original_id')),\
+                [{'doc_id': self.doc_ids[url], 'original_id': original_id} for url, original_id in duplicates.items()]\
+            )
+            for document in documents:
+                if document.url in duplicates:
+                    self.duplicates += 1
+                    self.saved_rows += len(document.title_counts) + len(document.body_counts) + len(document.keywords)
+                    self.saved_bytes += positions_size(document.title_tokens) + positions_size(document.body_tokens)
+        indexed = [document for document in documents if document.url not in duplicates]
+
+        surfaces: dict[str, str] = {}
+        for document in indexed:
+            for stem, word in document.surfaces.items():
+                surfaces.setdefault(stem, word)
+        self.title_terms.resolve(self.db, {token for document in indexed for token in document.title_counts}, surfaces)
+        self.body_terms.resolve(self.db, {token for document in indexed for token in document.body_counts}, surfaces)
+
+        title_postings = []
+        body_postings = []
+        keywords = []
+        for document in indexed:
+            doc_id = self.doc_ids[document.url]
+            title_ids = self.title_terms.ids
+            body_ids = self.body_terms.ids
+            title_postings.extend(posting_rows(doc_id, title_ids, document.title_tokens))
+            body_postings.extend(posting_rows(doc_id, body_ids, document.body_tokens))
+            keywords.extend((doc_id, body_ids[token], rank, count) for rank, (token, count) in enumerate(document.keywords))
+            self.title_terms.df.update(document.title_counts.keys())
+            self.body_terms.df.update(document.body_counts.keys())
+
+            if not self.shared:
+                self.statistics.document_count += 1
+                self.statistics.body_size += document.size
+                self.statistics.title_size += document.title_size
+
+        self.write(TitlePostingList.__table__, ('term_id', 'doc_id', 'tf', 'positions'), title_postings)
+        self.write(BodyPostingList.__table__, ('term_id', 'doc_id', 'tf', 'positions'), body_postings)
+        self.write(DocumentKeyword.__table__, ('doc_id', 'term_id', 'rank', 'count'), keywords)
+        self.title_terms.write_df(self.db)
+        self.body_terms.write_df(self.db)
+
+        # Children are on the left side of the association, parents on the right. The links of the pages indexed
+        # earlier to the pages of this batch were waiting in the frontier link table
+        links = []
+        urls = [document.url for document in documents]
+        for batch in chunks(urls):
+            for url, parent_id in self.db.execute(select(FrontierLink.url, FrontierLink.parent_id).where(FrontierLink.url.in_(batch))):
+                links.append((self.doc_ids[url], parent_id))
+            self.db.execute(delete(FrontierLink.__table__).where(FrontierLink.__table__.c.url.in_(batch)))
+        self.lookup({child for _, child in self.links})
+        pending = []
+        for parent, child in dict.fromkeys(self.links):
+            if child in self.doc_ids:
+                links.append((self.doc_ids[child], self.doc_ids[parent]))
+            else:
+                pending.append({'url': child, 'parent_id': self.doc_ids[parent]})
+        self.links = []
+        self.write(document_to_document, ('left_id', 'right_id'), links)
+        if len(pending) > 0:
+            self.db.execute(insert(FrontierLink.__table__), pending)
+
+        self.elapsed += time.perf_counter() - start
+
+    def find_duplicates(self, documents: list[PendingDocument]) -> dict[str, int]:
+        """Returns the id of the indexed page every near-duplicate of the batch is a copy of, by url
+
+        The bands of the signatures of the other pages are written so that the next pages are compared to them.
+        """
+        if self.duplicate_similarity is None:
+            return {}
+        keys = {document.url: band_keys(document.signature) for document in documents if document.signature is not None}
+        # Indexed pages sharing a band with a page of the batch, then the pages of the batch are added as they are indexed
+        candidates: dict[int, list[int]] = {}
+        signatures: dict[int, bytes] = {}
+        for batch in chunks(sorted({key for document_keys in keys.values() for key in document_keys})):
+            for key, doc_id, signature in self.db.execute(\
+                select(SignatureBand.key, SignatureBand.doc_id, Document.signature)\
+                .join(Document, Document.id == SignatureBand.doc_id)\
+                .where(SignatureBand.key.in_(batch))\
+            ):
+                candidates.setdefault(key, []).append(doc_id)
+                signatures[doc_id] = signature
+
+        duplicates = {}
+        bands = []
+        for document in documents:
+            if document.url not in keys:
+                continue
+            # The most similar page, the oldest one on a tie
+            found = {doc_id for key in keys[document.url] for doc_id in candidates.get(key, ())}
+            best = max(((similarity(document.signature, signatures[doc_id]), -doc_id) for doc_id in found), default=None)
+            if best is not None and best[0] >= self.duplicate_similarity:
+                duplicates[document.url] = -best[1]
+                continue
+            doc_id = self.doc_ids[document.url]
+            signatures[doc_id] = document.signature
+            for key in keys[document.url]:
+                candidates.setdefault(key, []).append(doc_id)
+                bands.append((key, doc_id))
+        self.write(SignatureBand.__table__, ('key', 'doc_id'), bands)
+        return duplicates
+
+    def remove(self, doc_ids: list[int]) -> None:
+        """Deletes the rows indexed for stored documents before they are indexed again, links pointing to them are kept
+
+        The near-duplicates of the documents lose their validators, the next crawl downloads them again and compares
+        them to the new version.
+        """
+        for ids in chunks(doc_ids):
+            self.title_terms.remove(self.db, TitlePostingList, ids)
+            self.body_terms.remove(self.db, BodyPostingList, ids)
+            self.db.execute(delete(DocumentKeyword.__table__).where(DocumentKeyword.__table__.c.doc_id.in_(ids)))
+            self.db.execute(delete(document_to_document).where(document_to_document.c.right_id.in_(ids)))
+            self.db.execute(delete(SignatureBand.__table__).where(SignatureBand.__table__.c.doc_id.in_(ids)))
+            self.db.execute(\
+                update(Document.__table__)\
+                .where(Document.__table__.c.duplicate_of_id.in_(ids))\
+                .values(last_modified=UNKNOWN_TIME, etag=None)\
+            )
+
+            if self.shared:
+                continue
+            # The near-duplicates were not counted
+            count, size, title_size = self.db.execute(\
+                select(func.count(), func.coalesce(func.sum(Document.size), 0), func.coalesce(func.sum(Document.title_size), 0))\
+                .where(Document.id.in_(ids), Document.duplicate_of_id.is_(None))\
+            ).one()
+            self.statistics.document_count -= count
+            self.statistics.body_size -= size
+            self.statistics.title_size -= title_size
+
+    def close(self) -> None:
+        self.flush()
+        if self.shared:
+            self.refresh_statistics()
+
+    def refresh_statistics(self) -> None:
+        """Computes the statistics of the collection and the document frequencies, once every worker is done"""
+        # The workers ending at the same time take turns
+        self.db.refresh(self.statistics, with_for_update=True)
+        self.title_terms.refresh_df(self.db, TitlePostingList)
+        self.body_terms.refresh_df(self.db, BodyPostingList)
+        self.statistics.document_count, self.statistics.body_size, self.statistics.title_size = self.db.execute(\
+            select(func.count(), func.coalesce(func.sum(Document.size), 0), func.coalesce(func.sum(Document.title_size), 0))\
+            .where(Document.duplicate_of_id.is_(None))\
+        ).one()
+
+    def report(self) -> str:
+        rate = self.rows/self.elapsed if self.elapsed > 0 else 0.0
+        return f'Wrote {self.rows} rows in {self.elapsed:.2f} s ({rate:.0f} rows/s)'
@@ -1,8 +1,12 @@
 import os
 
-DATABASE_URI = 'postgresql+psycopg2://{dbuser}:{dbpass}@{dbhost}/{dbname}'.format(
-    dbuser=os.environ['DBUSER'],
-    dbpass=os.environ['DBPASS'],
-    dbhost=os.environ['DBHOST'],
-    dbname=os.environ['DBNAME']
-)
+# DATABASE_URI selects any SQLAlchemy database instead, such as sqlite:///seekify.db for the benchmarks
+if 'DATABASE_URI' in os.environ:
+    DATABASE_URI = os.environ['DATABASE_URI']
+else:
+    DATABASE_URI = 'postgresql+psycopg2://{dbuser}:{dbpass}@{dbhost}/{dbname}'.format(
+        dbuser=os.environ['DBUSER'],
+        dbpass=os.environ['DBPASS'],
+        dbhost=os.environ['DBHOST'],
+        dbname=os.environ['DBNAME']
+    )
@@ -0,0 +1,99 @@
+"""Synthetic linked HTML corpora served from a local HTTP server, used by the benchmarks.
+
+Every page has a title and a body of words drawn from a Zipf law over the
+vocabulary, its skew is the exponent of the law. Page i links to page i+1 so
+that the whole corpus is reachable from p0.html, plus random other pages.
+"""
+import contextlib
+import itertools
+import os
+import random
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+CONSONANTS = 'bcdfghjklmnprstvz'
+VOWELS = 'aeiou'
+
+def make_vocabulary(size: int, rng: random.Random) -> list[str]:
+    """Returns distinct pronounceable words, the tokenizer and the stemmer keep them apart"""
+    syllables = [consonant + vowel for consonant in CONSONANTS for vowel in VOWELS]
+    words: set[str] = set()
+    length = 2
+    while len(words) < size:
+        # Longer words once the short ones run out
+        if len(words) >= len(syllables)**length//2:
+            length += 1
+        words.add(''.join(rng.choices(syllables, k=length)) + rng.choice(CONSONANTS))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+class Corpus:
+    def __init__(self, pages: int, vocabulary: int, skew: float, words_per_page: int, links_per_page: int, seed: int = 0) -> None:
+        self.pages = pages
+        self.skew = skew
+        self.words_per_page = words_per_page
+        self.links_per_page = links_per_page
+        self.seed = seed
+        rng = random.Random(seed)
+        # The first words of the vocabulary are the most frequent
+        self.vocabulary = make_vocabulary(vocabulary, rng)
+        self.cum_weights = list(itertools.accumulate(1/(rank**skew) for rank in range(1, vocabulary + 1)))
+
+    def draw(self, rng: random.Random, k: int) -> list[str]:
+        return rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=k)
+
+    def page(self, i: int) -> tuple[str, list[str]]:
+        """Returns the HTML of a page and the words of its body"""
+        rng = random.Random(self.seed*1000003 + i)
+        title = self.draw(rng, rng.randint(2, 6))
+        body = self.draw(rng, max(1, int(rng.expovariate(1/self.words_per_page))))
+        links = [(i + 1) % self.pages] + [rng.randrange(self.pages) for _ in range(self.links_per_page - 1)]
+        # The elements are separated by new lines, the text of adjacent tags would be read as a single word
+        paragraphs = ''.join(f'<p>{" ".join(body[j:j + 50])}</p>\n' for j in range(0, len(body), 50))
+        anchors = ''.join(f'<li><a href="p{link}.html">{" ".join(self.draw(rng, 2))}</a></li>\n' for link in links)
+        html = f'<!DOCTYPE html>\n<html><head><title>{" ".join(title)}</title></head>\n<body>\n{paragraphs}<ul>\n{anchors}</ul>\n</body></html>\n'
+        return html, body
+
+    def write(self, directory: str) -> int:
+        """Writes the pages to the directory and returns their total size in bytes"""
+        os.makedirs(directory, exist_ok=True)
+        size = 0
+        for i in range(self.pages):
+            html, _ = self.page(i)
+            data = html.encode('utf-8')
+            with open(os.path.join(directory, f'p{i}.html'), 'wb') as f:
+                f.write(data)
+            size += len(data)
+        return size
+
+    def sample_words(self, rng: random.Random, k: int) -> list[str]:
+        """Query words follow the same law as the text, most queries ask for common words"""
+        return self.draw(rng, k)
+
+    def sample_phrase(self, rng: random.Random, length: int) -> list[str]:
+        """Returns consecutive words of a random page so that the phrase is found at least once"""
+        while True:
+            _, body = self.page(rng.randrange(self.pages))
+            if len(body) >= length:
+                start = rng.randrange(len(body) - length + 1)
+                return body[start:start + length]
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+@contextlib.contextmanager
+def serve(directory: str) -> Iterator[str]:
+    """Serves the directory on a free local port and yields its base URL, the pages are sent with Last-Modified"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/'
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,68 @@
+"""Measures the size and the lookup latency of the front coded term dictionary.
+
+Usage: python benchmarks/dictionary_benchmark.py [--terms N] [--lookups N]
+
+The vocabulary is made of random lowercase words, the memory usage is compared
+with a dict mapping every word to its term id and df.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.dictionary import FrontCodedDictionary
+
+def make_vocabulary(terms: int, rng: random.Random) -> list[str]:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words: set[str] = set()
+    while len(words) < terms:
+        words.add(''.join(rng.choices(letters, k=min(3 + int(rng.expovariate(0.25)), 20))))
+    return sorted(words, key=lambda word: word.encode('utf-8'))
+
+def dict_size(terms: dict[str, tuple[int, int]]) -> int:
+    # Entries share nothing but the small integers, every key and value is a separate object
+    return sys.getsizeof(terms) + sum(sys.getsizeof(word) + sys.getsizeof(entry) + sum(sys.getsizeof(value) for value in entry) for word, entry in terms.items())
+
+def timed(lookup, keys: list[str]) -> float:
+    start = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    return 1e6*(time.perf_counter() - start)/len(keys)
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--terms', type=int, default=1000000)
+    argparser.add_argument('--lookups', type=int, default=100000)
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    words = make_vocabulary(args.terms, rng)
+    dfs = array('q', (1 + int(rng.expovariate(0.01)) for _ in words))
+
+    start = time.perf_counter()
+    dictionary = FrontCodedDictionary([word.encode('utf-8') for word in words], array('q', range(1, len(words) + 1)), dfs)
+    built = time.perf_counter() - start
+    reference = {word: (i + 1, dfs[i]) for i, word in enumerate(words)}
+
+    per_million = 1000000/len(words)
+    print(f'{len(words)} terms, built in {built:.2f} s')
+    print(f'front coded: {dictionary.nbytes()*per_million/2**20:8.1f} MiB per million terms')
+    print(f'       dict: {dict_size(reference)*per_million/2**20:8.1f} MiB per million terms')
+
+    present = rng.choices(words, k=args.lookups)
+    absent = [word + 'q' for word in rng.choices(words, k=args.lookups)]
+    prefixes = [word[:rng.randint(1, 3)] for word in rng.choices(words, k=args.lookups)]
+    assert all(dictionary.get(word) == reference[word] for word in present[:1000])
+    print(f'exact hit:    {timed(dictionary.get, present):6.2f} us  (dict {timed(reference.get, present):.2f} us)')
+    print(f'exact miss:   {timed(dictionary.get, absent):6.2f} us')
+    print(f'prefix range: {timed(dictionary.prefix_range, prefixes):6.2f} us')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Compares the throughput of the punkt and regex tokenizers of the Parser.
+
+Usage: python benchmarks/parser_benchmark.py [FILE ...]
+
+The text of the given files is analyzed, or the text of the crawled pages
+stored in the database when no file is given.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+load_dotenv()
+
+from bs4 import BeautifulSoup
+from sqlalchemy import select
+from app import app, db
+from app.models import Document
+from app.parser import Parser
+
+def load_texts(files: list[str], limit: int) -> list[str]:
+    if files:
+        texts = []
+        for path in files:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                texts.append(f.read())
+        return texts
+    with app.app_context():
+        return [\
+            BeautifulSoup(content, 'lxml').get_text()\
+            for content in db.session.scalars(select(Document.content).where(Document.content.is_not(None)).limit(limit))\
+        ]
+
+def run(parser: Parser, texts: list[str], rounds: int) -> tuple[float, int, list[list[str]]]:
+    tokens = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parsed = [parser.parse(text)[0] for text in texts]
+        tokens += sum(len(parser.tokenize(text)) for text in texts)
+    return time.perf_counter() - start, tokens, parsed
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('files', nargs='*')
+    argparser.add_argument('--rounds', type=int, default=3)
+    argparser.add_argument('--limit', type=int, default=1000, help='Number of stored pages used when no file is given')
+    args = argparser.parse_args()
+
+    texts = load_texts(args.files, args.limit)
+    if not texts:
+        sys.exit('No text to analyze')
+
+    results = {}
+    for tokenizer in ('punkt', 'regex'):
+        parser = Parser(tokenizer)
+        elapsed, tokens, parsed = run(parser, texts, args.rounds)
+        results[tokenizer] = parsed
+        info = parser.stem.cache_info()
+        print(f'{tokenizer:>6}: {tokens/elapsed:12.0f} tokens/s  {elapsed:8.3f} s  stem cache {info.hits} hits {info.misses} misses')
+
+    # Both modes should index the same stems
+    same = sum(punkt == regex for punkt, regex in zip(results['punkt'], results['regex']))
+    print(f'identical stemmed token lists: {same}/{len(texts)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Compares the scalar, Block-Max WAND and vectorized BM25 rankings.
+
+Usage: python benchmarks/scoring_benchmark.py [--docs N] [--queries N] [--terms N]
+
+Queries are drawn from a synthetic collection whose term frequencies follow
+a Zipf law, every ranking has to return the same documents.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.scoring import K1, K2, FieldStatistics, PhrasePostings, block_upper_bounds, rank
+
+def make_postings(docs: int, df: int, rng: random.Random) -> tuple[array, array]:
+    doc_ids = array('q', sorted(rng.sample(range(docs), df)))
+    ftds = array('q', (min(1 + int(rng.expovariate(0.7)), 50) for _ in range(df)))
+    return doc_ids, ftds
+
+def make_queries(docs: int, queries: int, terms: int, fields: dict[str, FieldStatistics], rng: random.Random) -> list[list[tuple]]:
+    # Document frequency of the term of rank r is proportional to 1/r, and so is its probability to be queried
+    vocabulary = [max(1, int(docs*0.5/r)) for r in range(1, 2001)]
+    weights = [1/r for r in range(1, len(vocabulary) + 1)]
+    postings: dict[tuple[str, int], tuple] = {}
+    result = []
+    for _ in range(queries):
+        query = []
+        for rank_ in set(rng.choices(range(len(vocabulary)), weights, k=rng.randint(1, terms))):
+            for field in ('title', 'body'):
+                if (field, rank_) not in postings:
+                    df = max(1, vocabulary[rank_]//10) if field == 'title' else vocabulary[rank_]
+                    doc_ids, ftds = make_postings(docs, df, rng)
+                    # Block bounds of single terms are precomputed by the index
+                    postings[field, rank_] = (field, doc_ids, ftds, block_upper_bounds(doc_ids, ftds, docs, df, fields[field]))
+                query.append(postings[field, rank_])
+        result.append(query)
+    return result
+
+def run(queries, fields: dict[str, FieldStatistics], docs: int, top: int, pruning: bool, vectorized: bool):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        postings = [PhrasePostings(doc_ids, ftds, fields[field], None, block_max) for field, doc_ids, ftds, block_max in query]
+        results.append(rank(postings, docs, top, pruning, vectorized=vectorized))
+    return time.perf_counter() - start, results
+
+def same(expected: list[tuple[float, int]], got: list[tuple[float, int]]) -> bool:
+    return len(expected) == len(got) and all(a[1] == b[1] and abs(a[0] - b[0]) <= 1e-9*max(1.0, abs(a[0])) for a, b in zip(expected, got))
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--docs', type=int, default=100000)
+    argparser.add_argument('--queries', type=int, default=50)
+    argparser.add_argument('--terms', type=int, default=3, help='Maximum number of terms per query')
+    argparser.add_argument('--top', type=int, default=50)
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    title_sizes = array('I', (rng.randint(1, 12) for _ in range(args.docs)))
+    body_sizes = array('I', (rng.randint(20, 2000) for _ in range(args.docs)))
+    fields = {
+        'title': FieldStatistics(K1, sum(title_sizes)/args.docs, title_sizes),
+        'body': FieldStatistics(K2, sum(body_sizes)/args.docs, body_sizes),
+    }
+    queries = make_queries(args.docs, args.queries, args.terms, fields, rng)
+    postings = sum(len(doc_ids) for query in queries for _, doc_ids, _, _ in query)
+    print(f'{args.docs} documents, {args.queries} queries, {postings} postings')
+
+    baseline = None
+    for name, pruning, vectorized in (('scalar', False, False), ('wand', True, False), ('vectorized', False, True)):
+        elapsed, results = run(queries, fields, args.docs, args.top, pruning, vectorized)
+        if baseline is None:
+            baseline = results
+        identical = sum(same(expected, got) for expected, got in zip(baseline, results))
+        print(f'{name:>10}: {1000*elapsed/len(queries):8.2f} ms/query  {postings/elapsed:12.0f} postings/s  identical {identical}/{len(queries)}')
+
+if __name__ == '__main__':
+    main()
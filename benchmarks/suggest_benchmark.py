@@ -0,0 +1,59 @@
+"""Measures the build time, the size and the latency of the query suggestions.
+
+Usage: python benchmarks/suggest_benchmark.py [--terms N] [--lookups N]
+
+The vocabulary is made of random lowercase words whose document frequencies
+follow a Zipf law, the prefixes looked up are the first letters of words drawn
+with the same law, like the ones typed by users.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.suggest import Suggestions
+
+def make_terms(terms: int, rng: random.Random) -> dict[str, tuple[str, int, int]]:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words: set[str] = set()
+    while len(words) < terms:
+        words.add(''.join(rng.choices(letters, k=min(3 + int(rng.expovariate(0.25)), 20))))
+    # The stems are not looked up, the words stand for them
+    return {word: (word, 0, max(1, int(100000/rank))) for rank, word in enumerate(rng.sample(sorted(words), len(words)), 1)}
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(p*len(values)))]
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--terms', type=int, default=200000)
+    argparser.add_argument('--lookups', type=int, default=100000)
+    argparser.add_argument('--limit', type=int, default=10)
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    suggestions = Suggestions(0, args.limit)
+    suggestions.terms = make_terms(args.terms, rng)
+    start = time.perf_counter()
+    suggestions.rank_terms()
+    print(f'{len(suggestions)} words, {len(suggestions.top)} precomputed prefixes, built in {time.perf_counter() - start:.2f} s')
+
+    words = list(suggestions.weights)
+    weights = [suggestions.weights[word] for word in words]
+    prefixes = [word[:rng.randint(1, 5)] for word in rng.choices(words, weights, k=args.lookups)]
+    latencies = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        suggestions.suggest(prefix)
+        latencies.append(1e6*(time.perf_counter() - start))
+    latencies.sort()
+    print(f'suggest: p50 {percentile(latencies, 0.5):.1f} us  p95 {percentile(latencies, 0.95):.1f} us  p99 {percentile(latencies, 0.99):.1f} us  max {latencies[-1]:.1f} us')
+
+if __name__ == '__main__':
+    main()
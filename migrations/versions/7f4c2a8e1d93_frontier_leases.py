@@ -0,0 +1,47 @@
+"""Frontier leases
+
+Host hash partitioning the frontier between the crawler workers and the time
+the lease of a worker on a page it fetches expires.
+
+Revision ID: 7f4c2a8e1d93
+Revises: 3e7b1f9d4a25
+Create Date: 2026-10-17 02:48:13.905127
+
+"""
+import zlib
+from urllib.parse import urlsplit
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f4c2a8e1d93'
+down_revision = '3e7b1f9d4a25'
+branch_labels = None
+depends_on = None
+
+
+def host_hash(url):
+    # Same hash as app.frontier.host_hash, copied so that the migration does not depend on the application
+    return zlib.crc32(urlsplit(url).netloc.encode('utf-8')) & 0x7fffffff
+
+
+def upgrade():
+    with op.batch_alter_table('frontier_table', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('host_hash', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('lease_expires', sa.DateTime(), nullable=True))
+
+    # The urls of a previous crawl are resumed by the worker of their host
+    bind = op.get_bind()
+    frontier = sa.table('frontier_table', sa.column('id'), sa.column('url'), sa.column('host_hash'))
+    rows = [{'url_id': row.id, 'new_host_hash': host_hash(row.url)} for row in bind.execute(sa.select(frontier.c.id, frontier.c.url))]
+    if len(rows) > 0:
+        bind.execute(frontier.update().where(frontier.c.id == sa.bindparam('url_id')).values(host_hash=sa.bindparam('new_host_hash')), rows)
+    with op.batch_alter_table('frontier_table', schema=None) as batch_op:
+        batch_op.alter_column('host_hash', server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('frontier_table', schema=None) as batch_op:
+        batch_op.drop_column('lease_expires')
+        batch_op.drop_column('host_hash')
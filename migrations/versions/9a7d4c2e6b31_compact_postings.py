@@ -0,0 +1,156 @@
+"""Compact postings
+
+One row per term and document with the term frequency and the delta encoded
+positions, instead of one row per occurrence in the posting tables and one row
+per term and document in the count tables.
+
+Revision ID: 9a7d4c2e6b31
+Revises: 5c1e8a3f2b64
+Create Date: 2026-10-17 01:12:21.224754
+
+"""
+from itertools import groupby
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a7d4c2e6b31'
+down_revision = '5c1e8a3f2b64'
+branch_labels = None
+depends_on = None
+
+# Field, table of the new postings, previous posting and count tables
+FIELDS = (
+    ('title', 'title_postings_table', 'title_posting_table', 'title_count_table'),
+    ('body', 'body_postings_table', 'body_posting_list', 'body_count_table'),
+)
+BATCH_SIZE = 10000
+# Options of the statements streaming the postings, set on the statements since the connection runs the DDL too
+STREAM = {'stream_results': True, 'yield_per': BATCH_SIZE}
+
+
+def delta_encode(values):
+    # Same encoding as app.index.delta_encode, copied so that the migration does not depend on the application
+    out = bytearray()
+    previous = 0
+    for value in values:
+        gap = value - previous
+        previous = value
+        while gap >= 0x80:
+            out.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return bytes(out)
+
+
+def delta_decode(data):
+    values = []
+    total = 0
+    value = 0
+    shift = 0
+    # Postgres returns the untyped binary column as a memoryview
+    for byte in bytes(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            total += value
+            values.append(total)
+            value = 0
+            shift = 0
+    return values
+
+
+def postings_table(name):
+    return sa.table(name, sa.column('term_id'), sa.column('doc_id'), sa.column('tf'), sa.column('positions'))
+
+
+def insert_batches(bind, table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            bind.execute(table.insert(), batch)
+            batch = []
+    if len(batch) > 0:
+        bind.execute(table.insert(), batch)
+
+
+def pack_postings(occurrences):
+    for (term_id, doc_id), group in groupby(occurrences, key=lambda row: (row.term_id, row.doc_id)):
+        positions = [row.position for row in group]
+        yield {'term_id': term_id, 'doc_id': doc_id, 'tf': len(positions), 'positions': delta_encode(positions)}
+
+
+def upgrade():
+    bind = op.get_bind()
+    for field, table_name, posting_name, count_name in FIELDS:
+        op.create_table(table_name,
+        sa.Column('term_id', sa.Integer(), nullable=False),
+        sa.Column('doc_id', sa.Integer(), nullable=False),
+        sa.Column('tf', sa.Integer(), nullable=False),
+        sa.Column('positions', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['doc_id'], ['document_table.id'], ),
+        sa.ForeignKeyConstraint(['term_id'], [f'{field}_term_table.id'], ),
+        sa.PrimaryKeyConstraint('term_id', 'doc_id'),
+        sqlite_with_rowid=False
+        )
+
+        # The occurrences are streamed in primary key order and packed per term and document
+        old_postings = sa.table(posting_name, sa.column('term_id'), sa.column('doc_id'), sa.column('position'))
+        occurrences = bind.execute(\
+            sa.select(old_postings.c.term_id, old_postings.c.doc_id, old_postings.c.position)\
+            .order_by(old_postings.c.term_id, old_postings.c.doc_id, old_postings.c.position)\
+            .execution_options(**STREAM)\
+        )
+        insert_batches(bind, postings_table(table_name), pack_postings(occurrences))
+
+        # The index is built once the rows are loaded
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.create_index(batch_op.f(f'ix_{table_name}_doc_id'), ['doc_id'], unique=False)
+
+        op.drop_table(posting_name)
+        op.drop_table(count_name)
+
+
+def downgrade():
+    bind = op.get_bind()
+    for field, table_name, posting_name, count_name in FIELDS:
+        op.create_table(count_name,
+        sa.Column('id', sa.INTEGER(), nullable=False),
+        sa.Column('doc_id', sa.INTEGER(), nullable=False),
+        sa.Column('term_id', sa.INTEGER(), nullable=False),
+        sa.Column('count', sa.INTEGER(), nullable=False),
+        sa.ForeignKeyConstraint(['doc_id'], ['document_table.id'], ),
+        sa.ForeignKeyConstraint(['term_id'], [f'{field}_term_table.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_table(posting_name,
+        sa.Column('id', sa.INTEGER(), nullable=False),
+        sa.Column('doc_id', sa.INTEGER(), nullable=False),
+        sa.Column('term_id', sa.INTEGER(), nullable=False),
+        sa.Column('position', sa.INTEGER(), nullable=False),
+        sa.ForeignKeyConstraint(['doc_id'], ['document_table.id'], ),
+        sa.ForeignKeyConstraint(['term_id'], [f'{field}_term_table.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+        postings = postings_table(table_name)
+        counts = sa.table(count_name, sa.column('doc_id'), sa.column('term_id'), sa.column('count'))
+        old_postings = sa.table(posting_name, sa.column('doc_id'), sa.column('term_id'), sa.column('position'))
+        select_postings = sa.select(postings.c.term_id, postings.c.doc_id, postings.c.tf, postings.c.positions)\
+            .order_by(postings.c.term_id, postings.c.doc_id)
+        insert_batches(bind, counts, (\
+            {'doc_id': row.doc_id, 'term_id': row.term_id, 'count': row.tf}\
+            for row in bind.execute(select_postings.execution_options(**STREAM))\
+        ))
+        insert_batches(bind, old_postings, (\
+            {'doc_id': row.doc_id, 'term_id': row.term_id, 'position': position}\
+            for row in bind.execute(select_postings.execution_options(**STREAM))\
+            for position in delta_decode(row.positions)\
+        ))
+
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.drop_index(batch_op.f(f'ix_{table_name}_doc_id'))
+        op.drop_table(table_name)
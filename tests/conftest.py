@@ -0,0 +1,145 @@
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator
+from unittest import mock
+import nltk
+import pytest
+
+# The app is configured on import, the tests that do not touch the database use an in-memory SQLite one
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+class SiteHandler(BaseHTTPRequestHandler):
+    server: 'SiteServer'
+
+    def do_GET(self) -> None:
+        site = self.server.site
+        status = site.request(self.path)
+        try:
+            if status == 0:
+                # The connection is closed without an answer, the client sees a connection error
+                self.close_connection = True
+                return
+            if status != 200:
+                self.send_error(status)
+                return
+            body = site.pages[self.path].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            site.release()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+class SiteServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site: 'Site') -> None:
+        super().__init__(('127.0.0.1', 0), SiteHandler)
+        self.site = site
+
+class Site:
+    """Pages served by http.server from a thread, with the requests they received
+
+    A path answers with the statuses queued for it in statuses first, 0 closes the connection without an answer,
+    then with its page or 404. Every request is delayed by delay seconds.
+    """
+    def __init__(self) -> None:
+        self.pages: dict[str, str] = {}
+        self.statuses: dict[str, list[int]] = {}
+        self.delay = 0.0
+        self.hits: Counter = Counter()
+        # Times at which the requests arrived and the highest number of requests served at the same time
+        self.arrivals: list[float] = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.server = SiteServer(self)
+        # A short poll interval so that the server shuts down quickly
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def request(self, path: str) -> int:
+        with self.lock:
+            self.hits[path] += 1
+            self.arrivals.append(time.monotonic())
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            queued = self.statuses.get(path)
+            status = queued.pop(0) if queued else 200 if path in self.pages else 404
+        time.sleep(self.delay)
+        return status
+
+    def release(self) -> None:
+        with self.lock:
+            self.active -= 1
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+def linked_pages(url: str, dead_url: str) -> dict[str, str]:
+    """A small site: a home page linking to articles that link to each other, to a missing page and to a dead host"""
+    topics = {
+        'rivers': 'Rivers carry water from the mountains down to the sea through valleys and plains',
+        'forests': 'Forests cover the hills where rivers start, their trees shelter birds and deer',
+        'deserts': 'Deserts receive little rain, few rivers cross them and forests never grow there',
+        'oceans': 'Oceans receive the water of every river and cover most of the planet',
+    }
+    pages = {'/': '<html><head><title>Geography</title></head><body><p>Landscapes of the world</p>'\
+        + ''.join(f'<a href="/{topic}.html">{topic}</a>' for topic in topics) + '</body></html>'}
+    for i, (topic, text) in enumerate(topics.items()):
+        neighbour = list(topics)[(i + 1) % len(topics)]
+        pages[f'/{topic}.html'] = f'<html><head><title>{topic.capitalize()}</title></head><body><p>{text}</p>'\
+            f'<a href="{url}{neighbour}.html">{neighbour}</a><a href="/missing.html">missing</a>'\
+            f'<a href="{dead_url}{topic}.html">mirror</a><a href="/">home</a></body></html>'
+    return pages
+
+@pytest.fixture
+def dead_url() -> str:
+    """Base url of a local port nothing listens on, its connections are refused"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f'http://127.0.0.1:{port}/'
+
+@pytest.fixture
+def make_site() -> Iterator[Callable[[], Site]]:
+    sites = []
+    def make() -> Site:
+        site = Site()
+        sites.append(site)
+        return site
+    yield make
+    for site in sites:
+        site.close()
+
+@pytest.fixture
+def site(make_site, dead_url) -> Site:
+    site = make_site()
+    site.pages.update(linked_pages(site.url, dead_url))
+    return site
+
+@pytest.fixture
+def crawl_db():
+    """Empty database of the application for the crawls of a test, the parser needs the nltk stopwords"""
+    try:
+        nltk.data.find('corpora/stopwords')
+    except LookupError:
+        pytest.skip('The nltk stopwords are not downloaded')
+    from app import app, db, init_db
+    # The regex tokenizer does not need the punkt data, a failing page is only retried once
+    with mock.patch.dict(app.config, PARSER_TOKENIZER='regex', SPIDER_RETRIES=1), app.app_context():
+        init_db()
+        yield db
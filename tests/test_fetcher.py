@@ -0,0 +1,65 @@
+from unittest import mock
+import pytest
+from app.fetcher import Fetcher
+
+@pytest.mark.parametrize('status', [500, 503, 429])
+def test_retries_transient_statuses(site, status):
+    site.statuses['/'] = [status, status]
+    with Fetcher(retries=3, backoff=0.01) as fetcher:
+        result = fetcher.fetch(site.url)
+    assert result.ok
+    assert site.hits['/'] == 3
+
+def test_gives_up_after_retries(site):
+    site.statuses['/'] = [500]*5
+    with Fetcher(retries=2, backoff=0.01) as fetcher:
+        result = fetcher.fetch(site.url)
+    assert result.status == 500
+    assert site.hits['/'] == 3
+
+def test_does_not_retry_missing_pages(site):
+    with Fetcher(retries=3, backoff=0.01) as fetcher:
+        result = fetcher.fetch(site.url + 'missing.html')
+    assert result.status == 404
+    assert site.hits['/missing.html'] == 1
+
+def test_retries_dropped_connections(site):
+    site.statuses['/'] = [0, 0]
+    with Fetcher(retries=3, backoff=0.01) as fetcher:
+        result = fetcher.fetch(site.url)
+    assert result.ok
+    assert site.hits['/'] == 3
+
+def test_retries_refused_connections(dead_url):
+    with Fetcher(retries=2, backoff=0.01) as fetcher, mock.patch('app.fetcher.time.sleep') as sleep:
+        result = fetcher.fetch(dead_url)
+    assert result.status == 0 and result.error is not None
+    # One backoff before every retry
+    assert sleep.call_count == 2
+
+def test_does_not_retry_invalid_urls():
+    with Fetcher(retries=3, backoff=0.01) as fetcher, mock.patch('app.fetcher.time.sleep') as sleep:
+        result = fetcher.fetch('http://')
+    assert result.status == 0 and result.error is not None
+    assert sleep.call_count == 0
+
+def test_caps_requests_per_host(make_site):
+    sites = [make_site(), make_site()]
+    for site in sites:
+        site.pages.update({f'/{i}.html': '<html></html>' for i in range(6)})
+        site.delay = 0.05
+    with Fetcher(concurrency=8, per_host=2) as fetcher:
+        futures = [fetcher.submit(f'{site.url}{i}.html') for i in range(6) for site in sites]
+        assert all(future.result().ok for future in futures)
+    # The hosts are capped separately, both reach the cap at the same time
+    assert [site.max_active for site in sites] == [2, 2]
+
+def test_spaces_requests_by_delay(site):
+    pages = ['', 'rivers.html', 'forests.html', 'deserts.html', 'oceans.html']
+    with Fetcher(concurrency=4, per_host=4, delay=0.2) as fetcher:
+        futures = [fetcher.submit(site.url + page) for page in pages]
+        assert all(future.result().ok for future in futures)
+    arrivals = sorted(site.arrivals)
+    assert len(arrivals) == len(pages)
+    # Some slack for the time the requests take to arrive, the first one opens the connection
+    assert min(later - earlier for earlier, later in zip(arrivals, arrivals[1:])) >= 0.15
@@ -0,0 +1,24 @@
+import pytest
+from nltk.tokenize import word_tokenize
+from app.parser import FAST_TOKEN_PATTERN
+
+SAMPLES = [
+    ("I can't go, we won't stop and you cannot be serious", ['I', 'ca', 'go', 'we', 'wo', 'stop', 'and', 'you', 'can', 'not', 'be', 'serious']),
+    ("DON'T say it's John's, isn't it?", ['DO', 'say', 'it', 'John', 'is', 'it']),
+    ("we're sure they've left but I'd stay", ['we', 'sure', 'they', 'left', 'but', 'I', 'stay']),
+    ("gonna wanna gotta gimme lemme", ['gon', 'na', 'wan', 'na', 'got', 'ta', 'gim', 'me', 'lem', 'me']),
+    ("a well-known state-of-the-art method, pre- and post-war", ['a', 'method', 'and']),
+    ("well--known don't-care rock'n'roll O'Neil", ['well', 'known']),
+    ("the U.S. army, e.g. this and/or example.com", ['the', 'army', 'this']),
+    ("say 'hello' now, 'tis the season", ['say', 'hello', 'now', 'tis', 'the', 'season']),
+    ("naïve café façade", ['naïve', 'café', 'façade']),
+]
+
+def alphabetic(tokens: list[str]) -> list[str]:
+    return [token for token in tokens if token.isalpha()]
+
+@pytest.mark.parametrize('text, expected', SAMPLES)
+def test_regex_tokenizer_matches_punkt(text, expected):
+    # A single line so that word_tokenize does not need the punkt sentence splitter
+    assert alphabetic(FAST_TOKEN_PATTERN.findall(text)) == expected
+    assert alphabetic(word_tokenize(text, preserve_line=True)) == expected
@@ -0,0 +1,26 @@
+from array import array
+from unittest import mock
+import pytest
+from app import scoring
+from app.scoring import K1, FieldStatistics, PhrasePostings, rank
+
+def make_postings() -> list[PhrasePostings]:
+    sizes = array('I', [3, 5, 8, 2, 4])
+    field = FieldStatistics(K1, 4.0, sizes)
+    return [PhrasePostings(array('q', [0, 2, 4]), array('q', [1, 3, 1]), field, 3)]
+
+@pytest.mark.parametrize('pruning, vectorized, ranker', [
+    (True, False, 'rank_wand'),
+    (False, False, 'rank_exhaustive'),
+    (False, True, 'rank_vectorized'),
+    (True, True, 'rank_vectorized'),
+])
+def test_flags_select_ranker(pruning, vectorized, ranker):
+    rankers = ('rank_wand', 'rank_exhaustive', 'rank_vectorized')
+    with mock.patch.multiple(scoring, **{name: mock.DEFAULT for name in rankers}) as mocks:
+        rank(make_postings(), 5, 2, pruning, vectorized=vectorized)
+    assert [name for name in rankers if mocks[name].called] == [ranker]
+
+def test_rankers_agree():
+    results = [rank(make_postings(), 5, 2, pruning, vectorized=vectorized) for pruning, vectorized in ((True, False), (False, False), (False, True))]
+    assert results[0] == results[1] == results[2]
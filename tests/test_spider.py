@@ -0,0 +1,70 @@
+import datetime
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+from app import init_db
+from app.frontier import FAILED
+from app.models import BodyPostingList, BodyTerm, Document, FrontierLink, FrontierUrl, document_to_document
+from app.spider import close_spider, init_spider, parse_page
+
+CRAWL_TIME = datetime.datetime(2025, 1, 1)
+
+def head_page(meta: str) -> str:
+    # Without a title or a body the page is parsed without tokenizing anything
+    return f'<html><head>{meta}</head></html>'
+
+@pytest.mark.parametrize('meta', [
+    '<meta name="last-modified" content="2024-01-01">',
+    '<meta name="last-modified" content="">',
+    '<meta name="last-modified">',
+])
+def test_malformed_last_modified_tag(meta):
+    page = parse_page('http://localhost/', head_page(meta), None, None, CRAWL_TIME)
+    assert not page.dated
+    assert page.document.last_modified == CRAWL_TIME
+
+def test_last_modified_tag():
+    meta = '<meta name="last-modified" content="Mon, 01 Jan 2024 10:00:00 +0200">'
+    page = parse_page('http://localhost/', head_page(meta), None, None, CRAWL_TIME)
+    assert page.dated
+    assert page.document.last_modified == datetime.datetime(2024, 1, 1, 8)
+
+def test_malformed_header_falls_back_to_tag():
+    meta = '<meta name="last-modified" content="Mon, 01 Jan 2024 10:00:00 GMT">'
+    page = parse_page('http://localhost/', head_page(meta), 'yesterday', None, CRAWL_TIME)
+    assert page.document.last_modified == datetime.datetime(2024, 1, 1, 10)
+
+def crawl(db, url: str, concurrency: int) -> dict:
+    """Crawls the site into the empty database and returns what was indexed"""
+    init_spider(url, concurrency, 0)
+    # The next crawl gets a new spider, this one remembers the pages it discovered
+    close_spider()
+    parent = aliased(Document)
+    return {
+        'documents': dict(db.session.execute(select(Document.url, Document.title)).all()),
+        'links': set(db.session.execute(\
+            select(parent.url, Document.url)\
+            .join(document_to_document, document_to_document.c.left_id == Document.id)\
+            .join(parent, document_to_document.c.right_id == parent.id)\
+        ).all()),
+        'terms': {word: df for word, df in db.session.execute(select(BodyTerm.word, BodyTerm.df))},
+        'postings': db.session.scalar(select(func.count()).select_from(BodyPostingList)),
+    }
+
+def test_concurrent_crawl_indexes_same_pages(site, crawl_db):
+    sequential = crawl(crawl_db, site.url, 1)
+    init_db()
+    concurrent = crawl(crawl_db, site.url, 4)
+    assert len(sequential['documents']) == 5
+    assert concurrent == sequential
+
+def test_unreachable_pages_dropped_from_link_graph(site, crawl_db, dead_url):
+    indexed = crawl(crawl_db, site.url, 4)
+    assert set(indexed['documents']) == {site.url + path.lstrip('/') for path in site.pages}
+    # Home to every article, every article to the next one and back home
+    assert len(indexed['links']) == 12
+    assert all(dead_url not in child and 'missing' not in child for _, child in indexed['links'])
+    states = dict(crawl_db.session.execute(select(FrontierUrl.url, FrontierUrl.state)).all())
+    assert states[site.url + 'missing.html'] == FAILED
+    assert states[dead_url + 'rivers.html'] == FAILED
+    assert crawl_db.session.scalar(select(func.count()).select_from(FrontierLink)) == 0